@@ -1,11 +1,21 @@
-from flask import Flask, request
-from user import User
-from bot import bot
+import atexit
+import logging
+from typing import Callable, Dict
+import telebot
+from flask import Flask, Response, request
+import metrics
+import study_queue
+from db import get_database
+from notion_api import get_client
+from scheduler import ReloadScheduler
+from update_queue import UpdateQueue
+from user import User, review_log
+from bot import bot, SESSIONS, passive_delivery
+from utils import env
 
-app = Flask(__name__)
+logger = logging.getLogger(__name__)
 
 
-@app.route('/notion_auth', methods=["GET"])
 def notion_auth():
     state_token = request.args["state"]
     code = request.args["code"]
@@ -15,6 +25,8 @@ def notion_auth():
     result = user.fetch_access_token(code)
     if not result:
         return 400, "Oops. Try again latter!"
+    # Session of this user was loaded before login and misses the token
+    SESSIONS.invalidate(user.telegram_user_id)
     caption = f"""
 Successfully logged in ✅
 Workspace name: {result['workspace_name']}
@@ -25,3 +37,100 @@ Workspace name: {result['workspace_name']}
     else:
         bot.send_message(chat_id=user.telegram_user_id, text=caption)
     return "Success"
+
+
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def register_webhook(app: Flask, token: str, update_queue: UpdateQueue):
+    """
+    Routes Telegram webhook calls to update queue
+    """
+    metrics.Gauge("webhook_queue_depth", "Telegram updates waiting to be processed", update_queue.depth)
+    register_stats("webhook_queue", update_queue.stats, {"processed": "Telegram updates processed",
+                                                         "rejected": "Telegram updates refused by full queue",
+                                                         "failed": "Telegram updates which handlers raised"})
+
+    @app.route(f"/{token}", methods=["POST"])
+    def tg_token():
+        """Process Telegram webhook calls"""
+        req_data = request.get_data().decode("utf-8")
+        update = telebot.types.Update.de_json(req_data)
+        if not update_queue.put(update):
+            # Telegram redelivers update later
+            return "", 503
+
+        return ""
+
+
+def register_stats(prefix: str, stats: Callable[[], dict], counters: Dict[str, str]):
+    """
+    Exports totals kept by a component as counters named prefix_name_total
+    :param stats: component stats() method
+    :param counters: stats key -> metric documentation
+    """
+    for name, documentation in counters.items():
+        metrics.CallbackCounter(f"{prefix}_{name}_total", documentation, lambda name=name: stats()[name])
+
+
+def warm_up():
+    """
+    Opens connections of the current worker before it takes requests
+    """
+    get_database().command("ping")
+    get_client()
+
+
+def create_app(background_jobs: bool = True) -> Flask:
+    """
+    Creates app of a single worker process and starts its update workers
+    Nothing here talks to Telegram, one-time setup is done by release.py
+    :param background_jobs: start auto reload and passive delivery, they hold leases,
+                            so only one worker of the deployment runs them at a time
+    """
+    metrics.configure_logging()
+    app = Flask(__name__)
+    app.add_url_rule('/notion_auth', view_func=notion_auth, methods=["GET"])
+    app.add_url_rule('/metrics', view_func=metrics_endpoint, methods=["GET"])
+
+    metrics.Gauge("review_log_depth", "Reviews waiting to be written", review_log.depth)
+    register_stats("review_log", review_log.stats, {"written": "Reviews written to the database",
+                                                    "dropped": "Reviews dropped by full buffer"})
+    register_stats("telegram_outbox", bot.outbox.stats, {"sent": "Telegram requests sent",
+                                                         "failed": "Telegram requests failed",
+                                                         "retried": "Telegram requests retried after 429",
+                                                         "coalesced": "Telegram edits replaced by newer ones"})
+    register_stats("session_cache", SESSIONS.stats, {"hits": "User session cache hits",
+                                                     "misses": "User session cache misses",
+                                                     "evictions": "User sessions expired or evicted"})
+    update_queue = UpdateQueue(bot.process_new_updates,
+                               workers=int(env.get("UPDATE_WORKERS", 8)),
+                               maxsize=int(env.get("UPDATE_QUEUE_SIZE", 1000))).start()
+    app.extensions["update_queue"] = update_queue
+    register_webhook(app, env['TG_TOKEN'], update_queue)
+
+    stops = []
+    if background_jobs:
+        stops.append(ReloadScheduler().start().stop)
+        passive_delivery.start()
+        stops.append(passive_delivery.stop)
+    # Queued updates are handled first, their answers are written by study threads and logged,
+    # replies are sent last
+    stops += [update_queue.stop, study_queue.shutdown, review_log.stop, bot.outbox.stop]
+    app.extensions["shutdown"] = stops
+    # Last resort for servers without exit hooks, Python stops executors before atexit handlers
+    atexit.register(shutdown, app)
+    return app
+
+
+def shutdown(app: Flask):
+    """
+    Stops workers of the process in order, runs once
+    Called by gunicorn worker_exit hook and main.py while executors still take tasks
+    """
+    for stop in app.extensions.pop("shutdown", ()):
+        try:
+            stop()
+        except Exception:
+            logger.exception("Failed to stop %s", stop)
@@ -0,0 +1,19 @@
+"""
+Microbenchmarks, run as python -m benchmarks.<name>, results are printed as JSON
+"""
+import statistics
+from typing import List
+
+
+def summarize(seconds: List[float]) -> dict:
+    """
+    Latency summary of timed runs in milliseconds
+    """
+    ordered = sorted(seconds)
+    return {
+        "runs": len(ordered),
+        "mean_ms": round(statistics.mean(ordered) * 1000, 3),
+        "p50_ms": round(ordered[len(ordered) // 2] * 1000, 3),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
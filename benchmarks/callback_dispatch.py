@@ -0,0 +1,69 @@
+"""
+Compares callback dispatch through chain of prefix predicates with opcode table
+
+    python -m benchmarks.callback_dispatch [--number 100000]
+"""
+import argparse
+import json
+import timeit
+from types import SimpleNamespace
+
+import callbacks
+from callbacks import CallbackRouter
+
+CARD_ID = "5f9c1b2e8a4d3c2b1a0f9e8d"
+PAGE_ID = "0123456789abcdef0123456789abcdef"
+
+LEGACY_PREFIXES = ["reload", "delete", "flashcard-flip", "flashcard-answer", "passive-toggle",
+                   "passive-cadence", "passive-offset", "title"]
+
+
+def legacy_handlers():
+    """
+    Handlers the way telebot evaluates them: every predicate splits the payload until one matches
+    """
+    def handler(call):
+        suffix = call.data.split("_")[-1]
+        return call.data.split("_")[1], suffix
+
+    return [(lambda call, prefix=prefix: call.data.split("_")[0] == prefix, handler) for prefix in LEGACY_PREFIXES]
+
+
+def dispatch_legacy(handlers, call):
+    for predicate, handler in handlers:
+        if predicate(call):
+            return handler(call)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=100000)
+    args = parser.parse_args()
+
+    router = CallbackRouter()
+    for opcode, prefix in enumerate(LEGACY_PREFIXES, start=1):
+        router.route(opcode, legacy_prefix=prefix)(lambda call, data: data)
+
+    handlers = legacy_handlers()
+    # Answers are the most frequent callbacks and the last but one legacy predicate to match
+    legacy_call = SimpleNamespace(data=f"flashcard-answer_yes_{CARD_ID}")
+    compact_call = SimpleNamespace(data=callbacks.encode(callbacks.ANSWER, CARD_ID, "yes"))
+
+    results = {}
+    for name, func in (("legacy_chain", lambda: dispatch_legacy(handlers, legacy_call)),
+                       ("router_legacy_payload", lambda: router.dispatch(legacy_call)),
+                       ("router_compact_payload", lambda: router.dispatch(compact_call))):
+        seconds = min(timeit.repeat(func, number=args.number, repeat=5))
+        results[name] = {"ns_per_dispatch": round(seconds / args.number * 1e9, 1)}
+
+    results["payload_bytes"] = {
+        "legacy_answer": len(legacy_call.data),
+        "compact_answer": len(compact_call.data),
+        "legacy_reload": len(f"reload_{PAGE_ID}"),
+        "compact_reload": len(callbacks.encode(callbacks.RELOAD, PAGE_ID)),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
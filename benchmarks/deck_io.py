@@ -0,0 +1,104 @@
+"""
+Deck export and import throughput and peak memory on synthetic cards
+
+    python -m benchmarks.deck_io [--cards 10000 100000] [--chunk-bytes 45000000] [--mongodb-url mongodb://localhost]
+
+Cards are generated lazily, so peak traced memory is what export and import hold themselves
+and should not grow with deck size. With --mongodb-url cards are also imported into
+and exported from a local mongod through User.
+"""
+import argparse
+import contextlib
+import json
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+import decks
+from fakes.notion import FakeNotion
+from fakes.telegram import FakeTelegram
+
+
+def synthetic_cards(count: int):
+    page_id = uuid.uuid4().hex
+    now = datetime.utcnow()
+    for index in range(count):
+        yield {"front_side": f"🧩 Question {index}, with \"quotes\"", "back_side": f"Answer {index}\nsecond line",
+               "page_id": page_id, "block_id": str(uuid.uuid4()), "due_at": now, "ease": 2.5, "interval": index % 30,
+               "learning_step": None if index % 3 else 0, "reps": index % 7, "lapses": index % 2}
+
+
+@contextlib.contextmanager
+def traced(result: dict, name: str):
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result[name] = {"ms": round(elapsed * 1000, 3), "peak_kib": round(peak / 1024)}
+
+
+def bench_files(cards: int, deck_format: str, chunk_bytes: int) -> dict:
+    result = {}
+    chunks = []
+    with traced(result, "export"):
+        for chunk in decks.export_chunks(synthetic_cards(cards), deck_format, chunk_bytes):
+            chunks.append(chunk)
+    result["export"].update(files=len(chunks), bytes=sum(chunk.file.seek(0, 2) for chunk in chunks))
+
+    rows = 0
+    with traced(result, "import_parse"):
+        for chunk in chunks:
+            chunk.file.seek(0)
+            rows += sum(1 for row in decks.read_rows(decks.text_lines(chunk.file)) if row)
+    result["import_parse"]["rows"] = rows
+    for chunk in chunks:
+        chunk.file.close()
+    return result
+
+
+def bench_mongo(mongodb_url: str, cards: int) -> dict:
+    from benchmarks.hot_paths import configure, create_user
+
+    result = {}
+    with FakeNotion() as notion, FakeTelegram() as telegram, contextlib.redirect_stdout(sys.stderr):
+        configure(notion, telegram, mongodb_url)
+        user = create_user(6000)
+        chunks = list(decks.export_chunks(synthetic_cards(cards)))
+        reports = []
+        with traced(result, "import"):
+            for chunk in chunks:
+                reports.append(user.import_deck(decks.text_lines(chunk.file)))
+        result["import"]["inserted"] = sum(report.inserted for report in reports)
+        with traced(result, "export"):
+            exported = 0
+            for chunk in user.export_deck():
+                exported += chunk.cards
+                chunk.file.close()
+        result["export"]["cards"] = exported
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cards", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--chunk-bytes", type=int, default=decks.chunk_bytes())
+    parser.add_argument("--mongodb-url", help="local mongod to import cards into")
+    args = parser.parse_args()
+
+    results = {}
+    for cards in args.cards:
+        results[str(cards)] = {deck_format: bench_files(cards, deck_format, args.chunk_bytes)
+                               for deck_format in decks.FORMATS}
+    if args.mongodb_url:
+        results["mongodb"] = bench_mongo(args.mongodb_url, max(args.cards))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
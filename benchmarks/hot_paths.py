@@ -0,0 +1,262 @@
+"""
+Hot paths of the bot measured against local stand-ins of Notion, MongoDB and Telegram
+
+    python -m benchmarks.hot_paths [--sizes 100 1000 10000] [--mongodb-url mongodb://localhost]
+                                   [--output results.json]
+
+Uses mongomock unless --mongodb-url is given. mongomock checks unique indexes by scanning
+the collection, so initial sync of 10k cards takes minutes there and study_loop is skipped
+as it lacks update pipeline operators, search has no index there either; use a local mongod
+for numbers worth comparing. Measures:
+    parse_flashcards - blocks parsed per second
+    reload_flashcards - full sync of a new page, re-sync of unchanged page and incremental sync
+    database_import - import of a database, its full and incremental re-sync and peak traced memory
+    study_loop - active_study followed by flashcard_answer
+    search - /search queries over a user with --search-cards cards
+    webhook - from webhook POST to the reply received by Telegram
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+from benchmarks import summarize
+from fakes.notion import FakeNotion, bullet
+from fakes.telegram import FakeTelegram
+
+TG_TOKEN = "123456:benchmark"
+
+
+def configure(notion: FakeNotion, telegram: FakeTelegram, mongodb_url: str = None):
+    """
+    Points the bot at stand-ins, has to run before bot modules are imported
+    """
+    os.environ.update({
+        "TG_TOKEN": TG_TOKEN,
+        "TELEGRAM_API_URL": telegram.api_url,
+        "NOTION_API_URL": notion.api_url,
+        "NOTION_RATE_LIMIT": "100000",
+        "NOTION_RATE_BURST": "100000",
+        "TG_RATE_LIMIT": "100000",
+        "TG_CHAT_RATE_LIMIT": "100000",
+        "MONGODB_URL": mongodb_url or "mongodb://localhost",
+        "NOTION_CLIENT_ID": "benchmark",
+        "NOTION_CLIENT_SECRET": "benchmark",
+    })
+    import db
+    if not mongodb_url:
+        import mongomock
+        db._client = mongomock.MongoClient()
+    # Every run starts from an empty database
+    db.get_database().client.drop_database(db.get_database().name)
+    db.ensure_indexes()
+
+
+def create_user(telegram_id: int):
+    from user import User, users
+    users.insert_one({"user_id": telegram_id, "first_name": "Benchmark", "access_token": "fake-token"})
+    return User(users.find_one({"user_id": telegram_id}))
+
+
+def bench_parse(sizes, repeat: int) -> dict:
+    from bson.objectid import ObjectId
+    from notion_api import NotionAPI
+
+    results = {}
+    for size in sizes:
+        blocks = [bullet(str(uuid.uuid4()), f"🧩 Question {index}::Answer {index}" if index % 5 else f"Note {index}")
+                  for index in range(size)]
+        block = NotionAPI("fake-token", ObjectId()).block().retrieve(uuid.uuid4().hex)
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for _ in block.parse_flashcards(blocks):
+                pass
+            timings.append(time.perf_counter() - started)
+        results[str(size)] = {**summarize(timings), "blocks_per_second": round(size / min(timings))}
+    return results
+
+
+def bench_reload(notion: FakeNotion, sizes, repeat: int) -> dict:
+    from user import pages
+
+    results = {}
+    for index, size in enumerate(sizes):
+        user = create_user(1000 + index)
+        page_id = notion.add_page(bullets=size)
+        pages.insert_one({"page_id": page_id, "user": user.id, "title": "Benchmark page"})
+
+        requests = notion.requests
+        started = time.perf_counter()
+        report = user.reload_flashcards(page_id)
+        initial = time.perf_counter() - started
+        result = {"initial_ms": round(initial * 1000, 3), "notion_requests": notion.requests - requests,
+                  "report": report.__dict__}
+
+        for name, incremental in (("unchanged", False), ("incremental", True)):
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                user.reload_flashcards(page_id, incremental=incremental)
+                timings.append(time.perf_counter() - started)
+            result[name] = summarize(timings)
+        results[str(size)] = result
+    return results
+
+
+def bench_database(notion: FakeNotion, rows: int) -> dict:
+    from user import pages
+
+    user = create_user(4000)
+    database_id = notion.add_database(rows=rows)
+    pages.insert_one({"page_id": database_id, "user": user.id, "title": "Benchmark database", "type": "database",
+                      "properties": {"front": "Front", "back": "Back"}})
+
+    result = {"rows": rows}
+    for name, incremental in (("import", False), ("full_resync", False), ("incremental", True)):
+        tracemalloc.start()
+        started = time.perf_counter()
+        report = user.reload_flashcards(database_id, incremental=incremental)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result[name] = {"ms": round(elapsed * 1000, 3), "peak_kib": round(peak / 1024), "report": report.__dict__}
+    return result
+
+
+def bench_study(notion: FakeNotion, cards: int, answers: int) -> dict:
+    from user import pages
+
+    user = create_user(2000)
+    page_id = notion.add_page(bullets=cards, flashcard_ratio=1)
+    pages.insert_one({"page_id": page_id, "user": user.id, "title": "Benchmark page"})
+    user.reload_flashcards(page_id)
+
+    next_card, answer, loop = [], [], []
+    try:
+        for _ in range(answers):
+            started = time.perf_counter()
+            card = user.active_study()
+            shown = time.perf_counter()
+            if card is None:
+                break
+            user.flashcard_answer(str(card["_id"]), "yes")
+            finished = time.perf_counter()
+            next_card.append(shown - started)
+            answer.append(finished - shown)
+            loop.append(finished - started)
+    except Exception as e:
+        # mongomock does not implement every operator of update pipelines
+        return {"skipped": f"{type(e).__name__}: {e}"}
+    return {"active_study": summarize(next_card), "flashcard_answer": summarize(answer), "loop": summarize(loop)}
+
+
+def bench_search(cards: int, repeat: int) -> dict:
+    from datetime import datetime as dt
+    from user import flashcards, card_fields
+    from flashcard_parser import Flashcard
+
+    user = create_user(5000)
+    page_id = uuid.uuid4().hex
+    words = ["photosynthesis", "mitochondria", "capital", "river", "equation", "theorem", "verb", "noun"]
+    started = time.perf_counter()
+    batch = []
+    for index in range(cards):
+        flashcard = Flashcard(page_id, str(uuid.uuid4()), f"🧩 {words[index % 8]} question {index}",
+                              f"{words[(index * 3) % 8]} answer {index}", user.id)
+        batch.append({**card_fields(flashcard, flashcard.content_hash()), "due_at": dt.utcnow()})
+        if len(batch) == 1000:
+            flashcards.insert_many(batch)
+            batch = []
+    if batch:
+        flashcards.insert_many(batch)
+    result = {"cards": cards, "index_ms": round((time.perf_counter() - started) * 1000, 3)}
+
+    for query in ("question 4242", "capital", "photosinthesis", "equat answer", "missing"):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            found = user.search(query)
+            timings.append(time.perf_counter() - started)
+        result[query] = {**summarize(timings), "results": len(found)}
+    return result
+
+
+def bench_webhook(telegram: FakeTelegram, requests: int, chats: int) -> dict:
+    from app import create_app
+
+    app = create_app(background_jobs=False)
+    update_queue = app.extensions["update_queue"]
+    client = app.test_client()
+
+    timings = []
+    try:
+        for index in range(requests):
+            chat_id = 3000 + index % chats
+            update = {
+                "update_id": index + 1,
+                "message": {
+                    "message_id": index + 1,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": {"id": chat_id, "is_bot": False, "first_name": "Benchmark"},
+                    "text": "/start",
+                    "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+                },
+            }
+            replies = len(telegram.calls("sendMessage"))
+            started = time.perf_counter()
+            client.post(f"/{TG_TOKEN}", data=json.dumps(update), content_type="application/json")
+            while len(telegram.calls("sendMessage")) == replies:
+                time.sleep(0.0002)
+            timings.append(time.perf_counter() - started)
+    finally:
+        update_queue.stop()
+    # First update of every chat loads the user from the database
+    return {"all": summarize(timings), "cached_session": summarize(timings[chats:] or timings)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--database-rows", type=int, default=20000)
+    parser.add_argument("--answers", type=int, default=200)
+    parser.add_argument("--search-cards", type=int, help="defaults to 50000, 1000 with mongomock")
+    parser.add_argument("--webhook-requests", type=int, default=200)
+    parser.add_argument("--mongodb-url", help="local mongod, mongomock is used by default")
+    parser.add_argument("--output", help="file to write results to, defaults to stdout")
+    args = parser.parse_args()
+
+    with FakeNotion() as notion, FakeTelegram(global_rate=100000, chat_rate=100000, chat_burst=100000) as telegram:
+        # Handlers print debug output, keep stdout for results
+        with contextlib.redirect_stdout(sys.stderr):
+            configure(notion, telegram, args.mongodb_url)
+            results = {
+                "started_at": datetime.utcnow().isoformat(),
+                "python": platform.python_version(),
+                "mongodb": args.mongodb_url and "mongod" or "mongomock",
+                "parse_flashcards": bench_parse(args.sizes, args.repeat),
+                "reload_flashcards": bench_reload(notion, args.sizes, args.repeat),
+                "database_import": bench_database(notion, args.database_rows),
+                "study_loop": bench_study(notion, max(args.answers, 100), args.answers),
+                "search": bench_search(args.search_cards or (50000 if args.mongodb_url else 1000), args.repeat),
+                "webhook": bench_webhook(telegram, args.webhook_requests, chats=20),
+            }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Parse throughput of FlashcardParser on synthetic blocks of every supported type
+
+    python -m benchmarks.parse_flashcards [--blocks 50000] [--repeat 5]
+"""
+import argparse
+import json
+import random
+import time
+import uuid
+
+from benchmarks import summarize
+from bson.objectid import ObjectId
+from fakes.notion import bullet
+from flashcard_parser import FlashcardParser
+
+
+def rich_text(*segments: str) -> list:
+    return [{"type": "text", "plain_text": segment, "text": {"content": segment}} for segment in segments]
+
+
+def synthetic_blocks(count: int, seed: int = 0) -> list:
+    """
+    Mix of plain notes, list items split into several rich text segments, toggles with children,
+    table rows and malformed cards, in the order walk() could yield them
+    """
+    rng = random.Random(seed)
+    blocks = []
+    page = {"type": "page_id", "page_id": uuid.uuid4().hex}
+    while len(blocks) < count:
+        index = len(blocks)
+        kind = rng.random()
+        if kind < 0.3:
+            blocks.append(bullet(str(uuid.uuid4()), f"Note {index}"))
+        elif kind < 0.6:
+            block = bullet(str(uuid.uuid4()), "")
+            block["bulleted_list_item"]["text"] = rich_text("🧩 ", f"Question {index}", " :: ", f"Answer {index}")
+            blocks.append(block)
+        elif kind < 0.7:
+            block = bullet(str(uuid.uuid4()), f"🧩 Question {index} :: Answer :: with separator")
+            block["type"] = "numbered_list_item"
+            block["numbered_list_item"] = block.pop("bulleted_list_item")
+            blocks.append(block)
+        elif kind < 0.8:
+            toggle_id = str(uuid.uuid4())
+            blocks.append({"id": toggle_id, "type": "toggle", "has_children": True, "parent": page,
+                           "last_edited_time": "2021-06-01T12:00:00.000Z",
+                           "toggle": {"text": rich_text(f"🧩 Toggle {index}")}})
+            for line in range(3):
+                child = bullet(str(uuid.uuid4()), f"Answer line {line}")
+                child["parent"] = {"type": "block_id", "block_id": toggle_id}
+                blocks.append(child)
+        elif kind < 0.95:
+            blocks.append({"id": str(uuid.uuid4()), "type": "table_row", "has_children": False,
+                           "last_edited_time": "2021-06-01T12:00:00.000Z",
+                           "table_row": {"cells": [rich_text(f"🧩 Word {index}"), rich_text(f"Translation {index}")]}})
+        else:
+            blocks.append(bullet(str(uuid.uuid4()), f"🧩 Question {index} without answer"))
+    for block in blocks:
+        block.setdefault("parent", page)
+    return blocks[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blocks", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    blocks = synthetic_blocks(args.blocks)
+    timings = []
+    for _ in range(args.repeat):
+        flashcard_parser = FlashcardParser(ObjectId(), uuid.uuid4().hex, separators=["::"])
+        started = time.perf_counter()
+        cards = sum(1 for _ in flashcard_parser.parse(blocks))
+        timings.append(time.perf_counter() - started)
+
+    print(json.dumps({
+        "blocks": args.blocks,
+        "cards": cards,
+        "diagnostics": len(flashcard_parser.diagnostics),
+        "parse": summarize(timings),
+        "blocks_per_second": round(args.blocks / min(timings)),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
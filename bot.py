@@ -1,41 +1,133 @@
 import telebot
 from telebot.types import BotCommand, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
 from utils import env
-from user import User
+from user import User, PageCursor, PageView, next_due_flashcard, passive_subscriptions
+from cache import TTLCache
+from db import acquire_lease, lease_owner
+from passive import PassiveDelivery, PassiveSettings
+import csv
 import re
 import logging
-from functools import wraps
+import threading
+import time
+from contextlib import contextmanager
 from functools import partial
-
-logger = telebot.logger
-telebot.logger.setLevel(logging.DEBUG)
+from typing import Union
+import requests
+from outbox import Outbox, CALLBACK, INTERACTIVE, BULK
+import callbacks
+import decks
+import metrics
+from callbacks import CallbackRouter, CallbackData
+
+logger = logging.getLogger(__name__)
+# DEBUG logs every request payload, user content included
+telebot.logger.setLevel(env.get("TELEBOT_LOG_LEVEL", "WARNING").upper())
+# Records reach the JSON handler of the root logger, see metrics.configure_logging()
+telebot.logger.removeHandler(telebot.console_output_handler)
 
 telebot.apihelper.ENABLE_MIDDLEWARE = True
-bot = telebot.TeleBot(env['TG_TOKEN'])
+if api_url := env.get("TELEGRAM_API_URL"):
+    # Local stand-in of Bot API, see fakes/telegram.py
+    telebot.apihelper.API_URL = api_url
+
+
+class FlashcardsBot(telebot.TeleBot):
+    """
+    TeleBot that keeps user session per thread, so updates of different chats
+    can be processed in parallel by update workers.
+    Outgoing messages go through the outbox and return Future of the sent message
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._local = threading.local()
+        self.outbox = Outbox(global_rate=float(env.get("TG_RATE_LIMIT", 30)),
+                             chat_rate=float(env.get("TG_CHAT_RATE_LIMIT", 1)),
+                             workers=int(env.get("TG_OUTBOX_WORKERS", 4)))
+
+    def _exec_task(self, task, *args, **kwargs):
+        try:
+            with metrics.handler_latency.time(handler=task.__name__):
+                super()._exec_task(task, *args, **kwargs)
+        except Exception:
+            metrics.handler_errors.inc(handler=task.__name__)
+            raise
+
+    def send_message(self, chat_id, text, *args, priority=INTERACTIVE, **kwargs):
+        return self.outbox.submit(partial(super().send_message, chat_id, text, *args, **kwargs), chat_id, priority)
+
+    def send_photo(self, chat_id, photo, *args, priority=INTERACTIVE, **kwargs):
+        return self.outbox.submit(partial(super().send_photo, chat_id, photo, *args, **kwargs), chat_id, priority)
+
+    def send_document(self, chat_id, data, *args, priority=INTERACTIVE, **kwargs):
+        def send():
+            if hasattr(data, "seek"):
+                # Outbox retries upload the file again
+                data.seek(0)
+            return super(FlashcardsBot, self).send_document(chat_id, data, *args, **kwargs)
 
+        return self.outbox.submit(send, chat_id, priority)
 
+    def edit_message_text(self, text, chat_id=None, message_id=None, *args, **kwargs):
+        return self.outbox.submit(partial(super().edit_message_text, text, chat_id, message_id, *args, **kwargs),
+                                  chat_id, INTERACTIVE, coalesce_key=("text", chat_id, message_id))
 
+    def edit_message_reply_markup(self, chat_id=None, message_id=None, *args, **kwargs):
+        return self.outbox.submit(partial(super().edit_message_reply_markup, chat_id, message_id, *args, **kwargs),
+                                  chat_id, INTERACTIVE, coalesce_key=("markup", chat_id, message_id))
 
-bot.set_my_commands([
+    def answer_callback_query(self, callback_query_id, *args, **kwargs):
+        return self.outbox.submit(partial(super().answer_callback_query, callback_query_id, *args, **kwargs),
+                                  priority=CALLBACK)
+
+    @property
+    def session(self) -> User:
+        return self._local.session
+
+    @session.setter
+    def session(self, user: User):
+        self._local.session = user
+
+
+# Handlers run in the thread that processes the update, see update_queue.UpdateQueue
+bot = FlashcardsBot(env['TG_TOKEN'], threaded=False)
+metrics.Gauge("telegram_outbox_depth", "Telegram requests waiting in outbox", bot.outbox.depth)
+
+COMMANDS = [
     BotCommand("/start", "Shows basic bot info"),
     BotCommand("/add_page", "Adds new page to bot`s library"),
     BotCommand("/reload", "Reloads flashcards from pages you have chosen for"),
     BotCommand("/study", "Starts active learning mode"),
+    BotCommand("/search", "Finds flashcards by words of their sides"),
+    BotCommand("/stats", "Shows your study statistics"),
+    BotCommand("/export", "Sends your flashcards as CSV or Anki notes file"),
+    BotCommand("/import", "Adds flashcards from CSV or Anki notes file"),
     BotCommand("/passive", "Shows passive learning mode settings"),
     BotCommand("/login", "Process login via Notion")
-])
+]
+
+
+def setup_telegram(domain: str):
+    """
+    One-time Telegram setup of a deployment: bot commands and webhook
+    Runs once per deploy, see release.py, not on import or per worker
+    """
+    bot.set_my_commands(COMMANDS)
+    webhook_url = f"{domain}/{env['TG_TOKEN']}"
+    if bot.get_webhook_info().url != webhook_url:
+        bot.set_webhook(webhook_url)
 
 
 # Setting up user sessions
-SESSIONS: dict[str, User] = {}
+# Bounded by size and age, User keeps its model in sync with its own writes
+SESSIONS = TTLCache(maxsize=int(env.get("SESSION_CACHE_SIZE", 10000)),
+                    ttl=float(env.get("SESSION_TTL", 30 * 60)))
+metrics.Gauge("session_cache_size", "User sessions kept in memory", lambda: len(SESSIONS))
+
 
 def get_or_set_session(from_user):
-    user_id = from_user.id
-    try:
-        return SESSIONS[user_id]
-    except KeyError:
-        SESSIONS[user_id] = User.from_telegram_credentials(from_user)
-        return SESSIONS[user_id]
+    return SESSIONS.get_or_set(str(from_user.id), lambda: User.from_telegram_credentials(from_user))
 
 @bot.middleware_handler(update_types=['message', 'callback_query'])
 def set_session(bot_instance, message):
@@ -45,9 +137,39 @@ def set_session(bot_instance, message):
 
 # Message handler
 
+PASSIVE_CADENCE_OPTIONS = (30, 60, 180)
+
+
+def render_passive_settings(settings: PassiveSettings):
+    """
+    Renders passive mode settings message
+    """
+    state = "on ✅" if settings.enabled else "off"
+    quiet_hours = "none" if settings.quiet_start == settings.quiet_end else \
+        f"{settings.quiet_start:02}:00 - {settings.quiet_end:02}:00"
+    text = f"""
+Passive mode is {state}
+Flashcards are sent every {settings.cadence} min
+Quiet hours: {quiet_hours} (UTC{settings.utc_offset:+})
+    """
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton("Turn off" if settings.enabled else "Turn on",
+                                    callback_data=callbacks.encode(callbacks.PASSIVE_TOGGLE)))
+    markup.add(*[InlineKeyboardButton(f"{minutes} min",
+                                      callback_data=callbacks.encode(callbacks.PASSIVE_CADENCE, None, minutes))
+                 for minutes in PASSIVE_CADENCE_OPTIONS])
+    markup.add(InlineKeyboardButton("UTC -1", callback_data=callbacks.encode(callbacks.PASSIVE_OFFSET, None, -1)),
+               InlineKeyboardButton("UTC +1", callback_data=callbacks.encode(callbacks.PASSIVE_OFFSET, None, 1)))
+    for opcode, label in ((callbacks.PASSIVE_QUIET_START, "Quiet from"), (callbacks.PASSIVE_QUIET_END, "Quiet until")):
+        markup.add(InlineKeyboardButton(f"{label} -1h", callback_data=callbacks.encode(opcode, None, -1)),
+                   InlineKeyboardButton(f"{label} +1h", callback_data=callbacks.encode(opcode, None, 1)))
+    return text, markup
+
+
 @bot.message_handler(commands=["passive"])
 def passive(message):
-    bot.reply_to(message, "Passive mode is currently under development")
+    text, markup = render_passive_settings(bot.session.get_passive_settings())
+    bot.reply_to(message, text, reply_markup=markup)
 
 
 @bot.message_handler(commands=["start"])
@@ -59,6 +181,9 @@ We are glad to see you here and ready to help you ^-^
 Use /add_page to add new page for learning
 Use /reload to reload flashcards from page
 Use /study to enter manual study mode
+Use /search to find flashcards
+Use /stats to see your progress
+Use /export and /import to back up or move your flashcards
 Use /passive to change passive learning settings
 
 🌟 Flashcards are reloaded automatically every 3 hours 🌟
@@ -67,8 +192,9 @@ Productive learning bro!
 
 
     """
-    print(bot.session.is_logged_in_notion())
-    if not bot.session.is_logged_in_notion():
+    logged_in = bot.session.is_logged_in_notion()
+    metrics.log_sampled(logger, "start", user=bot.session.id, logged_in=logged_in)
+    if not logged_in:
         text += "It seems that you are not authorized. Please user /login to do it."
 
     bot.reply_to(message, text)
@@ -104,11 +230,11 @@ def login(message):
 
 @bot.message_handler(commands=["add_page"])
 def add_page(message):
-    text = "Send me link to the page:"
+    text = "Send me link to the page or database:"
     markup = ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
     button = KeyboardButton(return_to_main)
     markup.add(button)
-    next_message = bot.reply_to(message, text, reply_markup=markup, parse_mode="Markdown")
+    next_message = bot.reply_to(message, text, reply_markup=markup, parse_mode="Markdown").result()
     bot.register_next_step_handler(next_message, add_page_save)
 
 
@@ -116,7 +242,8 @@ def add_page_save(message):
     """
     Next step handler for add_page function
     """
-    match = re.search(r"^https://www.notion.so/.+-(.{32})$", message.text)
+    # Page links end with the title and page id, database links may be followed by view id
+    match = re.search(r"^https://www.notion.so/(?:.+[-/])?([0-9a-f]{32})(?:\?v=[0-9a-f]{32})?$", message.text)
 
     # Reserved message handler does not include next step handlers
     # Doing it manually
@@ -130,96 +257,150 @@ def add_page_save(message):
     page_id = match.groups()[0]
     result = bot.session.add_page(page_id)
     if not result:
-        text = "Page already exists or max page limit (5) exceeded ⛔️"
+        text = f"Page already exists or max page limit ({env.get('MAX_PAGES', 50)}) exceeded ⛔️"
     else:
-        page_title = bot.session.notion.page().retrieve(page_id).get_title()
+        page_title = bot.session.get_page(page_id)["title"]
         text = f"Page \"{page_title}\" successfully added and flashcards reloaded✅"
 
     bot.send_message(message.from_user.id, text)
 
 
-def render_pages_markup(pages):
+def render_pages_markup(view: PageView):
     """
-    Renders pages keyboard
+    Renders pages keyboard, navigation buttons keep cursors of neighbour pages
     """
     markup = InlineKeyboardMarkup()
-    for item in pages:
-        title_button = InlineKeyboardButton(f"{item['title']}",
-                                            callback_data=f"title_{item['page_id']}")
-        reload_button = InlineKeyboardButton("♻️️", callback_data=f"reload_{item['page_id']}")
-        delete_button = InlineKeyboardButton("⛔️", callback_data=f"delete_{item['page_id']}")
+    for item in view.pages:
+        title = f"{item['icon']} {item['title']}" if item.get("icon") else f"{item['title']}"
+        title_button = InlineKeyboardButton(title,
+                                            callback_data=callbacks.encode(callbacks.TITLE, item['page_id']))
+        delete_button = InlineKeyboardButton("⛔️", callback_data=callbacks.encode(callbacks.DELETE, item['page_id']))
+        if item.get("type") == "import":
+            # Imported cards are not synced with Notion
+            markup.add(title_button, delete_button)
+            continue
+        reload_button = InlineKeyboardButton("♻️️", callback_data=callbacks.encode(callbacks.RELOAD, item['page_id']))
         markup.add(title_button, reload_button, delete_button)
 
+    navigation = []
+    if view.previous:
+        navigation.append(InlineKeyboardButton("◀️", callback_data=callbacks.encode(
+            callbacks.PAGES, view.previous.page_object_id, "p", view.previous.updated_at)))
+    if view.next:
+        navigation.append(InlineKeyboardButton("▶️", callback_data=callbacks.encode(
+            callbacks.PAGES, view.next.page_object_id, "n", view.next.updated_at)))
+    if navigation:
+        markup.add(*navigation)
     return markup
 
 
+def shown_page_cursor(markup) -> Union[PageCursor, None]:
+    """
+    Cursor of the first page shown by pages keyboard, None if it shows the first keyboard page
+    """
+    for row in getattr(markup, "keyboard", None) or ():
+        for button in row:
+            try:
+                data = router.decode(button.callback_data or "")
+            except callbacks.CallbackDataError:
+                continue
+            if data.opcode == callbacks.PAGES and data.args[0] == "p":
+                return PageCursor(int(data.args[1]), data.item_id)
+    return None
+
+
 @bot.message_handler(commands=["reload"])
 def reload(message):
-    pages = bot.session.get_pages(1)
-    if pages.count() < 1:
+    view = bot.session.get_pages()
+    if not view.pages:
         text = "No pages are added"
     else:
-        text = "Choose which page to reload"
+        text = f"Choose which page to reload, pages added: {view.count}"
 
-    markup = render_pages_markup(pages)
+    markup = render_pages_markup(view)
     bot.reply_to(message, text, reply_markup=markup)
 
 
-def get_call_prefix(call):
-    """
-    Gets callback_query prefix
-    All callback queries are written in format prefix_value for ex. reload_pageid
-    """
-    return call.data.split("_")[0]
+# All callback queries are decoded once and dispatched by opcode, see callbacks.py
+router = CallbackRouter()
 
 
-def get_call_suffix(func):
-    @wraps(func)
-    def wrapper(*args):
-        call, *_ = args
-        suffix = call.data.split("_")[-1]
-        return func(call, suffix)
+@bot.callback_query_handler(func=lambda call: True)
+def route_callback(call):
+    if not router.dispatch(call):
+        # Stops loading indicator of buttons without action
+        bot.answer_callback_query(call.id)
 
-    return wrapper
 
+@router.route(callbacks.TITLE, legacy_prefix="title")
+def title_callback(call, data: CallbackData):
+    bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda call: get_call_prefix(call) == "reload")
-@get_call_suffix
-def reload_callback(call, suffix):
-    result = bot.session.reload_flashcards(suffix)
+
+@router.route(callbacks.RELOAD, legacy_prefix="reload")
+def reload_callback(call, data: CallbackData):
+    result = bot.session.reload_flashcards(data.item_id)
     if not result:
         text = "Error! Page might not exist"
+    elif result.page_skipped:
+        text = "Imported cards are not synced with Notion"
     else:
-        text = "Flashcards successfully updated!"
+        text = f"Flashcards successfully updated! Changed: {result.changed}, checked blocks: {result.fetched}"
+        if result.malformed:
+            text += f", malformed cards: {result.malformed}"
     bot.answer_callback_query(call.id, text)
 
 
-@bot.callback_query_handler(func=lambda call: get_call_prefix(call) == "delete")
-@get_call_suffix
-def delete_callback(call, suffix):
-    bot.session.delete_page(suffix)
+@router.route(callbacks.DELETE, legacy_prefix="delete")
+def delete_callback(call, data: CallbackData):
+    bot.session.delete_page(data.item_id)
     text = "Page deleted"
     bot.answer_callback_query(call.id, text)
-    pages = bot.session.get_pages(1)
-    markup = render_pages_markup(pages)
+    # Keyboard stays on the page it showed
+    cursor = shown_page_cursor(call.message.reply_markup)
+    view = bot.session.get_pages(cursor, inclusive=True) if cursor else bot.session.get_pages()
+    markup = render_pages_markup(view)
     bot.edit_message_reply_markup(call.message.chat.id, call.message.id, reply_markup=markup)
 
 
-def render_flashcard_message(flashcard, front_side=True, active_study=True):
+@router.route(callbacks.PAGES)
+def pages_callback(call, data: CallbackData):
+    direction, updated_at = data.args
+    view = bot.session.get_pages(PageCursor(int(updated_at), data.item_id), older=direction == "n")
+    bot.answer_callback_query(call.id)
+    bot.edit_message_reply_markup(call.message.chat.id, call.message.id, reply_markup=render_pages_markup(view))
+
+
+# Flip button argument of cards shown without answer buttons
+BROWSE = "b"
+
+
+def render_flashcard_message(flashcard, front_side=True, active_study=True, rendered_at: int = None,
+                             answers=True):
+    """
+    :param rendered_at: unix time the card was first shown, kept in buttons to measure time to answer
+    :param answers: False renders only the flip button, e.g. for search hits which may be not due
+    """
     markup = InlineKeyboardMarkup()
-    flashcard_id = flashcard['_id']
+    flashcard_id = str(flashcard['_id'])
+    rendered_at = rendered_at or int(time.time())
     text = flashcard["front_side"] if front_side else flashcard["back_side"]
     flashcard_position = "front" if front_side else "back"
-    flashcard_text_btn = InlineKeyboardButton("*flip*",
-                                              callback_data=f"flashcard-flip_{flashcard_position}_{flashcard_id}")
+    flip_args = (flashcard_position, rendered_at) if answers else (flashcard_position, rendered_at, BROWSE)
+    flashcard_text_btn = InlineKeyboardButton("*flip*", callback_data=callbacks.encode(
+        callbacks.FLIP, flashcard_id, *flip_args))
 
     markup.add(flashcard_text_btn, row_width=10)
-    yes_btn = InlineKeyboardButton("✅", callback_data=f"flashcard-answer_yes_{flashcard_id}")
-    no_btn = InlineKeyboardButton("❌", callback_data=f"flashcard-answer_no_{flashcard_id}")
+    if not answers:
+        return text, markup
+    yes_btn = InlineKeyboardButton("✅", callback_data=callbacks.encode(callbacks.ANSWER, flashcard_id, "yes", rendered_at))
+    no_btn = InlineKeyboardButton("❌", callback_data=callbacks.encode(callbacks.ANSWER, flashcard_id, "no", rendered_at))
 
     if not active_study:
-        easy_btn = InlineKeyboardButton("✨", callback_data=f"flashcard-answer_ez_{flashcard_id}")
-        hard_btn = InlineKeyboardButton("🏋️‍♂️", callback_data=f"flashcard-answer_hard_{flashcard_id}")
+        easy_btn = InlineKeyboardButton("✨", callback_data=callbacks.encode(
+            callbacks.ANSWER, flashcard_id, "ez", rendered_at))
+        hard_btn = InlineKeyboardButton("🏋️‍♂️", callback_data=callbacks.encode(
+            callbacks.ANSWER, flashcard_id, "hard", rendered_at))
 
         markup.add(easy_btn, hard_btn, no_btn)
         markup.add(yes_btn)
@@ -229,6 +410,98 @@ def render_flashcard_message(flashcard, front_side=True, active_study=True):
     return text, markup
 
 
+@bot.message_handler(commands=["search"])
+def search_flashcards(message):
+    query = message.text.partition(" ")[2].strip()
+    if not query:
+        bot.reply_to(message, "Send words to look for after the command, e.g. /search capital")
+        return
+    found = bot.session.search(query, limit=int(env.get("SEARCH_RESULTS", 5)))
+    if not found:
+        bot.reply_to(message, "Nothing found 🤷")
+        return
+    for flashcard in found:
+        # Answers of cards which are not due are ignored, so hits can only be flipped
+        text, markup = render_flashcard_message(flashcard, answers=False)
+        bot.send_message(message.from_user.id, text, reply_markup=markup)
+
+
+def format_retention(retention) -> str:
+    return "—" if retention is None else f"{retention:.0%}"
+
+
+@bot.message_handler(commands=["stats"])
+def show_stats(message):
+    stats = bot.session.get_study_stats()
+    text = f"""
+📚 Cards: {stats.cards}
+⏰ Due today: {stats.due_today}
+🎓 Learned: {stats.learned}
+🔥 Streak: {stats.streak} days
+🎯 Retention: {format_retention(stats.retention_7)} last 7 days, {format_retention(stats.retention_30)} last 30 days
+    """
+    bot.reply_to(message, text)
+
+
+@bot.message_handler(commands=["export"])
+def export_deck(message):
+    deck_format = message.text.partition(" ")[2].strip().lower() or decks.CSV
+    if deck_format not in decks.FORMATS:
+        bot.reply_to(message, "Choose format: /export csv or /export anki")
+        return
+    exported = 0
+    for chunk in bot.session.export_deck(deck_format):
+        sent = bot.send_document(message.from_user.id, chunk.file, caption=f"{chunk.cards} flashcards",
+                                 visible_file_name=chunk.name, priority=BULK)
+        sent.add_done_callback(lambda _, file=chunk.file: file.close())
+        exported += chunk.cards
+    if not exported:
+        bot.reply_to(message, "No flashcards to export")
+
+
+@bot.message_handler(commands=["import"])
+def import_deck(message):
+    text = "Send me CSV file made by /export or notes exported from Anki as plain text:"
+    markup = ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
+    markup.add(KeyboardButton(return_to_main))
+    next_message = bot.reply_to(message, text, reply_markup=markup).result()
+    bot.register_next_step_handler(next_message, import_deck_save)
+
+
+@contextmanager
+def open_document(file_id: str):
+    """
+    Streams file uploaded to Telegram, bots can download files up to 20 MB
+    """
+    url = telebot.apihelper.get_file_url(bot.token, file_id)
+    with requests.get(url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        yield response.raw
+
+
+def import_deck_save(message):
+    """
+    Next step handler for import_deck function
+    """
+    if action := RESERVED_KEYWORDS.get(message.text, None):
+        return action(message)
+    if not message.document:
+        bot.send_message(message.from_user.id, "It is not a file")
+        return import_deck(message)
+
+    try:
+        with open_document(message.document.file_id) as file:
+            report = bot.session.import_deck(decks.text_lines(file))
+    except (UnicodeDecodeError, csv.Error):
+        bot.send_message(message.from_user.id, "File has to be UTF-8 text in CSV or Anki notes format ⛔️")
+        return
+    text = f"Flashcards imported ✅ New: {report.inserted}, updated: {report.updated}"
+    if report.malformed:
+        text += f", rows without both sides: {report.malformed}"
+    bot.send_message(message.from_user.id, text)
+
+
 @bot.message_handler(commands=["study"])
 def study_mode(message):
     flashcard = bot.session.active_study()
@@ -249,20 +522,31 @@ def study_mode_start(message):
     bot.send_message(message.from_user.id, text, reply_markup=markup)
 
 
-@bot.callback_query_handler(func=lambda call: get_call_prefix(call) == "flashcard-flip")
-@get_call_suffix
-def flip_callback(call, suffix):
-    flashcard = bot.session.get_flashcard_by_id(suffix)
-    new_front_side = False if call.data.split("_")[1] == "front" else True
-    text, markup = render_flashcard_message(flashcard, front_side=new_front_side)
+def button_rendered_at(data: CallbackData, index: int) -> Union[int, None]:
+    """
+    Render time kept in flashcard buttons, buttons sent before it was added have none
+    """
+    try:
+        return int(data.args[index])
+    except (IndexError, ValueError):
+        return None
+
+
+@router.route(callbacks.FLIP, legacy_prefix="flashcard-flip")
+def flip_callback(call, data: CallbackData):
+    flashcard = bot.session.get_flashcard_by_id(data.item_id)
+    new_front_side = False if data.args[0] == "front" else True
+    answers = BROWSE not in data.args[2:]
+    text, markup = render_flashcard_message(flashcard, front_side=new_front_side, rendered_at=button_rendered_at(data, 1),
+                                            answers=answers)
     bot.edit_message_text(text, call.message.chat.id, call.message.id, reply_markup=markup)
 
 
-@bot.callback_query_handler(func=lambda call: get_call_prefix(call) == "flashcard-answer")
-@get_call_suffix
-def flashcard_answers(call, suffix):
-    level_of_answer = call.data.split("_")[1]
-    bot.session.flashcard_answer(suffix, level_of_answer)
+@router.route(callbacks.ANSWER, legacy_prefix="flashcard-answer")
+def flashcard_answers(call, data: CallbackData):
+    level_of_answer = data.args[0]
+    shown_at = button_rendered_at(data, 1)
+    bot.session.submit_answer(data.item_id, level_of_answer, time.time() - shown_at if shown_at else None)
 
     text = "Answer saved ^-^"
 
@@ -277,13 +561,45 @@ def flashcard_answers(call, suffix):
 
 
 
-# TODO: fix bug that not transfers cards from study to passive mode
-
-# TODO: passive learning mode
-# TODO: passive learning mode settings
+def send_passive_flashcard(chat_id, flashcard):
+    text, markup = render_flashcard_message(flashcard, active_study=False)
+    bot.send_message(chat_id, text, reply_markup=markup, priority=BULK)
+
+
+passive_delivery = PassiveDelivery(
+    send_passive_flashcard,
+    next_due_flashcard,
+    settings_source=passive_subscriptions,
+    lease=lambda: acquire_lease("passive-delivery", lease_owner(), 120, renew=True)
+)
+
+
+@router.route(callbacks.PASSIVE_TOGGLE, legacy_prefix="passive-toggle", legacy_has_id=False)
+@router.route(callbacks.PASSIVE_CADENCE, legacy_prefix="passive-cadence", legacy_has_id=False)
+@router.route(callbacks.PASSIVE_OFFSET, legacy_prefix="passive-offset", legacy_has_id=False)
+@router.route(callbacks.PASSIVE_QUIET_START)
+@router.route(callbacks.PASSIVE_QUIET_END)
+def passive_callback(call, data: CallbackData):
+    settings = bot.session.get_passive_settings()
+    if data.opcode == callbacks.PASSIVE_TOGGLE:
+        settings.enabled = not settings.enabled
+    elif data.opcode == callbacks.PASSIVE_CADENCE:
+        settings.cadence = int(data.args[0])
+    elif data.opcode == callbacks.PASSIVE_OFFSET:
+        settings.utc_offset = max(-12, min(14, settings.utc_offset + int(data.args[0])))
+    elif data.opcode == callbacks.PASSIVE_QUIET_START:
+        # Equal start and end turn quiet hours off
+        settings.quiet_start = (settings.quiet_start + int(data.args[0])) % 24
+    elif data.opcode == callbacks.PASSIVE_QUIET_END:
+        settings.quiet_end = (settings.quiet_end + int(data.args[0])) % 24
+    bot.session.set_passive_settings(settings)
+    passive_delivery.subscribe(bot.session.id, bot.session.telegram_user_id, settings)
+
+    bot.answer_callback_query(call.id, "Settings saved")
+    text, markup = render_passive_settings(settings)
+    bot.edit_message_text(text, call.message.chat.id, call.message.id, reply_markup=markup)
 
-# TODO: deploy on the server
 
-# spaced repetition 2.5 - 0.2
+# TODO: fix bug that not transfers cards from study to passive mode
 
-# Learning phase 1 min -> Again -> 1 min -> Good -> 10 min -> Good -> Graduated
+# TODO: deploy on the server
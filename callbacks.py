@@ -0,0 +1,122 @@
+"""
+Compact callback payloads and table based callback routing
+
+Payload is "~" followed by urlsafe base64 of
+    version (1 byte) | opcode (1 byte) | id length (1 byte) | id | args joined by "_"
+Ids are hex strings (ObjectId, Notion ids) and take half of their length in bytes.
+Old payloads in "prefix_args_id" format are still decoded during rollout.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from functools import lru_cache
+from typing import Callable, Dict, NamedTuple, Tuple, Union
+import metrics
+
+MARKER = "~"
+VERSION = 1
+
+# Opcodes
+RELOAD = 1
+DELETE = 2
+FLIP = 3
+ANSWER = 4
+PASSIVE_TOGGLE = 5
+PASSIVE_CADENCE = 6
+PASSIVE_OFFSET = 7
+TITLE = 8
+PAGES = 9
+PASSIVE_QUIET_START = 10
+PASSIVE_QUIET_END = 11
+
+
+class CallbackDataError(ValueError):
+    """
+    Raised on payloads that can not be decoded
+    """
+
+
+class CallbackData(NamedTuple):
+    opcode: int
+    item_id: Union[str, None]
+    args: Tuple[str, ...] = ()
+
+
+def encode(opcode: int, item_id: str = None, *args) -> str:
+    """
+    Builds compact callback payload
+    :param item_id: hex id of the item callback refers to
+    """
+    id_bytes = bytes.fromhex(item_id) if item_id else b""
+    payload = bytes((VERSION, opcode, len(id_bytes))) + id_bytes + "_".join(map(str, args)).encode("utf-8")
+    return MARKER + urlsafe_b64encode(payload).decode("ascii").rstrip("=")
+
+
+@lru_cache(maxsize=4096)
+def decode_compact(data: str) -> CallbackData:
+    """
+    Decodes compact payload, cached since the same buttons are pressed over and over
+    """
+    try:
+        encoded = data[len(MARKER):]
+        payload = urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+        version, opcode, id_length = payload[0], payload[1], payload[2]
+        args = payload[3 + id_length:].decode("utf-8")
+    except (ValueError, IndexError) as e:
+        raise CallbackDataError(data) from e
+    if version != VERSION:
+        raise CallbackDataError(f"Unsupported callback payload version {version}")
+
+    item_id = payload[3:3 + id_length].hex() if id_length else None
+    return CallbackData(opcode, item_id, tuple(args.split("_")) if args else ())
+
+
+class CallbackRouter:
+    """
+    Decodes callback payload once and dispatches it through opcode table
+    """
+
+    def __init__(self):
+        self._handlers: Dict[int, Callable] = {}
+        # legacy prefix -> (opcode, whether last part of payload is item id)
+        self._legacy: Dict[str, Tuple[int, bool]] = {}
+
+    def route(self, opcode: int, legacy_prefix: str = None, legacy_has_id: bool = True):
+        """
+        Registers handler called as handler(call, data)
+        :param legacy_prefix: prefix of old "prefix_args_id" payloads of this handler
+        """
+        def decorator(func):
+            self._handlers[opcode] = func
+            if legacy_prefix:
+                self._legacy[legacy_prefix] = (opcode, legacy_has_id)
+            return func
+
+        return decorator
+
+    def decode(self, data: str) -> CallbackData:
+        if data.startswith(MARKER):
+            return decode_compact(data)
+
+        prefix, *parts = data.split("_")
+        try:
+            opcode, has_id = self._legacy[prefix]
+        except KeyError:
+            raise CallbackDataError(data)
+        if has_id and parts:
+            return CallbackData(opcode, parts[-1], tuple(parts[:-1]))
+        return CallbackData(opcode, None, tuple(parts))
+
+    def dispatch(self, call) -> bool:
+        """
+        Calls handler of callback query
+        :return: False if payload is unknown or has no handler
+        """
+        try:
+            data = self.decode(call.data)
+        except CallbackDataError:
+            return False
+        handler = self._handlers.get(data.opcode)
+        if handler is None:
+            return False
+        with metrics.handler_latency.time(handler=handler.__name__):
+            handler(call, data)
+        return True
@@ -1,11 +1,146 @@
-from pymongo import MongoClient
+import os
+import socket
+from datetime import datetime, timedelta
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
 from utils import env
+from metrics import MongoListener
+
+_client = None
+_client_pid = None
 
 
 def get_database():
     """
     Setups MONGODB connection
+    Client is created on first use and shared by the process, it manages its own connection pool.
+    Client is recreated after fork, pymongo clients are not fork-safe
     :return: MongoClient
     """
-    client = MongoClient(env['MONGODB_URL'])
-    return client['notion-bot']
+    global _client, _client_pid
+    if _client is None or _client_pid not in (None, os.getpid()):
+        _client = MongoClient(env['MONGODB_URL'], event_listeners=[MongoListener()])
+        _client_pid = os.getpid()
+    return _client['notion-bot']
+
+
+class LazyCollection:
+    """
+    Collection resolved on first use, so importing modules does not connect to MongoDB
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(get_database()[self._name], attr)
+
+
+def lease_owner() -> str:
+    """
+    Identifies current process in lease documents
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def acquire_lease(lock_id: str, owner: str, seconds: float, renew: bool = False) -> bool:
+    """
+    Takes lease document in "locks" collection, so only one instance does the job
+    :param renew: allow current owner to extend lease before it expires
+    :return: True if lease is held by owner now
+    """
+    now = datetime.utcnow()
+    lock_filter = {"_id": lock_id, "expires_at": {"$lte": now}}
+    if renew:
+        lock_filter = {"_id": lock_id, "$or": [{"expires_at": {"$lte": now}}, {"owner": owner}]}
+    try:
+        get_database()["locks"].find_one_and_update(
+            lock_filter,
+            {"$set": {"owner": owner, "acquired_at": now, "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Lease is held by another instance and has not expired yet
+        return False
+    return True
+
+
+def _dedupe_flashcards(database: Database):
+    """
+    Removes duplicated flashcards left by unscoped writes of older versions,
+    so unique index on (user, page_id, block_id) can be built
+    """
+    duplicates = database["flashcards"].aggregate([
+        {"$group": {
+            "_id": {"user": "$user", "page_id": "$page_id", "block_id": "$block_id"},
+            "ids": {"$push": "$_id"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    for duplicate in duplicates:
+        database["flashcards"].delete_many({"_id": {"$in": duplicate["ids"][1:]}})
+
+
+def ensure_indexes(database: Database = None):
+    """
+    Creates indexes used by bot queries
+    Safe to run on every startup, existing indexes are left untouched
+    """
+    database = database if database is not None else get_database()
+    flashcards = database["flashcards"]
+    if "user_page_block" not in flashcards.index_information():
+        _dedupe_flashcards(database)
+    flashcards.create_index([("user", ASCENDING), ("page_id", ASCENDING), ("block_id", ASCENDING)],
+                            unique=True, name="user_page_block")
+    flashcards.create_index([("user", ASCENDING), ("due_at", ASCENDING)], name="user_due_at")
+    flashcards.create_index([("user", ASCENDING), ("search_keys", ASCENDING)], name="user_search_keys")
+    # Cards created before spaced repetition scheduler are due right away
+    flashcards.update_many({"due_at": {"$exists": False}}, {"$set": {"due_at": datetime.utcnow()}})
+    # active_coef counter was replaced by due_at, its index only slows writes down
+    if "user_active_coef" in flashcards.index_information():
+        flashcards.drop_index("user_active_coef")
+
+    database["users"].create_index("user_id", unique=True, name="user_id")
+    # Cards in learning steps were listed in users, nothing read the list
+    database["users"].update_many({"active_cards": {"$exists": True}}, {"$unset": {"active_cards": ""}})
+    database["users"].create_index("passive.enabled", sparse=True, name="passive_enabled")
+    database["users"].create_index("passive.updated_at", sparse=True, name="passive_updated_at")
+
+    database["reviews"].create_index([("card", ASCENDING), ("answered_at", ASCENDING)], name="card_answered_at")
+    database["reviews"].create_index([("user", ASCENDING), ("answered_at", ASCENDING)], name="user_answered_at")
+    # Replay of one user reads reviews in (card, answered_at) order
+    database["reviews"].create_index([("user", ASCENDING), ("card", ASCENDING), ("answered_at", ASCENDING)],
+                                     name="user_card_answered_at")
+
+    database["pages"].create_index([("user", ASCENDING), ("page_id", ASCENDING)], unique=True, name="user_page")
+    # Library keyboard pages through (updatedAt, _id) ranges, pages which were never synced go last
+    database["pages"].update_many({"updatedAt": {"$exists": False}}, {"$set": {"updatedAt": datetime(1970, 1, 1)}})
+    database["pages"].create_index([("user", ASCENDING), ("updatedAt", DESCENDING), ("_id", DESCENDING)],
+                                   name="user_updated_id")
+    if "user_updated" in database["pages"].index_information():
+        database["pages"].drop_index("user_updated")
+
+
+def find_stages(plan, stages) -> list:
+    """
+    Collects stages of explain() output with one of given names
+    """
+    found = []
+    if isinstance(plan, dict):
+        if plan.get("stage") in stages:
+            found.append(plan)
+        for value in plan.values():
+            found.extend(find_stages(value, stages))
+    elif isinstance(plan, list):
+        for item in plan:
+            found.extend(find_stages(item, stages))
+    return found
+
+
+def find_collscans(plan) -> list:
+    """
+    Collects collection scan stages of explain() output
+    """
+    return find_stages(plan, {"COLLSCAN"})
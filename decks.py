@@ -0,0 +1,169 @@
+"""
+Streaming export and import of flashcard decks
+
+Export writes cards read through a cursor into temporary files of at most DECK_CHUNK_BYTES,
+bots can upload documents up to 50 MB. Import reads uploaded files row by row, so memory
+stays flat regardless of deck size.
+
+Formats:
+    csv - header row, sides, card ids and scheduling state, imports restore cards as they were
+    anki - notes in Anki plain text format (File > Import), sides only
+"""
+import csv
+import io
+import tempfile
+from itertools import chain
+from dataclasses import dataclass
+from datetime import datetime
+from typing import IO, Iterable, Iterator, NamedTuple, Union
+import srs
+from utils import env
+
+CSV = "csv"
+ANKI = "anki"
+FORMATS = {CSV: "csv", ANKI: "txt"}
+CSV_COLUMNS = ["front", "back", "page_id", "block_id", "due_at", "ease", "interval", "learning_step", "reps",
+               "lapses"]
+ANKI_HEADER = "#separator:tab\n#html:false\n#columns:Front\tBack\n"
+ANKI_SEPARATORS = {"tab": "\t", "comma": ",", "semicolon": ";", "pipe": "|", "space": " "}
+# Projection of cards read by export
+EXPORT_FIELDS = {"front_side": 1, "back_side": 1, "page_id": 1, "block_id": 1, "due_at": 1, "ease": 1,
+                 "interval": 1, "learning_step": 1, "reps": 1, "lapses": 1}
+
+
+def chunk_bytes() -> int:
+    return int(env.get("DECK_CHUNK_BYTES", 45_000_000))
+
+
+def batch_size() -> int:
+    return int(env.get("DECK_BATCH", 1000))
+
+
+class ExportChunk(NamedTuple):
+    name: str
+    file: IO[bytes]
+    cards: int
+
+
+class DeckRow(NamedTuple):
+    front_side: str
+    back_side: str
+    page_id: Union[str, None] = None
+    block_id: Union[str, None] = None
+    state: Union[srs.CardState, None] = None
+
+
+@dataclass
+class ImportReport:
+    """
+    Result of deck import
+    malformed - rows without both sides
+    """
+    rows: int = 0
+    inserted: int = 0
+    updated: int = 0
+    malformed: int = 0
+
+
+def _csv_row(card: dict) -> list:
+    state = srs.CardState.from_document(card)
+    return [card.get("front_side", ""), card.get("back_side", ""), card.get("page_id", ""), card.get("block_id", ""),
+            state.due_at.isoformat() if state.due_at else "", state.ease, state.interval,
+            "" if state.step is None else state.step, state.reps, state.lapses]
+
+
+def export_chunks(cards: Iterable[dict], deck_format: str = CSV, max_bytes: int = None) -> Iterator[ExportChunk]:
+    """
+    Writes cards into temporary files, every file is a complete deck with its own header
+    Files are rewound and have to be closed by the caller
+    """
+    max_bytes = max_bytes or chunk_bytes()
+    extension = FORMATS[deck_format]
+    header = ",".join(CSV_COLUMNS) + "\r\n" if deck_format == CSV else ANKI_HEADER
+    header = header.encode("utf-8")
+    line = io.StringIO()
+    writer = csv.writer(line) if deck_format == CSV else csv.writer(line, delimiter="\t", lineterminator="\n")
+
+    file, size, count, number = None, 0, 0, 0
+    for card in cards:
+        writer.writerow(_csv_row(card) if deck_format == CSV else [card.get("front_side", ""),
+                                                                   card.get("back_side", "")])
+        data = line.getvalue().encode("utf-8")
+        line.seek(0)
+        line.truncate()
+        if file is not None and size + len(data) > max_bytes:
+            file.seek(0)
+            yield ExportChunk(f"flashcards-{number}.{extension}", file, count)
+            file = None
+        if file is None:
+            number += 1
+            file = tempfile.TemporaryFile()
+            file.write(header)
+            size, count = len(header), 0
+        file.write(data)
+        size += len(data)
+        count += 1
+    if file is not None:
+        file.seek(0)
+        yield ExportChunk(f"flashcards-{number}.{extension}", file, count)
+
+
+def _parse_state(row: dict) -> Union[srs.CardState, None]:
+    if not row.get("due_at"):
+        return None
+    try:
+        return srs.CardState(
+            ease=float(row.get("ease") or srs.DEFAULT_EASE),
+            interval=float(row.get("interval") or 0),
+            step=int(row["learning_step"]) if row.get("learning_step") else None,
+            reps=int(row.get("reps") or 0),
+            lapses=int(row.get("lapses") or 0),
+            due_at=datetime.fromisoformat(row["due_at"]),
+        )
+    except ValueError:
+        return None
+
+
+def read_rows(lines: Iterable[str]) -> Iterator[Union[DeckRow, None]]:
+    """
+    Parses exported CSV or Anki notes text line by line
+    CSV files are recognized by their header, anything else is read as Anki notes,
+    tab separated unless "#separator:" says otherwise
+    :param lines: text read with newline="", see text_lines()
+    :return: rows, None for rows without both sides
+    """
+    lines = iter(lines)
+    line = next(lines, "")
+    if line.strip().lower().startswith("front,back"):
+        header = [column.strip().lower() for column in next(csv.reader([line]))]
+        for values in csv.reader(lines):
+            if not any(values):
+                continue
+            row = dict(zip(header, values))
+            if not row.get("front", "").strip() or not row.get("back", "").strip():
+                yield None
+                continue
+            yield DeckRow(row["front"], row["back"], row.get("page_id") or None, row.get("block_id") or None,
+                          _parse_state(row))
+        return
+
+    delimiter = "\t"
+    while line.startswith("#"):
+        if line.startswith("#separator:"):
+            separator = line.split(":", 1)[1].strip().lower()
+            delimiter = ANKI_SEPARATORS.get(separator, separator[:1] or "\t")
+        line = next(lines, "")
+    for values in csv.reader(chain([line], lines), delimiter=delimiter):
+        if not any(values):
+            continue
+        if len(values) < 2 or not values[0].strip() or not values[1].strip():
+            yield None
+            continue
+        yield DeckRow(values[0], values[1])
+
+
+def text_lines(file: IO[bytes]) -> IO[str]:
+    """
+    Decodes uploaded file as it is read
+    """
+    return io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
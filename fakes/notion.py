@@ -0,0 +1,189 @@
+"""
+Local stand-in for Notion API serving synthetic pages of flashcard bullets
+
+    with FakeNotion() as notion:
+        page_id = notion.add_page(bullets=1000)
+        NotionAPI.api_url = notion.api_url
+        ...
+
+Block children and database rows are paginated with start_cursor/next_cursor like the real API.
+"""
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+EDITED_TIME = "2021-06-01T12:00:00.000Z"
+
+
+def rich_text(text: str) -> List[dict]:
+    return [{"type": "text", "plain_text": text, "text": {"content": text}}]
+
+
+def bullet(block_id: str, text: str, last_edited_time: str = EDITED_TIME) -> dict:
+    return {
+        "object": "block",
+        "id": block_id,
+        "type": "bulleted_list_item",
+        "has_children": False,
+        "last_edited_time": last_edited_time,
+        "bulleted_list_item": {"text": rich_text(text)},
+    }
+
+
+class FakeNotion:
+
+    def __init__(self, latency: float = 0, max_page_size: int = 100):
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.requests = 0
+        self._pages: Dict[str, dict] = {}
+        self._children: Dict[str, List[dict]] = {}
+        self._databases: Dict[str, dict] = {}
+        self._rows: Dict[str, List[dict]] = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def add_page(self, bullets: int = 100, flashcard_ratio: float = 0.8, title: str = "Benchmark page") -> str:
+        """
+        Adds page with bullets, flashcard_ratio of them are flashcards
+        :return: page id in the format used in Notion links
+        """
+        page_id = uuid.uuid4().hex
+        flashcards = int(bullets * flashcard_ratio)
+        children = []
+        for index in range(bullets):
+            text = f"🧩 Question {index}::Answer {index}" if index < flashcards else f"Note {index}"
+            children.append(bullet(str(uuid.uuid4()), text))
+        with self._lock:
+            self._pages[page_id] = {
+                "object": "page",
+                "id": page_id,
+                "last_edited_time": EDITED_TIME,
+                "properties": {"title": {"title": [{"text": {"content": title}, "plain_text": title}]}},
+            }
+            self._children[page_id] = children
+        return page_id
+
+    def add_database(self, rows: int = 100, title: str = "Benchmark database") -> str:
+        """
+        Adds database with Front and Back text properties
+        :return: database id in the format used in Notion links
+        """
+        database_id = uuid.uuid4().hex
+        database_rows = [{
+            "object": "page",
+            "id": str(uuid.uuid4()),
+            "last_edited_time": EDITED_TIME,
+            "properties": {
+                "Front": {"id": "title", "type": "title", "title": rich_text(f"Word {index}")},
+                "Back": {"id": "back", "type": "rich_text", "rich_text": rich_text(f"Translation {index}")},
+            },
+        } for index in range(rows)]
+        with self._lock:
+            self._databases[database_id] = {
+                "object": "database",
+                "id": database_id,
+                "last_edited_time": EDITED_TIME,
+                "title": rich_text(title),
+                "properties": {"Front": {"id": "title", "type": "title", "title": {}},
+                               "Back": {"id": "back", "type": "rich_text", "rich_text": {}}},
+            }
+            self._rows[database_id] = database_rows
+        return database_id
+
+    def start(self) -> "FakeNotion":
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self):
+                url = urlparse(self.path)
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if body and self.headers.get("Content-Type", "").startswith("application/json"):
+                    params.update(json.loads(body))
+                status, payload = fake.handle(self.command, url.path, params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = _respond
+            do_POST = _respond
+            do_PATCH = _respond
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def api_url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1/"
+
+    @staticmethod
+    def _not_found(item_id: str) -> Tuple[int, dict]:
+        return 404, {"object": "error", "status": 404, "code": "object_not_found",
+                     "message": f"Could not find block with ID: {item_id}."}
+
+    def handle(self, method: str, path: str, params: dict) -> Tuple[int, dict]:
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+        parts = path.strip("/").split("/")[1:]
+
+        if parts == ["oauth", "token"]:
+            return 200, {"access_token": "fake-token", "workspace_name": "Fake workspace", "bot_id": "fake-bot"}
+        if len(parts) == 2 and parts[0] == "pages":
+            page = self._pages.get(parts[1].replace("-", ""))
+            return (200, page) if page else self._not_found(parts[1])
+        if len(parts) == 3 and parts[0] == "blocks" and parts[2] == "children":
+            return self._list_children(parts[1], params)
+        if len(parts) == 2 and parts[0] == "databases":
+            database = self._databases.get(parts[1].replace("-", ""))
+            return (200, database) if database else self._not_found(parts[1])
+        if len(parts) == 3 and parts[0] == "databases" and parts[2] == "query":
+            rows = self._rows.get(parts[1].replace("-", ""))
+            if rows is None:
+                return self._not_found(parts[1])
+            edited_after = (params.get("filter") or {}).get("last_edited_time", {}).get("after")
+            if edited_after:
+                rows = [row for row in rows if row["last_edited_time"] > edited_after]
+            return self._paginate(rows, params)
+        return 400, {"object": "error", "status": 400, "code": "invalid_request_url", "message": path}
+
+    def _list_children(self, block_id: str, params: dict) -> Tuple[int, dict]:
+        children = self._children.get(block_id.replace("-", ""))
+        if children is None:
+            # Bullets have no children
+            return 200, {"object": "list", "results": [], "next_cursor": None, "has_more": False}
+
+        return self._paginate(children, params)
+
+    def _paginate(self, items: List[dict], params: dict) -> Tuple[int, dict]:
+        page_size = min(int(params.get("page_size", 100)), self.max_page_size)
+        start = int(params.get("start_cursor", 0))
+        end = start + page_size
+        has_more = end < len(items)
+        return 200, {"object": "list", "results": items[start:end],
+                     "next_cursor": str(end) if has_more else None, "has_more": has_more}
@@ -0,0 +1,121 @@
+"""
+Local stand-in for Telegram Bot API, used to exercise the bot without network
+
+    with FakeTelegram() as telegram:
+        telebot.apihelper.API_URL = telegram.api_url
+        ...
+        telegram.calls("sendMessage")
+
+Message sending methods are limited by global and per-chat token buckets
+and answered with 429 and retry_after like the real API.
+"""
+import itertools
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+from utils import TokenBucket
+
+LIMITED_METHODS = {"sendMessage", "sendPhoto", "sendDocument", "editMessageText", "editMessageReplyMarkup"}
+MESSAGE_METHODS = LIMITED_METHODS | {"forwardMessage"}
+
+
+class FakeTelegram:
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3, latency: float = 0):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.latency = latency
+        self.requests: List[Tuple[float, str, dict]] = []
+        self.throttled = 0
+        self._chat_buckets: Dict[str, TokenBucket] = {}
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self) -> "FakeTelegram":
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self):
+                url = urlparse(self.path)
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if body and self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                    params.update({key: values[-1] for key, values in parse_qs(body.decode()).items()})
+                method = url.path.rsplit("/", 1)[-1]
+                status, payload = fake.handle(method, params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = _respond
+            do_POST = _respond
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def api_url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def calls(self, method: str) -> List[dict]:
+        with self._lock:
+            return [params for _, name, params in self.requests if name == method]
+
+    def _throttle(self, chat_id: str) -> float:
+        with self._lock:
+            bucket = self._chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+        return max(bucket.try_acquire(), self.global_bucket.try_acquire())
+
+    def handle(self, method: str, params: dict) -> Tuple[int, dict]:
+        if self.latency:
+            time.sleep(self.latency)
+        if method in LIMITED_METHODS and (wait := self._throttle(params.get("chat_id", ""))) > 0:
+            retry_after = math.ceil(wait)
+            with self._lock:
+                self.throttled += 1
+            return 429, {"ok": False, "error_code": 429,
+                         "description": f"Too Many Requests: retry after {retry_after}",
+                         "parameters": {"retry_after": retry_after}}
+
+        with self._lock:
+            self.requests.append((time.monotonic(), method, params))
+        return 200, {"ok": True, "result": self._result(method, params)}
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Fake bot", "username": "fake_bot"}
+        if method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        if method in MESSAGE_METHODS:
+            return {
+                "message_id": int(params.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return True
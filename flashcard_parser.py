@@ -0,0 +1,234 @@
+"""
+Turns Notion blocks into flashcards in a single pass over a block stream
+
+Supported cards, all marked with 🧩:
+    bulleted and numbered list items - "🧩 front :: back"
+    toggles - front is the summary, back is text of direct children
+    table rows - front is the first cell, back is the second one
+    database rows - sides are mapped properties, no marker needed
+Side separators are taken from FLASHCARD_SEPARATORS (comma separated, "::" by default),
+text is split on the first separator found. Malformed cards are reported as diagnostics.
+"""
+import hashlib
+import re
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Sequence, Union
+from bson.objectid import ObjectId
+from utils import env
+
+MARKER = "🧩"
+
+
+def content_hash(front_side: str, back_side: str) -> str:
+    """
+    Hash of flashcard sides, used to detect edited cards without comparing fields
+    """
+    return hashlib.sha1(f"{front_side}\x1f{back_side}".encode("utf-8")).hexdigest()
+
+
+@dataclass
+class Flashcard:
+    page_id: str
+    block_id: str
+    front_side: str
+    back_side: str
+
+    user: ObjectId
+    last_edited_time: str = None
+
+    def content_hash(self) -> str:
+        return content_hash(self.front_side, self.back_side)
+
+    def __hash__(self):
+        return self.front_side
+
+
+class Diagnostic(NamedTuple):
+    block_id: str
+    reason: str
+    text: str
+
+
+def plain_text(rich_text: Union[List[dict], None]) -> str:
+    """
+    Joins every segment of Notion rich text
+    """
+    return "".join(segment.get("plain_text", "") for segment in rich_text or ())
+
+
+def property_text(prop: Union[dict, None]) -> str:
+    """
+    Text value of a database row property
+    """
+    if not prop:
+        return ""
+    value = prop.get(prop.get("type"))
+    if prop["type"] in ("title", "rich_text"):
+        return plain_text(value)
+    if prop["type"] == "select":
+        return value["name"] if value else ""
+    if prop["type"] == "multi_select":
+        return ", ".join(option["name"] for option in value or ())
+    if prop["type"] == "formula":
+        return property_text(value)
+    return "" if value is None else str(value)
+
+
+def _rich_text(content: dict) -> List[dict]:
+    # "text" in API versions before 2022-02-22, "rich_text" after
+    return content.get("rich_text", content.get("text"))
+
+
+def default_separators() -> List[str]:
+    return [separator for separator in env.get("FLASHCARD_SEPARATORS", "::").split(",") if separator]
+
+
+class _PendingToggle:
+    __slots__ = ("block", "front_side", "back_parts", "last_edited_time")
+
+    def __init__(self, block: dict, front_side: str):
+        self.block = block
+        self.front_side = front_side
+        self.back_parts = []
+        self.last_edited_time = block.get("last_edited_time")
+
+
+class FlashcardParser:
+    """
+    Parses flashcards of a page from blocks in any order
+
+    Cards are yielded as soon as their block arrives, toggle cards once the stream ends,
+    since their children may come in any later chunk. Children are matched to toggles
+    by block["parent"], see notion_api.Block.walk.
+    Blocks of known cards that were not edited are not parsed again, their ids are collected
+    in unchanged instead of yielding cards.
+    Handlers of other block types can be added with register().
+    """
+    # Cards which edit time is the latest edit of the block and its children
+    aggregate_types = {"toggle"}
+
+    def __init__(self, user_id: ObjectId, page_id: str, separators: Sequence[str] = None, marker: str = MARKER,
+                 known_edits: Dict[str, str] = None):
+        """
+        :param known_edits: block id -> last_edited_time of stored cards which can be trusted,
+                            blocks with the same edit time are skipped
+        """
+        self.user_id = user_id
+        self.page_id = page_id
+        self.marker = marker
+        self.known_edits = known_edits or {}
+        self.unchanged: List[str] = []
+        separators = separators or default_separators()
+        self._separator = re.compile("|".join(map(re.escape, separators)))
+        self.diagnostics: List[Diagnostic] = []
+        self._toggles: Dict[str, _PendingToggle] = {}
+        self._handlers: Dict[str, Callable[[dict, dict], Union[Flashcard, None]]] = {
+            "bulleted_list_item": self._parse_list_item,
+            "numbered_list_item": self._parse_list_item,
+            "toggle": self._parse_toggle,
+            "table_row": self._parse_table_row,
+        }
+
+    def register(self, block_type: str, handler: Callable[[dict, dict], Union[Flashcard, None]]):
+        """
+        Adds parser of block type, called as handler(block, block[block_type])
+        """
+        self._handlers[block_type] = handler
+
+    def _is_unchanged(self, block_id: str, last_edited_time: Union[str, None]) -> bool:
+        return last_edited_time is not None and self.known_edits.get(block_id) == last_edited_time
+
+    def _report(self, block: dict, reason: str, text: str):
+        self.diagnostics.append(Diagnostic(block["id"], reason, text[:100]))
+
+    def card(self, block: dict, front_side: str, back_side: str, last_edited_time: str = None) -> Union[Flashcard, None]:
+        if not front_side.strip() or not back_side.strip():
+            self._report(block, "empty side", f"{front_side}|{back_side}")
+            return None
+        return Flashcard(self.page_id, block["id"], front_side, back_side, self.user_id,
+                         last_edited_time or block.get("last_edited_time"))
+
+    def split(self, block: dict, text: str) -> Union[Flashcard, None]:
+        """
+        Splits "front :: back" text on the first separator
+        """
+        sides = self._separator.split(text.strip(), 1)
+        if len(sides) != 2:
+            self._report(block, "missing separator", text)
+            return None
+        return self.card(block, *sides)
+
+    def _parse_list_item(self, block: dict, content: dict) -> Union[Flashcard, None]:
+        text = plain_text(_rich_text(content))
+        if self.marker not in text:
+            return None
+        return self.split(block, text)
+
+    def _parse_toggle(self, block: dict, content: dict) -> None:
+        text = plain_text(_rich_text(content))
+        if self.marker not in text:
+            return None
+        if not block.get("has_children"):
+            self._report(block, "toggle without children", text)
+            return None
+        self._toggles[block["id"]] = _PendingToggle(block, text.strip())
+        return None
+
+    def _parse_table_row(self, block: dict, content: dict) -> Union[Flashcard, None]:
+        cells = content.get("cells") or []
+        if not cells or self.marker not in (front_side := plain_text(cells[0])):
+            return None
+        if len(cells) < 2:
+            self._report(block, "row without back cell", front_side)
+            return None
+        return self.card(block, front_side.strip(), plain_text(cells[1]).strip())
+
+    def _child_text(self, block: dict) -> str:
+        content = block.get(block["type"]) or {}
+        if block["type"] == "table_row":
+            return " | ".join(plain_text(cell) for cell in content.get("cells") or [])
+        return plain_text(_rich_text(content) if isinstance(content, dict) else None)
+
+    def parse_rows(self, rows: Iterable[dict], front_property: str, back_property: str) -> Iterator[Flashcard]:
+        """
+        Yields flashcards of database rows, sides are taken from mapped properties
+        """
+        for row in rows:
+            properties = row.get("properties", {})
+            if front_property not in properties or back_property not in properties:
+                self._report(row, "missing property", ", ".join(properties))
+                continue
+            flashcard = self.card(row, property_text(properties[front_property]).strip(),
+                                  property_text(properties[back_property]).strip())
+            if flashcard:
+                yield flashcard
+
+    def parse(self, blocks: Iterable[dict]) -> Iterator[Flashcard]:
+        for block in blocks:
+            parent_id = (block.get("parent") or {}).get("block_id")
+            if parent_id is not None and (toggle := self._toggles.get(parent_id)):
+                if text := self._child_text(block):
+                    toggle.back_parts.append(text)
+                if (edited := block.get("last_edited_time")) and edited > (toggle.last_edited_time or ""):
+                    # Edits of children change the card, but not the toggle itself
+                    toggle.last_edited_time = edited
+                continue
+
+            if block["type"] not in self.aggregate_types and \
+                    self._is_unchanged(block["id"], block.get("last_edited_time")):
+                self.unchanged.append(block["id"])
+                continue
+            handler = self._handlers.get(block["type"])
+            if handler and (flashcard := handler(block, block.get(block["type"]) or {})):
+                yield flashcard
+
+        for toggle in self._toggles.values():
+            if self._is_unchanged(toggle.block["id"], toggle.last_edited_time):
+                self.unchanged.append(toggle.block["id"])
+                continue
+            # Children of one chunk arrive in document order
+            flashcard = self.card(toggle.block, toggle.front_side, "\n".join(toggle.back_parts),
+                                  toggle.last_edited_time)
+            if flashcard:
+                yield flashcard
+        self._toggles.clear()
@@ -0,0 +1,27 @@
+import os
+import subprocess
+import sys
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 3000)}"
+# Single process only: next-step handlers, per-chat update order, study sessions, the Telegram outbox
+# and Notion rate limits live in its memory, a second worker would get follow-up updates without them.
+# WEB_CONCURRENCY is ignored, scale with WEB_THREADS and UPDATE_WORKERS
+workers = 1
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 4))
+# App is loaded in the worker, so update workers and connections are not shared through fork
+preload_app = False
+
+
+def on_starting(server):
+    if server.cfg.workers != 1:
+        raise RuntimeError(f"The bot runs in a single worker process, got {server.cfg.workers} workers")
+    # Runs once in the master, in its own process so workers do not inherit its connections
+    subprocess.run([sys.executable, "release.py"], check=True)
+
+
+def worker_exit(server, worker):
+    # Runs in the worker before Python exits, so drained updates can still schedule answer writes
+    if getattr(worker, "wsgi", None) is not None:
+        from app import shutdown
+        shutdown(worker.wsgi)
@@ -1,13 +1,14 @@
-from bot import bot
-from flask import request
-from app import app
+"""
+Development mode: exposes local server through ngrok and runs Flask dev server
+Production mode runs wsgi.py under gunicorn, see gunicorn.conf.py
+"""
 from pyngrok import ngrok
-import utils
-import telebot
+from app import create_app, shutdown
+import metrics
+import release
 from utils import env
 
 PORT = env['PORT']
-TG_TOKEN = env['TG_TOKEN']
 
 
 def gen_public_url():
@@ -17,24 +18,14 @@ def gen_public_url():
     return ngrok.connect(PORT, bind_tls=True).public_url
 
 
-if utils.env['DEV']:
-    env['DOMAIN'] = gen_public_url()
-
-DOMAIN = env['DOMAIN']
-# Setting up webhook
-webhook_info = bot.get_webhook_info()
-if webhook_info.url != DOMAIN:
-    bot.set_webhook(f"{DOMAIN}/{TG_TOKEN}")
-
-
-@app.route(f"/{TG_TOKEN}", methods=["POST"])
-def tg_token():
-    """Process Telegram webhook calls"""
-    req_data = request.get_data().decode("utf-8")
-    update = telebot.types.Update.de_json(req_data)
-    bot.process_new_updates([update])
-
-    return ""
-
-
-app.run(port=PORT, debug=True)
+if __name__ == "__main__":
+    metrics.configure_logging()
+    if env.get('DEV'):
+        env['DOMAIN'] = gen_public_url()
+    release.main([env['DOMAIN']])
+    app = create_app()
+    try:
+        # Reloader would start every background worker twice
+        app.run(port=PORT, debug=True, use_reloader=False)
+    finally:
+        shutdown(app)
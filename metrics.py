@@ -0,0 +1,209 @@
+"""
+Process metrics exposed in Prometheus text format on /metrics and sampled structured logs
+"""
+import json
+import logging
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+from pymongo import monitoring
+from utils import env
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry: List["_Metric"] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        # Metric registered again, e.g. by another create_app() call, replaces the previous one
+        _registry[:] = [metric for metric in _registry if metric.name != name]
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> Tuple:
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        header = f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.kind}\n"
+        return header + "".join(f"{sample}\n" for sample in self.samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in values]
+
+
+class Gauge(_Metric):
+    """
+    Gauge read from callback when metrics are rendered, e.g. queue depth
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {self.callback()}"]
+
+
+class CallbackCounter(Gauge):
+    """
+    Counter read from callback when metrics are rendered, e.g. totals kept by a component
+    """
+    kind = "counter"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (last one is +Inf), sum]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, f'le="{bound}"')
+                samples.append(f"{self.name}_bucket{labels} {cumulative}")
+            samples.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            samples.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return samples
+
+
+def render() -> str:
+    """
+    All registered metrics in Prometheus text exposition format
+    """
+    return "".join(metric.render() for metric in _registry)
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+handler_latency = Histogram("bot_handler_seconds", "Telegram update handler latency", ("handler",))
+handler_errors = Counter("bot_handler_errors_total", "Telegram update handlers that raised", ("handler",))
+notion_requests = Counter("notion_requests_total", "Notion API responses", ("method", "endpoint", "status"))
+notion_latency = Histogram("notion_request_seconds", "Notion API request latency including retries",
+                           ("method", "endpoint"))
+mongo_latency = Histogram("mongo_command_seconds", "MongoDB command latency", ("command", "status"))
+
+
+class MongoListener(monitoring.CommandListener):
+    """
+    Records duration of every command sent to MongoDB
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_latency.observe(event.duration_micros / 1e6, command=event.command_name, status="ok")
+
+    def failed(self, event):
+        mongo_latency.observe(event.duration_micros / 1e6, command=event.command_name, status="failed")
+
+
+def log_sampled(logger: logging.Logger, event: str, sample_rate: float = None, **fields):
+    """
+    Logs event with fields as one JSON line, only sample_rate of calls are logged
+    :param sample_rate: defaults to LOG_SAMPLE_RATE
+    """
+    if sample_rate is None:
+        sample_rate = float(env.get("LOG_SAMPLE_RATE", 0.1))
+    if random.random() >= sample_rate:
+        return
+    event_fields = {"event": event, **fields}
+    logger.info(json.dumps(event_fields, default=str), extra={"event_fields": event_fields})
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as JSON lines, fields of log_sampled() events are kept at the top level
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name}
+        if event_fields := getattr(record, "event_fields", None):
+            line.update(event_fields)
+        else:
+            line["message"] = record.getMessage()
+        if record.exc_info:
+            line["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+
+def configure_logging():
+    """
+    Sends logs of LOG_LEVEL and above to stderr as JSON lines, repeated calls do nothing
+    """
+    root = logging.getLogger()
+    if any(isinstance(handler.formatter, JsonFormatter) for handler in root.handlers):
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    root.addHandler(handler)
+    root.setLevel(env.get("LOG_LEVEL", "INFO").upper())
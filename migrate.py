@@ -0,0 +1,28 @@
+"""
+Creates database indexes and verifies that bot queries are served by them
+Usage: python migrate.py [--check]
+"""
+import sys
+from db import ensure_indexes, get_database
+import search
+from user import explain_queries
+
+
+def main(argv) -> int:
+    ensure_indexes()
+    # Cards stored before search was added, later syncs index cards as they change
+    indexed = search.backfill(get_database()["flashcards"])
+    print(f"Indexes are up to date, {indexed} cards indexed for search")
+    if "--check" not in argv:
+        return 0
+
+    failed = [name for name, collscans in explain_queries().items() if collscans]
+    for name in failed:
+        print(f"COLLSCAN: {name}")
+    if not failed:
+        print("All queries use indexes")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,26 +1,152 @@
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import requests
-from dataclasses import dataclass
+from requests.adapters import HTTPAdapter
 from datetime import datetime
-from bson.objectid import ObjectId
-from typing import List, Union
+from typing import Dict, Iterator, Tuple, List, Union
+from urllib.parse import urlparse
+from utils import env, TokenBucket
+from flashcard_parser import Flashcard, FlashcardParser, plain_text
+import metrics
+from page_cache import PageMetadata
 
 
-@dataclass
-class Flashcard:
-    page_id: str
-    block_id: str
-    front_side: str
-    back_side: str
+def parse_notion_time(value: str) -> datetime:
+    """
+    Converts Notion timestamp to naive UTC datetime, the way pymongo returns dates
+    """
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
 
-    user: ObjectId
 
+class NotionAPIError(Exception):
+    """
+    Raised when Notion responds with an error object
+    """
 
-    def __hash__(self):
-        return self.front_side
+    def __init__(self, response: dict):
+        super().__init__(f"{response.get('code')}: {response.get('message')}")
+        self.response = response
+
+
+_notion_id = re.compile(r"/[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}(?=/|$)")
+
+
+def notion_endpoint(url: str) -> str:
+    """
+    Path of Notion API url with ids replaced, used as metric label
+    """
+    return _notion_id.sub("/:id", urlparse(url).path)
+
+
+class NotionClient:
+    """
+    HTTP client shared by all Notion API calls of the process
+    Keeps connections alive, limits request rate to Notion's per-integration limit
+    and retries throttled or failed requests honoring Retry-After
+    """
+    retry_statuses = {429, 500, 502, 503, 504}
+    idempotent_methods = {"GET", "PATCH", "DELETE"}
+
+    def __init__(self, rate_limit: float = 3, burst: float = 6, pool_size: int = 20,
+                 max_retries: int = 5, timeout: float = 30, backoff_cap: float = 30):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.limiter = TokenBucket(rate_limit, burst)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff_cap = backoff_cap
+
+    def request(self, method: str, url: str, idempotent: bool = None, **kwargs) -> requests.Response:
+        """
+        Sends request to Notion
+        429 responses are always retried, 5xx responses and connection errors
+        only for idempotent requests
+        :param idempotent: overrides idempotency check based on method
+        :return: last received response
+        """
+        if idempotent is None:
+            idempotent = method.upper() in self.idempotent_methods
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = notion_endpoint(url)
+        with metrics.notion_latency.time(method=method, endpoint=endpoint):
+            return self._request(method, url, endpoint, idempotent, **kwargs)
+
+    def _request(self, method: str, url: str, endpoint: str, idempotent: bool, **kwargs) -> requests.Response:
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                res = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                metrics.notion_requests.inc(method=method, endpoint=endpoint, status="connection_error")
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+
+            metrics.notion_requests.inc(method=method, endpoint=endpoint, status=res.status_code)
+            retryable = res.status_code == 429 or (idempotent and res.status_code in self.retry_statuses)
+            if not retryable or attempt >= self.max_retries:
+                return res
+
+            if retry_after := self._retry_after(res):
+                # Notion limits the whole integration, so every thread has to wait
+                self.limiter.pause(retry_after)
+                time.sleep(retry_after)
+            else:
+                time.sleep(self._backoff(attempt))
+            attempt += 1
+
+    @staticmethod
+    def _retry_after(res: requests.Response) -> Union[float, None]:
+        try:
+            return max(float(res.headers["Retry-After"]), 0)
+        except (KeyError, ValueError):
+            return None
+
+    def _backoff(self, attempt: int) -> float:
+        """
+        Exponential backoff with jitter
+        """
+        return min(self.backoff_cap, 0.5 * 2 ** attempt) * random.uniform(0.5, 1)
+
+
+_client: Union[NotionClient, None] = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> NotionClient:
+    """
+    Returns Notion client of the current process
+    Client is recreated after fork so processes do not share sockets.
+    The bot runs as a single process, see gunicorn.conf.py, so it owns the whole NOTION_RATE_LIMIT.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = NotionClient(
+                    rate_limit=float(env.get("NOTION_RATE_LIMIT", 3)),
+                    burst=float(env.get("NOTION_RATE_BURST", 6)),
+                    pool_size=int(env.get("NOTION_POOL_SIZE", 20)),
+                )
+                _client_pid = pid
+    return _client
 
 
 class NotionAPI:
-    api_url = "https://api.notion.com/v1/"
+    # Overridden to point the bot at a local stand-in, see fakes/notion.py
+    api_url = env.get("NOTION_API_URL") or "https://api.notion.com/v1/"
 
     def __init__(self, access_token, *args):
         self.access_token = access_token
@@ -32,6 +158,9 @@ class NotionAPI:
     def block(self):
         return Block(self.access_token, self.api_url, *self.args)
 
+    def database(self):
+        return Database(self.access_token, self.api_url, *self.args)
+
 
 class ApiHandler:
 
@@ -45,11 +174,18 @@ class ApiHandler:
             "Authorization": f"Bearer {self.access_token}",
             "Notion-Version": "2021-05-13"
         }
-        res = requests.request(method, url, headers=headers, **kwargs)
-        return res.json()
+        res = get_client().request(method, url, headers=headers, **kwargs)
+        try:
+            return res.json()
+        except ValueError:
+            # Proxies answer 5xx with HTML, it is reported like Notion's own errors
+            return {"object": "error", "status": res.status_code, "code": "invalid_response",
+                    "message": res.text[:200]}
 
     def retrieve(self, item_id: str):
         response = self._make_request("GET", f"{self.url}/{item_id}")
+        if response.get("object") == "error":
+            raise NotionAPIError(response)
         self.content = response
         return self
 
@@ -78,40 +214,155 @@ class Page(ApiHandler):
         self.url += "pages"
 
     def get_title(self) -> str:
-        return self.content["properties"]["title"]["title"][0]["text"]["content"]
+        return plain_text(self.content["properties"]["title"]["title"])
+
+    def get_last_edited_time(self) -> str:
+        return self.content["last_edited_time"]
+
+    def get_icon(self) -> Union[str, None]:
+        """
+        Emoji icon of the page, None for pages without icon or with an image one
+        """
+        icon = self.content.get("icon") or {}
+        return icon.get("emoji")
+
+    def metadata(self) -> PageMetadata:
+        return PageMetadata(self.get_title(), self.get_icon(), self.get_last_edited_time())
+
+
+class Database(ApiHandler):
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.url += "databases"
+
+    def get_title(self) -> str:
+        return plain_text(self.content.get("title"))
+
+    def get_last_edited_time(self) -> str:
+        return self.content["last_edited_time"]
+
+    def property_types(self) -> dict:
+        """
+        :return: property name -> property type
+        """
+        return {name: prop["type"] for name, prop in self.content.get("properties", {}).items()}
+
+    def query(self, database_id: str, query_filter: dict = None, cursor: str = None,
+              page_size: int = 100) -> Tuple[List[dict], Union[str, None]]:
+        """
+        Fetches one chunk of database rows, oldest edits first
+        :return: rows and cursor of the next chunk if there is one
+        """
+        body = {"page_size": page_size, "sorts": [{"timestamp": "last_edited_time", "direction": "ascending"}]}
+        if query_filter:
+            body["filter"] = query_filter
+        if cursor:
+            body["start_cursor"] = cursor
+        # Query only reads, so it is retried like GET requests
+        response = self._make_request("POST", f"{self.url}/{database_id}/query", json=body, idempotent=True)
+        if response.get("object") == "error":
+            raise NotionAPIError(response)
+        next_cursor = response.get("next_cursor") if response.get("has_more") else None
+        return response["results"], next_cursor
+
+    def iter_rows(self, database_id: str, edited_after: str = None) -> Iterator[dict]:
+        """
+        Yields database rows following pagination cursors
+        :param edited_after: ISO time, only rows edited after it are returned by Notion
+        """
+        query_filter = {"timestamp": "last_edited_time", "last_edited_time": {"after": edited_after}} \
+            if edited_after else None
+        cursor = None
+        while True:
+            results, cursor = self.query(database_id, query_filter, cursor)
+            yield from results
+            if not cursor:
+                return
 
 
 class Block(ApiHandler):
-    flashcard_smile = "🧩"
 
     def __init__(self, *args):
         super(Block, self).__init__(*args)
         self.url += "blocks"
 
+    # Blocks whose children belong to another page or database
+    skip_descend_types = {"child_page", "child_database"}
+
     def retrieve(self, item_id: str):
+        """
+        Sets block to traverse, children are fetched lazily by walk()
+        """
         self.page_id = item_id
-        response = self._make_request("GET", f"{self.url}/{item_id}/children")
-        self.content = response
         return self
 
-    @staticmethod
-    def __parse_bulleted_item(item, user_id, page_id) -> Union[Flashcard, None]:
-        block_text = item["bulleted_list_item"]["text"][0]["plain_text"]
-        if not Block.flashcard_smile in block_text:
-            return None
-        front_side, back_side = block_text.strip().split("::")
-        return Flashcard(page_id, item["id"], front_side, back_side, user_id, )
-
-    def parse_flashcards(self) -> List[Flashcard]:
-        children = self.content["results"]
-        flashcards = []
-        parse_options = {
-            'bulleted_list_item': self.__parse_bulleted_item
-        }
-        for block in children:
-            if parse_option := parse_options.get(block["type"]):
-                flashcard = parse_option(block, self.user_id, self.page_id)
-                if flashcard:
-                    flashcards.append(flashcard)
+    def _fetch_children(self, block_id: str, cursor: str = None, page_size: int = 100) -> Tuple[List[dict], Union[str, None]]:
+        """
+        Fetches one chunk of block children
+        :return: children and cursor of the next chunk if there is one
+        """
+        params = {"page_size": page_size}
+        if cursor:
+            params["start_cursor"] = cursor
+        response = self._make_request("GET", f"{self.url}/{block_id}/children", params=params)
+        if response.get("object") == "error":
+            raise NotionAPIError(response)
+        next_cursor = response.get("next_cursor") if response.get("has_more") else None
+        return response["results"], next_cursor
+
+    def iter_children(self, block_id: str) -> Iterator[dict]:
+        """
+        Yields direct children of block following pagination cursors
+        """
+        cursor = None
+        while True:
+            results, cursor = self._fetch_children(block_id, cursor)
+            yield from results
+            if not cursor:
+                return
+
+    def walk(self, block_id: str = None, max_workers: int = None) -> Iterator[dict]:
+        """
+        Yields every block nested in block, descending into blocks with children
+        Sibling subtrees and next chunks are fetched concurrently by at most max_workers requests.
+        Blocks are yielded as soon as their chunk arrives, so document order is not preserved,
+        every block has "parent" set to the block it was fetched from
+        """
+        block_id = block_id or self.page_id
+        max_workers = max_workers or int(env.get("NOTION_TRAVERSAL_WORKERS", 4))
+        pending = deque([(block_id, None)])
+        running = {}
+        with ThreadPoolExecutor(max_workers) as executor:
+            try:
+                while pending or running:
+                    while pending and len(running) < max_workers:
+                        parent_id, cursor = pending.popleft()
+                        running[executor.submit(self._fetch_children, parent_id, cursor)] = parent_id
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        parent_id = running.pop(future)
+                        results, next_cursor = future.result()
+                        if next_cursor:
+                            pending.appendleft((parent_id, next_cursor))
+                        parent = {"type": "page_id", "page_id": parent_id} if parent_id == block_id else \
+                            {"type": "block_id", "block_id": parent_id}
+                        for block in results:
+                            # The way newer API versions annotate blocks, lets parser match toggle children
+                            block.setdefault("parent", parent)
+                            if block.get("has_children") and block["type"] not in self.skip_descend_types:
+                                pending.append((block["id"], None))
+                            yield block
+            finally:
+                for future in running:
+                    future.cancel()
+
+    def parser(self, separators: List[str] = None, known_edits: Dict[str, str] = None) -> FlashcardParser:
+        return FlashcardParser(self.user_id, self.page_id, separators, known_edits=known_edits)
 
-        return flashcards
+    def parse_flashcards(self, blocks: Iterator[dict] = None) -> Iterator[Flashcard]:
+        """
+        Yields flashcards found in blocks as they arrive
+        :param blocks: blocks to parse, defaults to every block nested in retrieved page
+        """
+        return self.parser().parse(blocks if blocks is not None else self.walk())
@@ -0,0 +1,233 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, List, Union
+from telebot.apihelper import ApiTelegramException
+from utils import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Request priorities, lower value is sent first
+CALLBACK = 0
+INTERACTIVE = 1
+BULK = 2
+
+
+class _Job:
+    __slots__ = ("priority", "seq", "key", "call", "future", "coalesce_key", "attempts")
+
+    def __init__(self, priority: int, seq: int, key: Hashable, call: Callable, coalesce_key: Hashable = None):
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.call = call
+        self.future = Future()
+        self.coalesce_key = coalesce_key
+        self.attempts = 0
+
+
+class Outbox:
+    """
+    Sends Telegram requests within flood limits
+
+    Every request takes a token from the global bucket and, if it targets a chat,
+    from the bucket of that chat. Requests of one chat are sent in order they were
+    submitted, the chat which head request has the best priority goes first.
+    A pending request with the same coalesce key (e.g. edit of the same message)
+    is replaced by the newer one. Requests answered with 429 are retried after retry_after.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 workers: int = 4, max_retries: int = 3, max_chat_buckets: int = 10000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self.max_chat_buckets = max_chat_buckets
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+        self._chat_buckets: Dict[Hashable, TokenBucket] = {}
+        self._queues: Dict[Hashable, deque] = {}
+        self._busy = set()
+        self._delayed_until: Dict[Hashable, float] = {}
+        self._ready = []
+        self._delayed = []
+        self._edits: Dict[Hashable, _Job] = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._stopping = False
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"outbox-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 10):
+        """
+        Sends queued requests and stops workers
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+
+    def submit(self, call: Callable, chat_id: Hashable = None, priority: int = INTERACTIVE,
+               coalesce_key: Hashable = None) -> Future:
+        """
+        Queues Telegram request
+        :param call: function doing the request
+        :param chat_id: chat the request is sent to, None for requests not bound to chat
+        :param coalesce_key: pending request with the same key is replaced with this one
+        :return: Future with result of the request
+        """
+        with self._cond:
+            self._ensure_started()
+            if coalesce_key is not None and (pending := self._edits.get(coalesce_key)):
+                pending.call = call
+                self.coalesced += 1
+                return pending.future
+
+            seq = next(self._seq)
+            # Requests without chat (callback answers) do not have to wait for each other
+            key = chat_id if chat_id is not None else ("callback", seq)
+            job = _Job(priority, seq, key, call, coalesce_key)
+            if coalesce_key is not None:
+                self._edits[coalesce_key] = job
+            queue = self._queues.setdefault(key, deque())
+            queue.append(job)
+            if len(queue) == 1:
+                self._schedule(key)
+            self._cond.notify()
+            return job.future
+
+    @staticmethod
+    def _is_chat(key: Hashable) -> bool:
+        return not isinstance(key, tuple)
+
+    def _chat_bucket(self, key: Hashable) -> TokenBucket:
+        bucket = self._chat_buckets.get(key)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_chat_buckets:
+                # Full buckets behave exactly like new ones
+                self._chat_buckets = {k: b for k, b in self._chat_buckets.items()
+                                      if k in self._queues or not b.is_full()}
+            bucket = self._chat_buckets[key] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _schedule(self, key: Hashable):
+        """
+        Marks head request of chat as ready to be sent, caller holds the lock
+        """
+        if key in self._busy or key in self._delayed_until or not self._queues.get(key):
+            return
+        head = self._queues[key][0]
+        heapq.heappush(self._ready, (head.priority, head.seq, key))
+
+    def _delay(self, key: Hashable, seconds: float):
+        ready_at = time.monotonic() + seconds
+        self._delayed_until[key] = ready_at
+        heapq.heappush(self._delayed, (ready_at, next(self._seq), key))
+
+    def _next_job(self) -> Union[_Job, None]:
+        """
+        Waits for a request which chat is allowed to send, caller holds the lock
+        :return: job or None when outbox is stopped and empty
+        """
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                ready_at, _, key = heapq.heappop(self._delayed)
+                if self._delayed_until.get(key) == ready_at:
+                    del self._delayed_until[key]
+                    self._schedule(key)
+
+            while self._ready:
+                _, seq, key = heapq.heappop(self._ready)
+                queue = self._queues.get(key)
+                if not queue or queue[0].seq != seq or key in self._busy or key in self._delayed_until:
+                    continue
+                if self._is_chat(key) and (wait := self._chat_bucket(key).try_acquire()) > 0:
+                    self._delay(key, wait)
+                    continue
+                job = queue.popleft()
+                self._busy.add(key)
+                if job.coalesce_key is not None and self._edits.get(job.coalesce_key) is job:
+                    del self._edits[job.coalesce_key]
+                return job
+
+            if self._stopping and not self._queues:
+                return None
+            self._cond.wait(self._delayed[0][0] - now if self._delayed else None)
+
+    @staticmethod
+    def _retry_after(error: ApiTelegramException) -> Union[float, None]:
+        if error.error_code != 429:
+            return None
+        return error.result_json.get("parameters", {}).get("retry_after", 1)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+            if job is None:
+                return
+
+            self.global_bucket.acquire()
+            retry_after = None
+            try:
+                result = job.call()
+            except ApiTelegramException as e:
+                retry_after = self._retry_after(e)
+                if retry_after is None or job.attempts >= self.max_retries:
+                    retry_after = None
+                    self._fail(job, e)
+            except Exception as e:
+                self._fail(job, e)
+            else:
+                job.future.set_result(result)
+                self.sent += 1
+
+            with self._cond:
+                self._busy.discard(job.key)
+                queue = self._queues[job.key]
+                if retry_after is not None:
+                    job.attempts += 1
+                    self.retried += 1
+                    queue.appendleft(job)
+                    self._delay(job.key, retry_after)
+                elif not queue:
+                    del self._queues[job.key]
+                else:
+                    self._schedule(job.key)
+                self._cond.notify_all()
+
+    def _fail(self, job: _Job, error: Exception):
+        logger.warning("Telegram request to %s failed: %s", job.key, error)
+        self.failed += 1
+        job.future.set_exception(error)
+
+    def depth(self) -> int:
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "coalesced": self.coalesced,
+        }
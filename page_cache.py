@@ -0,0 +1,150 @@
+"""
+Page metadata cache shared by worker processes of a host through SQLite
+
+Keeps title, icon and last edit time of pages per user and a summary of every page library
+(page count and its first keyboard page), so adding a page or opening /reload does not go
+to Notion or MongoDB every time. Entries expire after PAGE_CACHE_TTL
+and are replaced when a fresh read shows a different last_edited_time.
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Tuple, Union
+import metrics
+from utils import env
+
+
+@dataclass
+class PageMetadata:
+    title: str
+    icon: Union[str, None] = None
+    last_edited_time: Union[str, None] = None
+
+
+lookups = metrics.Counter("page_cache_requests_total", "Page cache lookups", ("kind", "result"))
+
+
+class PageMetadataCache:
+    """
+    :param path: SQLite database file, shared by every process using the same path
+    :param ttl: seconds entries stay valid
+    """
+
+    def __init__(self, path: str, ttl: float = 600, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS page_metadata (
+                    user_id TEXT NOT NULL,
+                    page_id TEXT NOT NULL,
+                    title TEXT,
+                    icon TEXT,
+                    last_edited_time TEXT,
+                    cached_at REAL NOT NULL,
+                    PRIMARY KEY (user_id, page_id)
+                );
+                CREATE TABLE IF NOT EXISTS page_summaries (
+                    user_id TEXT PRIMARY KEY,
+                    summary TEXT,
+                    generation INTEGER NOT NULL,
+                    cached_at REAL NOT NULL
+                );
+            """)
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Connection of the current thread, sqlite connections must not cross threads or forks
+        """
+        pid, connection = getattr(self._local, "connection", (None, None))
+        if pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = (os.getpid(), connection)
+        return connection
+
+    def _expired(self, cached_at: float) -> bool:
+        return self.clock() - cached_at > self.ttl
+
+    def get(self, user_id, page_id: str) -> Union[PageMetadata, None]:
+        row = self._connection().execute(
+            "SELECT title, icon, last_edited_time, cached_at FROM page_metadata WHERE user_id = ? AND page_id = ?",
+            (str(user_id), page_id)
+        ).fetchone()
+        if row is None or self._expired(row[3]):
+            lookups.inc(kind="metadata", result="miss")
+            return None
+        lookups.inc(kind="metadata", result="hit")
+        return PageMetadata(*row[:3])
+
+    def set(self, user_id, page_id: str, metadata: PageMetadata) -> bool:
+        """
+        Stores freshly read metadata
+        :return: True if cached entry had a different last_edited_time
+        """
+        connection = self._connection()
+        row = connection.execute("SELECT last_edited_time FROM page_metadata WHERE user_id = ? AND page_id = ?",
+                                 (str(user_id), page_id)).fetchone()
+        stale = row is not None and row[0] != metadata.last_edited_time
+        if stale:
+            lookups.inc(kind="metadata", result="stale")
+        connection.execute(
+            "INSERT OR REPLACE INTO page_metadata VALUES (?, ?, ?, ?, ?, ?)",
+            (str(user_id), page_id, metadata.title, metadata.icon, metadata.last_edited_time, self.clock())
+        )
+        return stale
+
+    def invalidate(self, user_id, page_id: str):
+        self._connection().execute("DELETE FROM page_metadata WHERE user_id = ? AND page_id = ?",
+                                   (str(user_id), page_id))
+
+    def get_page_summary(self, user_id) -> Tuple[Union[dict, None], int]:
+        """
+        :return: cached page library summary of user or None, and generation to pass to set_page_summary()
+        """
+        row = self._connection().execute(
+            "SELECT summary, generation, cached_at FROM page_summaries WHERE user_id = ?", (str(user_id),)
+        ).fetchone()
+        if row is None or row[0] is None or self._expired(row[2]):
+            lookups.inc(kind="page_summary", result="miss")
+            return None, row[1] if row else 0
+        lookups.inc(kind="page_summary", result="hit")
+        return json.loads(row[0]), row[1]
+
+    def set_page_summary(self, user_id, summary: dict, generation: int):
+        """
+        Stores summary read from the database unless it was invalidated since get_page_summary()
+        """
+        self._connection().execute("""
+            INSERT INTO page_summaries VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET summary = excluded.summary, cached_at = excluded.cached_at
+            WHERE page_summaries.generation = excluded.generation
+        """, (str(user_id), json.dumps(summary), generation, self.clock()))
+
+    def invalidate_page_summary(self, user_id):
+        self._connection().execute("""
+            INSERT INTO page_summaries VALUES (?, NULL, 1, ?)
+            ON CONFLICT (user_id) DO UPDATE SET summary = NULL, generation = page_summaries.generation + 1
+        """, (str(user_id), self.clock()))
+
+
+_cache: Union[PageMetadataCache, None] = None
+_cache_lock = threading.Lock()
+
+
+def get_page_cache() -> PageMetadataCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                default_path = os.path.join(tempfile.gettempdir(), "notion-bot-page-cache.sqlite3")
+                _cache = PageMetadataCache(env.get("PAGE_CACHE_PATH") or default_path,
+                                           ttl=float(env.get("PAGE_CACHE_TTL", 600)))
+    return _cache
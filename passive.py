@@ -0,0 +1,237 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Hashable, Iterable, List, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PassiveSettings:
+    """
+    Passive learning mode settings of a user
+    cadence is in minutes, quiet hours are local hours [quiet_start, quiet_end)
+    """
+    enabled: bool = False
+    cadence: int = 60
+    quiet_start: int = 22
+    quiet_end: int = 8
+    utc_offset: int = 0
+
+    @classmethod
+    def from_document(cls, document: Union[dict, None]) -> "PassiveSettings":
+        document = document or {}
+        return cls(
+            enabled=document.get("enabled", False),
+            cadence=document.get("cadence", 60),
+            quiet_start=document.get("quiet_start", 22),
+            quiet_end=document.get("quiet_end", 8),
+            utc_offset=document.get("utc_offset", 0),
+        )
+
+    def to_document(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "cadence": self.cadence,
+            "quiet_start": self.quiet_start,
+            "quiet_end": self.quiet_end,
+            "utc_offset": self.utc_offset,
+        }
+
+    def _local(self, timestamp: float) -> datetime:
+        return datetime.utcfromtimestamp(timestamp) + timedelta(hours=self.utc_offset)
+
+    def is_quiet(self, timestamp: float) -> bool:
+        hour = self._local(timestamp).hour
+        if self.quiet_start == self.quiet_end:
+            return False
+        if self.quiet_start < self.quiet_end:
+            return self.quiet_start <= hour < self.quiet_end
+        return hour >= self.quiet_start or hour < self.quiet_end
+
+    def quiet_end_after(self, timestamp: float) -> float:
+        local = self._local(timestamp)
+        end = local.replace(hour=self.quiet_end, minute=0, second=0, microsecond=0)
+        if end <= local:
+            end += timedelta(days=1)
+        return timestamp + (end - local).total_seconds()
+
+    def next_push_at(self, timestamp: float) -> float:
+        """
+        Time of the push following the one at timestamp, moved out of quiet hours
+        """
+        push_at = timestamp + self.cadence * 60
+        if self.is_quiet(push_at):
+            push_at = self.quiet_end_after(push_at)
+        return push_at
+
+
+class _Subscription:
+    __slots__ = ("chat_id", "settings", "version")
+
+    def __init__(self, chat_id, settings: PassiveSettings, version: int):
+        self.chat_id = chat_id
+        self.settings = settings
+        self.version = version
+
+
+class PassiveDelivery:
+    """
+    Pushes due flashcards to users with passive mode enabled
+
+    Next push time of every user is kept in a heap, so a tick only touches users
+    whose push is due and the database is queried once per push, not per user per tick.
+    Replaced or removed subscriptions leave stale heap entries which are skipped by version.
+
+    :param sender: sends flashcard to chat, called as sender(chat_id, flashcard)
+    :param card_source: returns due flashcard of user or None, called as card_source(user_id)
+    :param settings_source: returns user documents with passive settings changed after given
+                            time, or all enabled users for None
+    :param lease: returns True while this process is allowed to deliver pushes
+    :param clock: returns current unix time, replaced by a fake clock in tests
+    """
+
+    def __init__(self, sender: Callable[[Hashable, dict], None],
+                 card_source: Callable[[Hashable], Union[dict, None]],
+                 settings_source: Callable[[Union[datetime, None]], Iterable[dict]] = None,
+                 lease: Callable[[], bool] = None,
+                 clock: Callable[[], float] = time.time,
+                 refresh_interval: float = 60):
+        self.sender = sender
+        self.card_source = card_source
+        self.settings_source = settings_source
+        self.lease = lease
+        self.clock = clock
+        self.refresh_interval = refresh_interval
+        self.sent = 0
+        self.failed = 0
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._subscriptions: Dict[Hashable, _Subscription] = {}
+        self._versions = itertools.count()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._refreshed_at: Union[datetime, None] = None
+
+    def subscribe(self, user_id: Hashable, chat_id, settings: PassiveSettings, now: float = None):
+        """
+        Adds, updates or removes user depending on settings
+        """
+        now = self.clock() if now is None else now
+        with self._cond:
+            if not settings.enabled:
+                self._subscriptions.pop(user_id, None)
+                return
+            subscription = _Subscription(chat_id, settings, next(self._versions))
+            self._subscriptions[user_id] = subscription
+            heapq.heappush(self._heap, (settings.next_push_at(now), subscription.version, user_id))
+            self._cond.notify()
+
+    def unsubscribe(self, user_id: Hashable):
+        with self._cond:
+            self._subscriptions.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def next_push_at(self) -> Union[float, None]:
+        with self._cond:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def _drop_stale(self):
+        while self._heap:
+            _, version, user_id = self._heap[0]
+            subscription = self._subscriptions.get(user_id)
+            if subscription and subscription.version == version:
+                return
+            heapq.heappop(self._heap)
+
+    def tick(self, now: float = None) -> int:
+        """
+        Sends flashcards to every user whose push is due
+        :return: number of sent flashcards
+        """
+        now = self.clock() if now is None else now
+        due = []
+        with self._cond:
+            while True:
+                self._drop_stale()
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                _, _, user_id = heapq.heappop(self._heap)
+                due.append((user_id, self._subscriptions[user_id]))
+
+        sent = 0
+        for user_id, subscription in due:
+            settings = subscription.settings
+            if settings.is_quiet(now):
+                next_at = settings.quiet_end_after(now)
+            else:
+                next_at = settings.next_push_at(now)
+                try:
+                    if flashcard := self.card_source(user_id):
+                        self.sender(subscription.chat_id, flashcard)
+                        sent += 1
+                except Exception:
+                    logger.exception("Passive push to %s failed", user_id)
+                    self.failed += 1
+
+            with self._cond:
+                # Settings could change while we were sending
+                if self._subscriptions.get(user_id) is subscription:
+                    subscription.version = next(self._versions)
+                    heapq.heappush(self._heap, (next_at, subscription.version, user_id))
+        self.sent += sent
+        return sent
+
+    def refresh(self):
+        """
+        Loads settings changed since previous refresh
+        """
+        started = datetime.utcnow()
+        for document in self.settings_source(self._refreshed_at):
+            self.subscribe(document["_id"], document["user_id"], PassiveSettings.from_document(document.get("passive")))
+        self._refreshed_at = started
+
+    def _reset(self):
+        with self._cond:
+            self._heap = []
+            self._subscriptions = {}
+        self._refreshed_at = None
+
+    def start(self):
+        threading.Thread(target=self.run, name="passive-delivery", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+
+    def run(self):
+        next_refresh = 0
+        while not self._stop.is_set():
+            try:
+                if time.monotonic() >= next_refresh:
+                    next_refresh = time.monotonic() + self.refresh_interval
+                    if self.lease and not self.lease():
+                        # Another instance delivers pushes, load everything again if we take over
+                        self._reset()
+                        self._stop.wait(self.refresh_interval)
+                        continue
+                    if self.settings_source:
+                        self.refresh()
+                self.tick()
+            except Exception:
+                logger.exception("Passive delivery tick failed")
+
+            with self._cond:
+                timeout = max(next_refresh - time.monotonic(), 0)
+                if (push_at := self.next_push_at()) is not None:
+                    timeout = min(timeout, max(push_at - self.clock(), 0))
+                if timeout > 0 and not self._stop.is_set():
+                    self._cond.wait(timeout)
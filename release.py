@@ -0,0 +1,24 @@
+"""
+One-time setup of a deployment: database indexes, bot commands and Telegram webhook
+Run once per deploy before workers start, gunicorn.conf.py does it on server start
+Usage: python release.py [domain], domain defaults to DOMAIN
+"""
+import sys
+from bot import setup_telegram
+from db import ensure_indexes, get_database
+import search
+from utils import env
+
+
+def main(argv) -> int:
+    domain = argv[0] if argv else env['DOMAIN']
+    ensure_indexes()
+    # Cards stored before search was added, later syncs index cards as they change
+    search.backfill(get_database()["flashcards"])
+    setup_telegram(domain)
+    print(f"Webhook is set to {domain}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,78 @@
+"""
+Rebuilds scheduling state of flashcards from the review log
+Usage: python replay_reviews.py [--user USER_ID] [--apply]
+Without --apply only reports cards which stored state differs from the replayed one.
+Cards answered before the log existed have more reps than logged reviews and are left untouched
+"""
+import argparse
+import sys
+from datetime import timedelta
+from itertools import islice
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+import srs
+from review_log import replay
+from user import flashcards, reviews, review_log
+
+BATCH = 500
+STATE_FIELDS = ("ease", "interval", "learning_step", "reps", "lapses")
+
+
+def differs(stored: srs.CardState, replayed: srs.CardState) -> bool:
+    stored_document, replayed_document = stored.to_document(), replayed.to_document()
+    if any(stored_document[name] != replayed_document[name] and not (
+            isinstance(replayed_document[name], float) and abs(stored_document[name] - replayed_document[name]) < 1e-6)
+           for name in STATE_FIELDS):
+        return True
+    # MongoDB keeps milliseconds of answer times
+    return stored.due_at is None or abs(stored.due_at - replayed.due_at) > timedelta(seconds=1)
+
+
+def replay_cursor(user_id: ObjectId = None):
+    """
+    Reviews in replay order, served by card_answered_at or user_card_answered_at index without a sort in memory
+    """
+    query = {"user": user_id} if user_id else {}
+    return reviews.find(query, {"card": 1, "answer": 1, "answered_at": 1}).sort(
+        [("card", 1), ("answered_at", 1)]).batch_size(BATCH * 10)
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--user", help="replay cards of one user")
+    parser.add_argument("--apply", action="store_true", help="write replayed state to cards")
+    args = parser.parse_args(argv)
+
+    # Reviews still buffered by this process
+    review_log.flush()
+    replayed = replay(replay_cursor(ObjectId(args.user) if args.user else None))
+    totals = {"cards": 0, "matching": 0, "differing": 0, "incomplete_history": 0, "missing": 0, "updated": 0}
+    while batch := list(islice(replayed, BATCH)):
+        stored = {card["_id"]: card for card in flashcards.find(
+            {"_id": {"$in": [card_id for card_id, _, _ in batch]}}, {"front_side": 0, "back_side": 0})}
+        operations = []
+        for card_id, state, count in batch:
+            totals["cards"] += 1
+            card = stored.get(card_id)
+            if card is None:
+                totals["missing"] += 1
+                continue
+            stored_state = srs.CardState.from_document(card)
+            if stored_state.reps > count:
+                totals["incomplete_history"] += 1
+                continue
+            if not differs(stored_state, state):
+                totals["matching"] += 1
+                continue
+            totals["differing"] += 1
+            operations.append(UpdateOne({"_id": card_id}, {"$set": state.to_document()}))
+        if args.apply and operations:
+            totals["updated"] += flashcards.bulk_write(operations, ordered=False).modified_count
+
+    for name, value in totals.items():
+        print(f"{name}: {value}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
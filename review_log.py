@@ -0,0 +1,152 @@
+"""
+Append-only log of flashcard reviews, written in batches
+
+Every applied answer becomes a document of "reviews" collection:
+    card, user, answer (normalized level), answered_at (naive UTC, time scheduling used),
+    time_to_answer (seconds since the card was rendered, None for old buttons)
+Scheduling state of any card can be rebuilt from its reviews, see replay_reviews.py
+"""
+import logging
+import threading
+import time
+from collections import deque
+from itertools import groupby
+from operator import itemgetter
+from typing import Iterable, Iterator, List, Tuple
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+import srs
+
+logger = logging.getLogger(__name__)
+
+
+class ReviewLog:
+    """
+    Buffers reviews in process and writes them with insert_many
+
+    A batch is written once max_batch reviews are waiting or the oldest one waited interval seconds.
+    Failed batches are retried, the buffer keeps at most max_buffer reviews and drops the oldest ones.
+    stop() writes what is left, it is registered to run on graceful shutdown by app.create_app().
+    """
+
+    def __init__(self, collection, max_batch: int = 100, interval: float = 5, max_buffer: int = 10000):
+        self.collection = collection
+        self.max_batch = max_batch
+        self.interval = interval
+        self.max_buffer = max_buffer
+        self.written = 0
+        self.dropped = 0
+        self._buffer = deque()
+        self._oldest_at = None
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, name="review-log", daemon=True)
+            self._thread.start()
+
+    def append(self, review: dict):
+        """
+        Queues review without touching the database
+        """
+        with self._cond:
+            self._ensure_started()
+            if not self._buffer:
+                self._oldest_at = time.monotonic()
+            self._buffer.append(review)
+            if len(self._buffer) > self.max_buffer:
+                self._buffer.popleft()
+                self.dropped += 1
+            if len(self._buffer) >= self.max_batch:
+                self._cond.notify()
+
+    def _take_batch(self) -> List[dict]:
+        batch = [self._buffer.popleft() for _ in range(min(self.max_batch, len(self._buffer)))]
+        self._oldest_at = time.monotonic() if self._buffer else None
+        return batch
+
+    def _write(self, batch: List[dict]) -> bool:
+        try:
+            self.collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Retried batch, documents written by the failed attempt already have their _id
+            if e.details.get("writeConcernErrors") or any(
+                    error["code"] != 11000 for error in e.details.get("writeErrors", ())):
+                logger.exception("Failed to write %s reviews", len(batch))
+                return False
+        except Exception:
+            logger.exception("Failed to write %s reviews", len(batch))
+            return False
+        self.written += len(batch)
+        return True
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._stopping and (
+                        len(self._buffer) < self.max_batch and
+                        (self._oldest_at is None or time.monotonic() - self._oldest_at < self.interval)):
+                    timeout = None if self._oldest_at is None else \
+                        self.interval - (time.monotonic() - self._oldest_at)
+                    self._cond.wait(timeout)
+                if self._stopping:
+                    return
+                batch = self._take_batch()
+            if not self._write(batch):
+                with self._cond:
+                    self._requeue(batch)
+                    self._cond.wait(self.interval)
+
+    def _requeue(self, batch: List[dict]):
+        self._buffer.extendleft(reversed(batch))
+        self._oldest_at = time.monotonic()
+
+    def flush(self) -> int:
+        """
+        Writes every buffered review from the calling thread
+        :return: number of reviews written
+        """
+        written = 0
+        while True:
+            with self._cond:
+                batch = self._take_batch()
+            if not batch:
+                return written
+            if not self._write(batch):
+                with self._cond:
+                    self._requeue(batch)
+                return written
+            written += len(batch)
+
+    def stop(self, timeout: float = 10):
+        """
+        Stops background writes and writes the rest of the buffer
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def depth(self) -> int:
+        return len(self._buffer)
+
+    def stats(self) -> dict:
+        return {"depth": self.depth(), "written": self.written, "dropped": self.dropped}
+
+
+def replay(reviews: Iterable[dict]) -> Iterator[Tuple[ObjectId, srs.CardState, int]]:
+    """
+    Folds reviews sorted by card and answered_at into scheduling state of every card
+    :return: card id, its state after the last review and number of reviews
+    """
+    for card_id, card_reviews in groupby(reviews, key=itemgetter("card")):
+        state = srs.CardState()
+        count = 0
+        for review in card_reviews:
+            state = srs.review(state, review["answer"], review["answered_at"])
+            count += 1
+        yield card_id, state, count
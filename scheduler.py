@@ -0,0 +1,183 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from typing import List, Union
+from db import LazyCollection, acquire_lease, lease_owner
+from user import User, SyncReport, pages
+from utils import env
+
+logger = logging.getLogger(__name__)
+
+scheduler_runs = LazyCollection("scheduler_runs")
+
+
+@dataclass
+class CycleStats:
+    """
+    Timing stats of a single auto-reload cycle
+    """
+    started_at: datetime
+    owner: str
+    duration: float = 0
+    pages_total: int = 0
+    reloaded: int = 0
+    unchanged: int = 0
+    failed: int = 0
+    skipped: int = 0
+    blocks_fetched: int = 0
+    cards_changed: int = 0
+    stats_reconciled: int = 0
+    page_latencies: List[float] = field(default_factory=list, repr=False)
+
+    def summary(self) -> dict:
+        latencies = sorted(self.page_latencies)
+        result = asdict(self)
+        del result["page_latencies"]
+        if latencies:
+            result["page_latency_avg"] = sum(latencies) / len(latencies)
+            result["page_latency_p95"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            result["page_latency_max"] = latencies[-1]
+        return result
+
+
+class ReloadScheduler:
+    """
+    Reloads flashcards of every added page periodically
+
+    Only one process runs a cycle: the leader takes a lease document in "locks"
+    that expires after the reload interval, other instances keep polling it.
+    Pages are interleaved round-robin between users so a user with many pages
+    does not delay everybody else, and task starts are spread with jitter over
+    the spread window instead of firing all at once.
+    """
+    lock_id = "reload-scheduler"
+
+    def __init__(self, interval: float = None, workers: int = None, spread: float = None, poll_interval: float = 60):
+        self.interval = interval or float(env.get("RELOAD_INTERVAL", 3 * 60 * 60))
+        self.workers = workers or int(env.get("RELOAD_WORKERS", 4))
+        self.spread = spread if spread is not None else float(env.get("RELOAD_SPREAD", self.interval / 6))
+        self.poll_interval = min(poll_interval, self.interval)
+        self.owner = lease_owner()
+        self.last_stats: Union[CycleStats, None] = None
+        self._stop = threading.Event()
+        self._thread: Union[threading.Thread, None] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="reload-scheduler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.acquire_lease():
+                    self.run_cycle()
+            except Exception:
+                logger.exception("Auto-reload cycle failed")
+            self._stop.wait(self.poll_interval * random.uniform(0.8, 1.2))
+
+    def acquire_lease(self) -> bool:
+        """
+        Takes leadership for the next cycle if previous lease has expired
+        """
+        return acquire_lease(self.lock_id, self.owner, self.interval)
+
+    @staticmethod
+    def fair_order(page_models) -> List[dict]:
+        """
+        Interleaves pages round-robin between users in random user order
+        """
+        by_user = {}
+        for page in page_models:
+            by_user.setdefault(page["user"], deque()).append(page)
+        queues = list(by_user.values())
+        random.shuffle(queues)
+
+        ordered = []
+        while queues:
+            for queue in queues:
+                ordered.append(queue.popleft())
+            queues = [queue for queue in queues if queue]
+        return ordered
+
+    def run_cycle(self) -> CycleStats:
+        stats = CycleStats(started_at=datetime.utcnow(), owner=self.owner)
+        cycle_start = time.monotonic()
+        ordered = self.fair_order(pages.find({}, {"page_id": 1, "user": 1}))
+        stats.pages_total = len(ordered)
+
+        users_cache = {}
+        stats_lock = threading.Lock()
+        in_flight = threading.BoundedSemaphore(self.workers)
+        slot = self.spread / len(ordered) if ordered else 0
+
+        def reload_page(page):
+            started = time.monotonic()
+            try:
+                user = users_cache.get(page["user"])
+                if user is None:
+                    user = users_cache[page["user"]] = User.from_id(page["user"])
+                if not user or not user.is_logged_in_notion():
+                    with stats_lock:
+                        stats.skipped += 1
+                    return
+                report = user.reload_flashcards(page["page_id"], incremental=True)
+                with stats_lock:
+                    self._record(stats, report, time.monotonic() - started)
+            except Exception:
+                logger.exception("Auto-reload of page %s failed", page["page_id"])
+                with stats_lock:
+                    stats.failed += 1
+            finally:
+                in_flight.release()
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="reload-worker") as executor:
+            for index, page in enumerate(ordered):
+                planned = cycle_start + slot * index + random.uniform(0, slot)
+                if (delay := planned - time.monotonic()) > 0 and self._stop.wait(delay):
+                    break
+                in_flight.acquire()
+                executor.submit(reload_page, page)
+
+        self.reconcile_stats(stats, users_cache.values())
+        stats.duration = time.monotonic() - cycle_start
+        self.last_stats = stats
+        summary = stats.summary()
+        scheduler_runs.insert_one(dict(summary))
+        logger.info("Auto-reload cycle finished: %s", summary)
+        return stats
+
+    def reconcile_stats(self, stats: CycleStats, cycle_users):
+        """
+        Corrects drift of study stats counters of users whose pages were reloaded
+        """
+        for user in cycle_users:
+            if self._stop.is_set():
+                return
+            if not user:
+                continue
+            try:
+                user.reconcile_stats()
+                stats.stats_reconciled += 1
+            except Exception:
+                logger.exception("Stats reconciliation of user %s failed", user.id)
+
+    @staticmethod
+    def _record(stats: CycleStats, report: Union[SyncReport, bool], latency: float):
+        stats.page_latencies.append(latency)
+        if not report:
+            stats.failed += 1
+        elif report.page_skipped:
+            stats.unchanged += 1
+        else:
+            stats.reloaded += 1
+            stats.blocks_fetched += report.fetched
+            stats.cards_changed += report.changed
@@ -0,0 +1,143 @@
+"""
+Full-text search over flashcards of a user
+
+Every card keeps its index keys in "search_keys" and the multikey index on (user, search_keys)
+serves as the inverted index, so it is updated together with the card and never rebuilt.
+Keys are the normalized words of both sides. Words of FUZZY_MIN_LENGTH letters or more also get
+every variant with one letter deleted, prefixed with "~", so a query word finds words one edit away
+(symmetric delete). Prefix matches are anchored regular expressions over the same index.
+"""
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Iterable, List, Set
+from pymongo import UpdateOne
+
+WORD = re.compile(r"\w+")
+FUZZY = "~"
+FUZZY_MIN_LENGTH = 4
+# Words longer than that are rarely mistyped in queries and add a key per letter
+FUZZY_MAX_LENGTH = 24
+PREFIX_MIN_LENGTH = 2
+MAX_CANDIDATES = 200
+
+
+@lru_cache(maxsize=65536)
+def normalize(word: str) -> str:
+    """
+    Case and accent insensitive form of word
+    """
+    decomposed = unicodedata.normalize("NFKD", word.casefold())
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def words(text: str) -> List[str]:
+    """
+    Unique normalized words of text in order of appearance
+    """
+    return list(dict.fromkeys(normalize(word) for word in WORD.findall(text)))
+
+
+def deletes(word: str) -> Set[str]:
+    return {word[:index] + word[index + 1:] for index in range(len(word))}
+
+
+def index_keys(front_side: str, back_side: str) -> List[str]:
+    """
+    Keys stored in "search_keys" of a card
+    """
+    keys = set()
+    for word in words(f"{front_side} {back_side}"):
+        keys.add(word)
+        if FUZZY_MIN_LENGTH <= len(word) <= FUZZY_MAX_LENGTH:
+            keys.update(FUZZY + variant for variant in deletes(word))
+    return sorted(keys)
+
+
+def _word_filter(word: str) -> dict:
+    keys = {word}
+    if len(word) >= FUZZY_MIN_LENGTH - 1:
+        # Query word is the indexed word with a letter deleted, or both have a letter replaced
+        variants = deletes(word) if len(word) >= FUZZY_MIN_LENGTH else set()
+        keys.add(FUZZY + word)
+        keys.update(FUZZY + variant for variant in variants)
+        # Query word has an extra letter
+        keys.update(variants)
+    clauses = [{"search_keys": {"$in": sorted(keys)}}]
+    if len(word) >= PREFIX_MIN_LENGTH:
+        clauses.append({"search_keys": {"$regex": f"^{re.escape(word)}"}})
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+
+def _distance_at_most_one(a: str, b: str) -> bool:
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) == len(b):
+        return sum(x != y for x, y in zip(a, b)) <= 1
+    shorter, longer = (a, b) if len(a) < len(b) else (b, a)
+    return shorter in deletes(longer)
+
+
+def score(query_words: Iterable[str], card: dict) -> float:
+    """
+    Ranks a candidate card: exact words weigh most, then prefixes, then typos
+    Matches on the front side weigh twice as much as ones on the back side
+    """
+    total = 0.0
+    sides = ((words(card.get("front_side", "")), 2), (words(card.get("back_side", "")), 1))
+    for query_word in query_words:
+        best = 0.0
+        for side_words, weight in sides:
+            for word in side_words:
+                if word == query_word:
+                    match = 3
+                elif word.startswith(query_word):
+                    match = 2
+                elif _distance_at_most_one(word, query_word):
+                    match = 1
+                else:
+                    continue
+                best = max(best, match * weight)
+        total += best
+    return total
+
+
+def query_filter(user_id, query_words: List[str]) -> dict:
+    return {"user": user_id, "$and": [_word_filter(word) for word in query_words]}
+
+
+def search(collection, user_id, query: str, limit: int = 5) -> List[dict]:
+    """
+    Cards of user matching every word of query exactly, as a prefix or with one typo
+    :return: best matching cards first
+    """
+    query_words = words(query)
+    if not query_words:
+        return []
+    # The longest word is the most selective one, index bounds are built from the first clause
+    query_words.sort(key=len, reverse=True)
+    candidates = list(collection.find(query_filter(user_id, query_words), {"search_keys": 0})
+                      .limit(MAX_CANDIDATES))
+    candidates.sort(key=lambda card: score(query_words, card), reverse=True)
+    return candidates[:limit]
+
+
+def backfill(collection, batch_size: int = 1000) -> int:
+    """
+    Indexes cards stored before search was added
+    :return: number of indexed cards
+    """
+    indexed = 0
+    cursor = collection.find({"search_keys": {"$exists": False}}, {"front_side": 1, "back_side": 1},
+                             batch_size=batch_size)
+    operations = []
+    for card in cursor:
+        operations.append(UpdateOne({"_id": card["_id"]}, {"$set": {
+            "search_keys": index_keys(card.get("front_side", ""), card.get("back_side", ""))
+        }}))
+        if len(operations) >= batch_size:
+            indexed += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        indexed += collection.bulk_write(operations, ordered=False).modified_count
+    return indexed
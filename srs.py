@@ -0,0 +1,217 @@
+"""
+SM-2 style spaced repetition scheduler
+
+Pure functions over CardState, no database access, so scheduling can be
+unit-tested and replayed.
+Learning phase: 1 min -> Good -> 10 min -> Good -> graduated (1 day)
+Review phase: interval is multiplied by ease (2.5 by default), wrong answers
+lower ease by 0.2 and send the card back to learning steps.
+"""
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Union
+
+AGAIN = "again"
+HARD = "hard"
+GOOD = "good"
+EASY = "easy"
+
+# Answer levels used in callback data of rendered flashcards
+ANSWER_LEVELS = {
+    "no": AGAIN,
+    "hard": HARD,
+    "yes": GOOD,
+    "ez": EASY,
+}
+
+DEFAULT_EASE = 2.5
+MIN_EASE = 1.3
+LAPSE_EASE_PENALTY = 0.2
+HARD_EASE_PENALTY = 0.15
+EASY_EASE_BONUS = 0.15
+LEARNING_STEPS = (timedelta(minutes=1), timedelta(minutes=10))
+GRADUATING_INTERVAL = 1.0
+EASY_INTERVAL = 4.0
+HARD_FACTOR = 1.2
+EASY_FACTOR = 1.3
+LAPSE_FACTOR = 0.5
+
+
+@dataclass
+class CardState:
+    """
+    Scheduling state of a flashcard
+    interval is in days, step is index of learning step or None when card is graduated
+    """
+    ease: float = DEFAULT_EASE
+    interval: float = 0
+    step: Union[int, None] = 0
+    reps: int = 0
+    lapses: int = 0
+    due_at: Union[datetime, None] = None
+
+    @property
+    def is_learning(self) -> bool:
+        return self.step is not None
+
+    @classmethod
+    def from_document(cls, document: dict) -> "CardState":
+        return cls(
+            ease=document.get("ease", DEFAULT_EASE),
+            interval=document.get("interval", 0),
+            step=document.get("learning_step", 0),
+            reps=document.get("reps", 0),
+            lapses=document.get("lapses", 0),
+            due_at=document.get("due_at"),
+        )
+
+    def to_document(self) -> dict:
+        return {
+            "ease": self.ease,
+            "interval": self.interval,
+            "learning_step": self.step,
+            "reps": self.reps,
+            "lapses": self.lapses,
+            "due_at": self.due_at,
+        }
+
+
+def normalize_answer(answer: str) -> str:
+    """
+    Maps callback answer level to scheduler answer
+    :raises ValueError: on unknown answer
+    """
+    level = ANSWER_LEVELS.get(answer, answer)
+    if level not in (AGAIN, HARD, GOOD, EASY):
+        raise ValueError(f"Unknown answer level: {answer}")
+    return level
+
+
+def _learn(state: CardState, level: str, now: datetime) -> CardState:
+    if level == EASY:
+        interval = max(state.interval, EASY_INTERVAL)
+        return CardState(state.ease, interval, None, state.reps + 1, state.lapses, now + timedelta(days=interval))
+
+    if level == AGAIN:
+        step = 0
+    elif level == HARD:
+        step = min(state.step, len(LEARNING_STEPS) - 1)
+    else:
+        step = state.step + 1
+
+    if step >= len(LEARNING_STEPS):
+        interval = max(state.interval, GRADUATING_INTERVAL)
+        return CardState(state.ease, interval, None, state.reps + 1, state.lapses, now + timedelta(days=interval))
+    return CardState(state.ease, state.interval, step, state.reps + 1, state.lapses, now + LEARNING_STEPS[step])
+
+
+def _review(state: CardState, level: str, now: datetime) -> CardState:
+    if level == AGAIN:
+        ease = max(MIN_EASE, state.ease - LAPSE_EASE_PENALTY)
+        interval = max(GRADUATING_INTERVAL, state.interval * LAPSE_FACTOR)
+        return CardState(ease, interval, 0, state.reps + 1, state.lapses + 1, now + LEARNING_STEPS[0])
+
+    if level == HARD:
+        ease = max(MIN_EASE, state.ease - HARD_EASE_PENALTY)
+        interval = state.interval * HARD_FACTOR
+    elif level == GOOD:
+        ease = state.ease
+        interval = state.interval * state.ease
+    else:
+        ease = state.ease + EASY_EASE_BONUS
+        interval = state.interval * state.ease * EASY_FACTOR
+
+    interval = max(interval, GRADUATING_INTERVAL)
+    return CardState(ease, interval, None, state.reps + 1, state.lapses, now + timedelta(days=interval))
+
+
+def review(state: CardState, answer: str, now: datetime) -> CardState:
+    """
+    Computes card state after answer
+    :param answer: callback answer level (yes/no/ez/hard) or scheduler answer
+    :param now: time of the answer, naive UTC
+    """
+    level = normalize_answer(answer)
+    if state.is_learning:
+        return _learn(state, level, now)
+    return _review(state, level, now)
+
+
+def _max(*values):
+    return {"$max": list(values)}
+
+
+def _learning_update(level: str) -> dict:
+    state = "$_srs"
+    last_step = len(LEARNING_STEPS) - 1
+    if level == EASY:
+        return {"interval": _max(f"{state}.interval", EASY_INTERVAL), "learning_step": None}
+    if level == AGAIN:
+        return {"interval": f"{state}.interval", "learning_step": 0}
+    if level == HARD:
+        return {"interval": f"{state}.interval", "learning_step": {"$min": [f"{state}.step", last_step]}}
+    graduates = {"$gte": [f"{state}.step", last_step]}
+    return {
+        "interval": {"$cond": [graduates, _max(f"{state}.interval", GRADUATING_INTERVAL), f"{state}.interval"]},
+        "learning_step": {"$cond": [graduates, None, {"$add": [f"{state}.step", 1]}]},
+    }
+
+
+def _review_update(level: str) -> dict:
+    ease = "$_srs.ease"
+    interval = "$_srs.interval"
+    if level == AGAIN:
+        return {
+            "ease": _max(MIN_EASE, {"$subtract": [ease, LAPSE_EASE_PENALTY]}),
+            "interval": _max(GRADUATING_INTERVAL, {"$multiply": [interval, LAPSE_FACTOR]}),
+            "learning_step": 0,
+            "lapses": {"$add": ["$_srs.lapses", 1]},
+        }
+    if level == HARD:
+        return {
+            "ease": _max(MIN_EASE, {"$subtract": [ease, HARD_EASE_PENALTY]}),
+            "interval": _max(GRADUATING_INTERVAL, {"$multiply": [interval, HARD_FACTOR]}),
+        }
+    if level == GOOD:
+        return {"interval": _max(GRADUATING_INTERVAL, {"$multiply": [interval, ease]})}
+    return {
+        "ease": {"$add": [ease, EASY_EASE_BONUS]},
+        "interval": _max(GRADUATING_INTERVAL, {"$multiply": [interval, ease, EASY_FACTOR]}),
+    }
+
+
+def review_pipeline(answer: str, now: datetime) -> list:
+    """
+    Update pipeline applying review() to a card document on the server
+    Lets answer be recorded with a single atomic find_one_and_update
+    """
+    level = normalize_answer(answer)
+    learning = _learning_update(level)
+    review_phase = _review_update(level)
+    is_learning = {"$ne": ["$_srs.step", None]}
+
+    fields = {}
+    for name, default in (("ease", "$_srs.ease"), ("interval", "$_srs.interval"),
+                          ("learning_step", None), ("lapses", "$_srs.lapses")):
+        fields[name] = {"$cond": [is_learning, learning.get(name, default), review_phase.get(name, default)]}
+    fields["reps"] = {"$add": ["$_srs.reps", 1]}
+
+    step_durations = [int(step.total_seconds() * 1000) for step in LEARNING_STEPS]
+    day = int(timedelta(days=1).total_seconds() * 1000)
+    return [
+        {"$set": {"_srs": {
+            "ease": {"$ifNull": ["$ease", DEFAULT_EASE]},
+            "interval": {"$ifNull": ["$interval", 0]},
+            # Missing step means new card, null means graduated one
+            "step": {"$cond": [{"$eq": [{"$type": "$learning_step"}, "missing"]}, 0, "$learning_step"]},
+            "reps": {"$ifNull": ["$reps", 0]},
+            "lapses": {"$ifNull": ["$lapses", 0]},
+        }}},
+        {"$set": fields},
+        {"$set": {"due_at": {"$cond": [
+            {"$ne": ["$learning_step", None]},
+            {"$add": [now, {"$arrayElemAt": [step_durations, "$learning_step"]}]},
+            {"$add": [now, {"$toLong": {"$multiply": ["$interval", day]}}]},
+        ]}}},
+        {"$unset": "_srs"},
+    ]
@@ -0,0 +1,172 @@
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Union
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+from utils import env
+
+logger = logging.getLogger(__name__)
+
+_executor: Union[ThreadPoolExecutor, None] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Executor shared by all sessions for refills and answer writes, created on first use
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(int(env.get("STUDY_WORKERS", 4)), thread_name_prefix="study")
+    return _executor
+
+
+def shutdown():
+    """
+    Waits for answers being written and stops study threads
+    Called on shutdown by app.create_app() once no more updates are handled
+    """
+    get_executor().shutdown(wait=True)
+
+
+class StudyQueue:
+    """
+    Upcoming due flashcards of a study session kept in memory
+
+    Flips and next card are served from memory, the queue is refilled in background
+    when it runs low. Cards with answers that are not written yet are excluded
+    from refills, so they are not shown again with their old schedule.
+    """
+    projection = {"front_side": 1, "back_side": 1, "due_at": 1}
+
+    def __init__(self, collection: Collection, user_id: ObjectId, size: int = 10, low_watermark: int = 3,
+                 recent_size: int = 32):
+        self.collection = collection
+        self.user_id = user_id
+        self.size = size
+        self.low_watermark = low_watermark
+        self.recent_size = recent_size
+        self._cards = deque()
+        self._recent: "OrderedDict[str, dict]" = OrderedDict()
+        self._pending_answers = set()
+        self._refill: Union[Future, None] = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _load(self, limit: int) -> list:
+        with self._lock:
+            exclude = [card["_id"] for card in self._cards] + list(self._pending_answers)
+        return list(self.collection.find(
+            {"user": self.user_id, "due_at": {"$lte": datetime.utcnow()}, "_id": {"$nin": exclude}},
+            self.projection
+        ).sort("due_at", ASCENDING).limit(limit))
+
+    def _fill(self, generation: int):
+        cards = self._load(self.size - len(self._cards))
+        with self._lock:
+            if generation != self._generation:
+                # Queue was cleared while loading, cards may be outdated
+                return
+            queued = {card["_id"] for card in self._cards} | self._pending_answers
+            self._cards.extend(card for card in cards if card["_id"] not in queued)
+
+    def _refill_async(self):
+        with self._lock:
+            if self._refill and not self._refill.done():
+                return
+            try:
+                self._refill = get_executor().submit(self._fill, self._generation)
+            except RuntimeError:
+                # Shutting down, next() loads cards itself
+                return
+        self._refill.add_done_callback(self._log_error)
+
+    @staticmethod
+    def _log_error(future: Future):
+        if error := future.exception():
+            logger.error("Study queue task failed: %s", error)
+
+    def _remember(self, card: dict):
+        with self._lock:
+            self._recent[str(card["_id"])] = card
+            self._recent.move_to_end(str(card["_id"]))
+            while len(self._recent) > self.recent_size:
+                self._recent.popitem(last=False)
+
+    def next(self) -> Union[dict, None]:
+        """
+        Pops the most overdue card, loads cards synchronously only when queue is empty
+        """
+        with self._lock:
+            card = self._cards.popleft() if self._cards else None
+        if card is None:
+            refill = self._refill
+            if refill and not refill.done():
+                refill.exception()
+            with self._lock:
+                empty = not self._cards
+                generation = self._generation
+            if empty:
+                self._fill(generation)
+            with self._lock:
+                card = self._cards.popleft() if self._cards else None
+        if card is None:
+            return None
+
+        self._remember(card)
+        if len(self._cards) < self.low_watermark:
+            self._refill_async()
+        return card
+
+    def get(self, card_id: str) -> Union[dict, None]:
+        """
+        Returns recently shown or queued card without reading the database
+        """
+        with self._lock:
+            if card := self._recent.get(card_id):
+                return card
+            return next((card for card in self._cards if str(card["_id"]) == card_id), None)
+
+    def submit_answer(self, card_id: str, write: Callable[[], object]) -> Future:
+        """
+        Writes answer in background, card stays out of refills until it is written
+        """
+        card_object_id = ObjectId(card_id)
+        with self._lock:
+            self._pending_answers.add(card_object_id)
+            self._cards = deque(card for card in self._cards if card["_id"] != card_object_id)
+
+        def written(_):
+            with self._lock:
+                self._pending_answers.discard(card_object_id)
+
+        try:
+            future = get_executor().submit(write)
+        except RuntimeError:
+            # Executor is shut down, answer is written by the calling thread
+            future = Future()
+            try:
+                future.set_result(write())
+            except Exception as e:
+                future.set_exception(e)
+        future.add_done_callback(written)
+        future.add_done_callback(self._log_error)
+        return future
+
+    def clear(self):
+        """
+        Drops prefetched cards, e.g. after flashcards were reloaded
+        """
+        with self._lock:
+            self._generation += 1
+            self._cards.clear()
+            self._recent.clear()
+
+    def __len__(self):
+        return len(self._cards)
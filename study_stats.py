@@ -0,0 +1,208 @@
+"""
+Per-user study statistics kept as counters in "stats" of the user document
+
+    cards - number of cards, learned - cards which graduated from learning steps
+    due - cards by UTC day of due_at, days before today count as due today
+    reviews - answers by UTC day, {"total": n, "correct": n}, "again" is the only incorrect answer
+    streak, last_review_day - days in a row with at least one answer
+
+Counters are changed by the writes that change cards, reconcile() recomputes them from
+flashcards and reviews to correct drift, e.g. of cards restored by deck import.
+The same writes drop day counters which are out of the stats window or zero, see update_pipeline().
+"""
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Iterable, Union
+import srs
+
+RETENTION_DAYS = (7, 30)
+# Days of review history reconcile() looks at to find streak
+STREAK_HISTORY_DAYS = 366
+
+
+def day(moment: datetime) -> str:
+    return moment.strftime("%Y-%m-%d")
+
+
+def cards_update(cards: Iterable[dict], sign: int = 1) -> dict:
+    """
+    $inc of stats for added (sign=1) or removed (sign=-1) cards
+    :param cards: documents with due_at and learning_step
+    """
+    update = Counter()
+    for card in cards:
+        state = srs.CardState.from_document(card)
+        update["stats.cards"] += sign
+        if not state.is_learning:
+            update["stats.learned"] += sign
+        if state.due_at:
+            update[f"stats.due.{day(state.due_at)}"] += sign
+    return dict(update)
+
+
+def _card_groups(flashcards, card_filter: dict):
+    """
+    Counts of cards matching card_filter and of learned ones among them by UTC day of due_at
+    """
+    return flashcards.aggregate([
+        {"$match": card_filter},
+        {"$group": {
+            "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$due_at"}},
+            "count": {"$sum": 1},
+            # Cards never answered have no learning_step and are in the first step
+            "learned": {"$sum": {"$cond": [{"$eq": [{"$type": "$learning_step"}, "null"]}, 1, 0]}},
+        }},
+    ])
+
+
+def stored_cards_update(flashcards, card_filter: dict, sign: int = 1) -> dict:
+    """
+    cards_update() of cards matching card_filter, grouped by the server instead of reading every card
+    """
+    update = Counter()
+    for group in _card_groups(flashcards, card_filter):
+        update["stats.cards"] += sign * group["count"]
+        update["stats.learned"] += sign * group["learned"]
+        if group["_id"]:
+            update[f"stats.due.{group['_id']}"] += sign * group["count"]
+    return {key: value for key, value in update.items() if value}
+
+
+def combine(*increments: dict) -> dict:
+    """
+    Sums $inc documents, keys which cancel out are dropped
+    """
+    total = Counter()
+    for increment in increments:
+        total.update(increment)
+    return {key: value for key, value in total.items() if value}
+
+
+def new_cards_update(count: int, now: datetime) -> dict:
+    """
+    $inc of stats for cards created by sync, they are due right away and in learning
+    """
+    return {"stats.cards": count, f"stats.due.{day(now)}": count} if count else {}
+
+
+def _drop_days(field: str, keep: dict) -> dict:
+    """
+    Expression of the day counters object at field without the days keep is false for
+    """
+    return {"$arrayToObject": {"$filter": {"input": {"$objectToArray": {"$ifNull": [f"${field}", {}]}},
+                                           "cond": keep}}}
+
+
+def update_pipeline(increments: dict, now: datetime, answered: bool = False) -> list:
+    """
+    Update pipeline of user document: adds increments to stats and drops day counters nobody reads,
+    reviews older than the longest retention window and due days counted down to zero.
+    Everything is computed from the stored document, so concurrent sessions of the user do not
+    overwrite each other
+    :param increments: $inc of stats, e.g. from cards_update()
+    :param answered: an answer was given at now, streak and last_review_day move on
+    """
+    added = {key: {"$add": [{"$ifNull": [f"${key}", 0]}, value]} for key, value in increments.items()}
+    if answered:
+        today = day(now)
+        added["stats.streak"] = {"$switch": {"branches": [
+            {"case": {"$eq": ["$stats.last_review_day", today]}, "then": {"$ifNull": ["$stats.streak", 1]}},
+            {"case": {"$eq": ["$stats.last_review_day", day(now - timedelta(days=1))]},
+             "then": {"$add": [{"$ifNull": ["$stats.streak", 0]}, 1]}},
+        ], "default": 1}}
+        added["stats.last_review_day"] = {"$literal": today}
+    retention_since = day(now - timedelta(days=max(RETENTION_DAYS) - 1))
+    return [
+        {"$set": added},
+        {"$set": {
+            "stats.due": _drop_days("stats.due", {"$ne": ["$$this.v", 0]}),
+            "stats.reviews": _drop_days("stats.reviews", {"$gte": ["$$this.k", retention_since]}),
+        }},
+    ]
+
+
+def answer_update(before: srs.CardState, after: srs.CardState, answer: str, now: datetime) -> list:
+    """
+    Update of stats for an answer that changed card state from before to after, see update_pipeline()
+    """
+    today = day(now)
+    increments = Counter({f"stats.reviews.{today}.total": 1})
+    if srs.normalize_answer(answer) != srs.AGAIN:
+        increments[f"stats.reviews.{today}.correct"] += 1
+    if before.due_at:
+        increments[f"stats.due.{day(before.due_at)}"] -= 1
+    increments[f"stats.due.{day(after.due_at)}"] += 1
+    if before.is_learning != after.is_learning:
+        increments["stats.learned"] += 1 if before.is_learning else -1
+    return update_pipeline({key: value for key, value in increments.items() if value}, now, answered=True)
+
+
+@dataclass
+class StudyStats:
+    cards: int = 0
+    due_today: int = 0
+    learned: int = 0
+    streak: int = 0
+    retention_7: Union[float, None] = None
+    retention_30: Union[float, None] = None
+
+    @classmethod
+    def from_document(cls, stats: Union[dict, None], now: datetime) -> "StudyStats":
+        stats = stats or {}
+        today = day(now)
+        retention = {}
+        for days in RETENTION_DAYS:
+            since = day(now - timedelta(days=days - 1))
+            answers = [counts for answer_day, counts in (stats.get("reviews") or {}).items() if answer_day >= since]
+            total = sum(counts.get("total", 0) for counts in answers)
+            retention[days] = sum(counts.get("correct", 0) for counts in answers) / total if total else None
+        streak_alive = stats.get("last_review_day") in (today, day(now - timedelta(days=1)))
+        return cls(
+            cards=stats.get("cards", 0),
+            due_today=sum(count for due_day, count in (stats.get("due") or {}).items() if due_day <= today),
+            learned=stats.get("learned", 0),
+            streak=stats.get("streak", 0) if streak_alive else 0,
+            retention_7=retention[7],
+            retention_30=retention[30],
+        )
+
+
+def reconcile(flashcards, reviews, user_id, now: datetime = None) -> dict:
+    """
+    Recomputes stats of user from cards and review log
+    Counters changed while it runs may be overwritten, the next reconciliation brings them back
+    :return: stats document
+    """
+    now = now or datetime.utcnow()
+    stats = {"cards": 0, "learned": 0, "due": {}, "reviews": {}, "streak": 0, "last_review_day": None,
+             "reconciled_at": now}
+    for group in _card_groups(flashcards, {"user": user_id}):
+        stats["cards"] += group["count"]
+        stats["learned"] += group["learned"]
+        if group["_id"]:
+            stats["due"][group["_id"]] = group["count"]
+
+    since = now - timedelta(days=STREAK_HISTORY_DAYS)
+    days = {}
+    for group in reviews.aggregate([
+        {"$match": {"user": user_id, "answered_at": {"$gte": since}}},
+        {"$group": {
+            "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$answered_at"}},
+            "total": {"$sum": 1},
+            "correct": {"$sum": {"$cond": [{"$eq": ["$answer", srs.AGAIN]}, 0, 1]}},
+        }},
+    ]):
+        days[group["_id"]] = {"total": group["total"], "correct": group["correct"]}
+
+    retention_since = day(now - timedelta(days=max(RETENTION_DAYS) - 1))
+    stats["reviews"] = {answer_day: counts for answer_day, counts in days.items() if answer_day >= retention_since}
+    if days:
+        stats["last_review_day"] = last_day = max(days)
+        streak = 0
+        current = datetime.strptime(last_day, "%Y-%m-%d")
+        while day(current) in days:
+            streak += 1
+            current -= timedelta(days=1)
+        stats["streak"] = streak
+    return stats
@@ -0,0 +1,22 @@
+import os
+import sys
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+# Modules of the bot live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MONGODB_URL = os.environ.setdefault("MONGODB_URL", "mongodb://localhost:27017")
+
+
+def mongod_available() -> bool:
+    try:
+        MongoClient(MONGODB_URL, serverSelectionTimeoutMS=500).admin.command("ping")
+    except PyMongoError:
+        return False
+    return True
+
+
+# Tests of queries and updates MongoDB runs itself, they need a disposable mongod at MONGODB_URL
+requires_mongod = pytest.mark.skipif(not mongod_available(), reason=f"no mongod at {MONGODB_URL}")
@@ -0,0 +1,85 @@
+"""
+Outbox against the local Telegram stand-in: flood limit retries, coalesced edits and priorities
+"""
+import threading
+from functools import partial
+import pytest
+import telebot
+from fakes.telegram import FakeTelegram
+from outbox import BULK, CALLBACK, Outbox
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    def create(**limits):
+        fake = FakeTelegram(**limits).start()
+        monkeypatch.setattr(telebot.apihelper, "API_URL", fake.api_url)
+        fakes.append(fake)
+        return telebot.TeleBot("1:fake", threaded=False), fake
+
+    fakes = []
+    yield create
+    for fake in fakes:
+        fake.stop()
+
+
+def blocker(outbox: Outbox, chat_id) -> threading.Event:
+    """
+    Keeps a worker busy with a request to chat_id until the returned event is set
+    """
+    started, release = threading.Event(), threading.Event()
+
+    def wait():
+        started.set()
+        release.wait(5)
+
+    outbox.submit(wait, chat_id)
+    assert started.wait(5)
+    return release
+
+
+def test_flood_limit_is_retried_after_retry_after(bot):
+    # Telegram allows one message per chat, the outbox does not know it
+    telegram_bot, telegram = bot(chat_rate=1, chat_burst=1)
+    outbox = Outbox(global_rate=100, chat_rate=100, chat_burst=100, workers=2)
+    futures = [outbox.submit(partial(telegram_bot.send_message, 5, f"message {index}"), 5) for index in range(2)]
+
+    assert [future.result(10).text for future in futures] == ["message 0", "message 1"]
+    assert telegram.throttled >= 1
+    assert outbox.retried >= 1
+    assert outbox.failed == 0
+    outbox.stop()
+
+
+def test_pending_edits_of_a_message_are_coalesced(bot):
+    telegram_bot, telegram = bot(chat_rate=100, chat_burst=100)
+    outbox = Outbox(global_rate=100, chat_rate=100, chat_burst=100, workers=1)
+    release = blocker(outbox, 5)
+
+    edits = [outbox.submit(partial(telegram_bot.edit_message_text, f"edit {index}", 5, 42), 5,
+                           coalesce_key=("text", 5, 42)) for index in range(3)]
+    release.set()
+
+    assert edits[0] is edits[1] is edits[2]
+    edits[0].result(10)
+    assert [params["text"] for params in telegram.calls("editMessageText")] == ["edit 2"]
+    assert outbox.coalesced == 2
+    outbox.stop()
+
+
+def test_callback_answers_go_before_bulk_messages(bot):
+    telegram_bot, telegram = bot(chat_rate=100, chat_burst=100)
+    outbox = Outbox(global_rate=100, chat_rate=100, chat_burst=100, workers=1)
+    release = blocker(outbox, 1)
+
+    bulk = [outbox.submit(partial(telegram_bot.send_message, chat_id, "push"), chat_id, BULK)
+            for chat_id in (10, 11, 12)]
+    answer = outbox.submit(partial(telegram_bot.answer_callback_query, "query"), priority=CALLBACK)
+    release.set()
+
+    answer.result(10)
+    for future in bulk:
+        future.result(10)
+    methods = [method for _, method, _ in telegram.requests]
+    assert methods == ["answerCallbackQuery", "sendMessage", "sendMessage", "sendMessage"]
+    outbox.stop()
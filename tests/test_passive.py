@@ -0,0 +1,130 @@
+"""
+Passive delivery driven by a fake clock, pushes go to the local Telegram stand-in
+"""
+import calendar
+import threading
+import time
+from datetime import datetime
+import pytest
+import telebot
+from fakes.telegram import FakeTelegram
+from passive import PassiveDelivery, PassiveSettings
+
+NOON = calendar.timegm(datetime(2024, 3, 1, 12, 0).timetuple())
+HOUR = 60 * 60
+
+
+class FakeClock:
+
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+    with FakeTelegram(global_rate=1000, chat_rate=1000, chat_burst=1000) as fake:
+        monkeypatch.setattr(telebot.apihelper, "API_URL", fake.api_url)
+        yield fake
+
+
+def sender():
+    bot = telebot.TeleBot("1:fake", threaded=False)
+    return lambda chat_id, flashcard: bot.send_message(chat_id, flashcard["front_side"])
+
+
+def card_source(user_id):
+    return {"front_side": f"card of {user_id}"}
+
+
+def always(cadence: int) -> PassiveSettings:
+    # Equal start and end, no quiet hours
+    return PassiveSettings(enabled=True, cadence=cadence, quiet_start=0, quiet_end=0)
+
+
+def sent_chats(telegram: FakeTelegram) -> list:
+    return [int(params["chat_id"]) for params in telegram.calls("sendMessage")]
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition was not met in time"
+        time.sleep(0.01)
+
+
+def test_pushes_follow_heap_order(telegram):
+    clock = FakeClock(NOON)
+    delivery = PassiveDelivery(sender(), card_source, clock=clock)
+    delivery.subscribe("hourly", 1, always(60))
+    delivery.subscribe("half-hourly", 2, always(30))
+    delivery.subscribe("rare", 3, always(180))
+    assert delivery.next_push_at() == NOON + HOUR / 2
+
+    clock.now = NOON + HOUR / 2
+    assert delivery.tick() == 1
+    clock.now = NOON + HOUR
+    assert delivery.tick() == 2
+    assert sent_chats(telegram) == [2, 1, 2]
+    assert delivery.next_push_at() == NOON + 1.5 * HOUR
+
+    # Replaced settings leave the old heap entry behind, it is skipped
+    delivery.subscribe("rare", 3, always(30))
+    delivery.unsubscribe("half-hourly")
+    clock.now = NOON + 3 * HOUR
+    assert delivery.tick() == 2
+    assert sent_chats(telegram)[3:] == [3, 1]
+
+
+def test_quiet_hours_postpone_pushes(telegram):
+    clock = FakeClock(NOON + 9.5 * HOUR)
+    delivery = PassiveDelivery(sender(), card_source, clock=clock)
+    # 22:00 - 08:00 local time of UTC+1, the first push at 22:30 local falls into it
+    delivery.subscribe("night", 1, PassiveSettings(enabled=True, cadence=60, quiet_start=22, quiet_end=8,
+                                                    utc_offset=1))
+    morning = NOON + 19 * HOUR
+    assert delivery.next_push_at() == morning
+
+    clock.now = NOON + 14 * HOUR
+    assert delivery.tick() == 0
+    clock.now = morning
+    assert delivery.tick() == 1
+    assert sent_chats(telegram) == [1]
+
+
+def test_lease_takeover(telegram):
+    clock = FakeClock(NOON)
+    holds_lease = threading.Event()
+    lease_checks = []
+
+    def lease():
+        lease_checks.append(holds_lease.is_set())
+        return holds_lease.is_set()
+
+    def settings_source(since):
+        if since is not None:
+            return []
+        return [{"_id": "user", "user_id": 7, "passive": always(60).to_document()}]
+
+    delivery = PassiveDelivery(sender(), card_source, settings_source, lease, clock=clock, refresh_interval=0.02)
+    delivery.start()
+    try:
+        wait_for(lambda: len(lease_checks) >= 2)
+        assert len(delivery) == 0
+
+        holds_lease.set()
+        wait_for(lambda: len(delivery) == 1)
+        clock.now = NOON + HOUR
+        wait_for(lambda: delivery.sent == 1)
+        assert sent_chats(telegram) == [7]
+
+        # Another instance took over, subscriptions are dropped until the lease comes back
+        holds_lease.clear()
+        wait_for(lambda: len(delivery) == 0)
+        clock.now = NOON + 2 * HOUR
+        time.sleep(0.1)
+        assert delivery.sent == 1
+    finally:
+        delivery.stop()
@@ -0,0 +1,41 @@
+"""
+Hot queries of User are served by indexes created by ensure_indexes()
+Needs a disposable mongod at MONGODB_URL (mongodb://localhost:27017 by default), skipped without one
+"""
+import pytest
+from conftest import requires_mongod
+
+pytestmark = requires_mongod
+
+# _id lookups are planned as IDHACK, or EXPRESS_IXSCAN since MongoDB 8.0
+INDEX_STAGES = {"IXSCAN", "IDHACK", "EXPRESS_IXSCAN"}
+
+
+@pytest.fixture(scope="module")
+def plans():
+    from db import ensure_indexes
+    from user import explain_plans
+
+    ensure_indexes()
+    return explain_plans()
+
+
+def test_queries_use_indexes(plans):
+    from db import find_collscans, find_stages
+
+    for name, plan in plans.items():
+        winning_plan = plan["queryPlanner"]["winningPlan"]
+        assert not find_collscans(winning_plan), name
+        assert find_stages(winning_plan, INDEX_STAGES), name
+
+
+@pytest.mark.parametrize("user_id", [None, "5f0c6b3e9d1b2a0012345678"])
+def test_replay_is_not_sorted_in_memory(user_id):
+    from bson import ObjectId
+    from db import ensure_indexes, find_stages
+    from replay_reviews import replay_cursor
+
+    ensure_indexes()
+    winning_plan = replay_cursor(ObjectId(user_id) if user_id else None).explain()["queryPlanner"]["winningPlan"]
+    assert find_stages(winning_plan, INDEX_STAGES)
+    assert not find_stages(winning_plan, {"SORT", "COLLSCAN"})
@@ -0,0 +1,103 @@
+"""
+Scheduling of srs.review() and its server-side twin srs.review_pipeline()
+"""
+from datetime import datetime, timedelta
+import pytest
+import srs
+from conftest import MONGODB_URL, requires_mongod
+
+NOW = datetime(2024, 3, 1, 12, 0)
+
+
+def test_new_card_goes_through_learning_steps():
+    state = srs.review(srs.CardState(), "yes", NOW)
+    assert (state.step, state.reps, state.due_at) == (1, 1, NOW + srs.LEARNING_STEPS[1])
+
+    state = srs.review(state, "yes", NOW)
+    assert state.step is None
+    assert state.interval == srs.GRADUATING_INTERVAL
+    assert state.due_at == NOW + timedelta(days=srs.GRADUATING_INTERVAL)
+
+
+def test_learning_answers():
+    learning = srs.CardState(step=1, reps=1)
+    again = srs.review(learning, "no", NOW)
+    assert (again.step, again.due_at) == (0, NOW + srs.LEARNING_STEPS[0])
+
+    hard = srs.review(learning, "hard", NOW)
+    assert (hard.step, hard.due_at) == (1, NOW + srs.LEARNING_STEPS[1])
+
+    easy = srs.review(learning, "ez", NOW)
+    assert (easy.step, easy.interval) == (None, srs.EASY_INTERVAL)
+
+
+def test_review_multiplies_interval_by_ease():
+    state = srs.review(srs.CardState(ease=2.5, interval=4, step=None, reps=5), "yes", NOW)
+    assert state.interval == 10
+    assert state.due_at == NOW + timedelta(days=10)
+
+    easy = srs.review(srs.CardState(ease=2.5, interval=4, step=None), "ez", NOW)
+    assert easy.ease == pytest.approx(2.5 + srs.EASY_EASE_BONUS)
+    assert easy.interval == pytest.approx(4 * 2.5 * srs.EASY_FACTOR)
+
+
+def test_lapse_returns_card_to_learning():
+    state = srs.review(srs.CardState(ease=2.5, interval=10, step=None, reps=5, lapses=1), "no", NOW)
+    assert state.ease == pytest.approx(2.5 - srs.LAPSE_EASE_PENALTY)
+    assert state.interval == 10 * srs.LAPSE_FACTOR
+    assert (state.step, state.reps, state.lapses) == (0, 6, 2)
+    assert state.due_at == NOW + srs.LEARNING_STEPS[0]
+
+    short = srs.review(srs.CardState(interval=1, step=None), "no", NOW)
+    assert short.interval == srs.GRADUATING_INTERVAL
+
+
+def test_ease_does_not_go_below_floor():
+    lapsed = srs.review(srs.CardState(ease=srs.MIN_EASE + 0.1, interval=3, step=None), "no", NOW)
+    assert lapsed.ease == srs.MIN_EASE
+    hard = srs.review(srs.CardState(ease=srs.MIN_EASE, interval=3, step=None), "hard", NOW)
+    assert hard.ease == srs.MIN_EASE
+
+
+def test_legacy_document_starts_as_new_card():
+    legacy = {"front_side": "front", "back_side": "back", "active_coef": 1.2}
+    state = srs.CardState.from_document(legacy)
+    assert state == srs.CardState()
+    assert srs.review(state, "yes", NOW).step == 1
+
+
+def test_unknown_answer_is_rejected():
+    with pytest.raises(ValueError):
+        srs.review(srs.CardState(), "maybe", NOW)
+
+
+DOCUMENTS = [
+    {},
+    {"active_coef": 1.2},
+    {"learning_step": 1, "ease": 2.5, "interval": 0, "reps": 1, "lapses": 0},
+    {"learning_step": None, "ease": 2.5, "interval": 4, "reps": 5, "lapses": 1},
+    {"learning_step": None, "ease": srs.MIN_EASE + 0.05, "interval": 2.5, "reps": 9, "lapses": 3},
+]
+
+
+@requires_mongod
+@pytest.mark.parametrize("answer", ["no", "hard", "yes", "ez"])
+@pytest.mark.parametrize("document", DOCUMENTS)
+def test_pipeline_matches_review(document, answer):
+    from pymongo import MongoClient, ReturnDocument
+
+    collection = MongoClient(MONGODB_URL)["notion-bot-test"]["srs"]
+    card_id = collection.insert_one(dict(document)).inserted_id
+    try:
+        stored = collection.find_one_and_update({"_id": card_id}, srs.review_pipeline(answer, NOW),
+                                                return_document=ReturnDocument.AFTER)
+    finally:
+        collection.delete_one({"_id": card_id})
+
+    expected = srs.review(srs.CardState.from_document(document), answer, NOW)
+    actual = srs.CardState.from_document(stored)
+    assert (actual.step, actual.reps, actual.lapses) == (expected.step, expected.reps, expected.lapses)
+    assert actual.ease == pytest.approx(expected.ease)
+    assert actual.interval == pytest.approx(expected.interval)
+    # MongoDB keeps milliseconds
+    assert abs(actual.due_at - expected.due_at) <= timedelta(milliseconds=1)
@@ -0,0 +1,49 @@
+"""
+Stats updates of study_stats.update_pipeline() are computed from the stored user document
+"""
+from datetime import datetime, timedelta
+import pytest
+import srs
+import study_stats
+from conftest import MONGODB_URL, requires_mongod
+
+pytestmark = requires_mongod
+
+NOW = datetime(2024, 3, 1, 12, 0)
+
+
+@pytest.fixture
+def users():
+    from pymongo import MongoClient
+
+    collection = MongoClient(MONGODB_URL)["notion-bot-test"]["users"]
+    yield collection
+    collection.delete_many({})
+
+
+def answer(users, user_id, now: datetime) -> dict:
+    before = srs.CardState(due_at=now)
+    users.update_one({"_id": user_id}, study_stats.answer_update(before, srs.review(before, "yes", now), "yes", now))
+    return users.find_one({"_id": user_id})["stats"]
+
+
+@pytest.mark.parametrize("last_review_day, streak", [(None, 1), ("2024-02-29", 5), ("2024-03-01", 4), ("2024-02-20", 1)])
+def test_streak_follows_stored_last_review_day(users, last_review_day, streak):
+    user_id = users.insert_one({"stats": {"streak": 4, "last_review_day": last_review_day}}).inserted_id
+    stats = answer(users, user_id, NOW)
+    assert (stats["streak"], stats["last_review_day"]) == (streak, "2024-03-01")
+    # Answers of the same day do not move the streak
+    assert answer(users, user_id, NOW + timedelta(hours=1))["streak"] == streak
+
+
+def test_stale_days_are_dropped(users):
+    user_id = users.insert_one({"stats": {
+        "due": {"2024-02-20": 0, "2024-03-05": 2},
+        "reviews": {"2024-01-01": {"total": 3, "correct": 3}, "2024-02-29": {"total": 1, "correct": 0}},
+    }}).inserted_id
+    users.update_one({"_id": user_id}, study_stats.update_pipeline({"stats.cards": 1, "stats.due.2024-03-05": -2}, NOW))
+
+    stats = users.find_one({"_id": user_id})["stats"]
+    assert stats["cards"] == 1
+    assert stats["due"] == {}
+    assert stats["reviews"] == {"2024-02-29": {"total": 1, "correct": 0}}
@@ -0,0 +1,126 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, List
+import metrics
+
+logger = logging.getLogger(__name__)
+
+queue_wait = metrics.Histogram("webhook_queue_wait_seconds", "Time Telegram updates waited in queue before handling",
+                               buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+
+
+class UpdateQueue:
+    """
+    Processes Telegram updates in background worker threads
+
+    Updates are sharded between workers by chat id, so updates of one chat are
+    handled in the order they came while different chats run in parallel.
+    Each worker queue is bounded, put() refuses updates when it is full so the
+    webhook can ask Telegram to deliver them later.
+    """
+
+    def __init__(self, handler: Callable[[List], None], workers: int = 8, maxsize: int = 1000):
+        self.handler = handler
+        self._queues = [queue.Queue(maxsize) for _ in range(workers)]
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self.enqueued = 0
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def start(self):
+        for index, worker_queue in enumerate(self._queues):
+            thread = threading.Thread(target=self._work, args=(worker_queue,), name=f"update-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout: float = 30):
+        """
+        Lets workers finish queued updates and stops them
+        """
+        self._stopping.set()
+        for worker_queue in self._queues:
+            try:
+                worker_queue.put_nowait(None)
+            except queue.Full:
+                # Worker stops once it drains the queue
+                pass
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        self._threads = []
+
+    @staticmethod
+    def chat_id(update) -> int:
+        if update.message:
+            return update.message.chat.id
+        if update.callback_query:
+            return update.callback_query.from_user.id
+        return 0
+
+    def put(self, update) -> bool:
+        """
+        Enqueues update without blocking
+        :return: False if worker queue of the chat is full
+        """
+        worker_queue = self._queues[self.chat_id(update) % len(self._queues)]
+        if self._stopping.is_set():
+            with self._lock:
+                self.rejected += 1
+            return False
+        try:
+            worker_queue.put_nowait((time.monotonic(), update))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def _work(self, worker_queue: queue.Queue):
+        while True:
+            try:
+                item = worker_queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+            if item is None:
+                return
+            enqueued_at, update = item
+            waited = time.monotonic() - enqueued_at
+            queue_wait.observe(waited)
+            try:
+                self.handler([update])
+            except Exception:
+                logger.exception("Failed to process update %s", update.update_id)
+                with self._lock:
+                    self.failed += 1
+            with self._lock:
+                self.processed += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+    def depth(self) -> int:
+        return sum(worker_queue.qsize() for worker_queue in self._queues)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "depth": self.depth(),
+                "max_worker_depth": max(worker_queue.qsize() for worker_queue in self._queues),
+                "enqueued": self.enqueued,
+                "processed": self.processed,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "wait_avg": self.wait_total / self.processed if self.processed else 0,
+                "wait_max": self.wait_max,
+            }
@@ -1,19 +1,189 @@
-from datetime import datetime
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 from utils import env
-from db import get_database
+from db import LazyCollection, find_collscans
 import urllib.parse
+from pymongo import UpdateOne, UpdateMany, DeleteMany, ReturnDocument, ASCENDING, DESCENDING
 from pymongo.collection import Collection
 from bson.objectid import ObjectId
-import requests
 from base64 import b64encode
-from typing import Union
-from notion_api import NotionAPI
+from concurrent.futures import Future
+from functools import partial
+from itertools import islice
+from typing import Iterable, Iterator, List, NamedTuple, Union
+import logging
+import metrics
+import decks
+import search
+import srs
+import study_stats
+from passive import PassiveSettings
+from study_queue import StudyQueue
+from review_log import ReviewLog
+from notion_api import NotionAPI, NotionAPIError, get_client, parse_notion_time
+from flashcard_parser import Flashcard, FlashcardParser, content_hash
+from page_cache import PageMetadata, get_page_cache
+
+logger = logging.getLogger(__name__)
+
+users = LazyCollection("users")
+pages = LazyCollection("pages")
+flashcards = LazyCollection("flashcards")
+reviews = LazyCollection("reviews")
+
+# Every applied answer is appended here, see review_log.py
+review_log = ReviewLog(reviews, max_batch=int(env.get("REVIEW_LOG_BATCH", 100)),
+                       interval=float(env.get("REVIEW_LOG_INTERVAL", 5)))
+
+# Page holding imported cards that do not belong to any page of the user,
+# hex like Notion ids since page ids are packed into callback data
+IMPORTED_PAGE = "0" * 32
+# Page library order, most recently synced first
+PAGE_ORDER = [("updatedAt", DESCENDING), ("_id", DESCENDING)]
+EPOCH = datetime(1970, 1, 1)
+LIBRARY_PAGE_SIZE = 5
+LIBRARY_FIELDS = {"page_id": 1, "title": 1, "icon": 1, "type": 1, "updatedAt": 1}
+
+
+def explain_plans(user_id: ObjectId = None) -> dict:
+    """
+    Runs explain() for every query shape issued by User
+    Writes and counts are represented by finds with the same filter
+    :return: query name -> explain() output
+    """
+    user_id = user_id or ObjectId()
+    queries = {
+        "users.from_id": users.find({"_id": user_id}).limit(1),
+        "users.from_telegram_credentials": users.find({"user_id": 0}).limit(1),
+        "pages.add_page": pages.find({"page_id": "", "user": user_id}).limit(1),
+        "pages.count": pages.find({"user": user_id}),
+        "pages.get_pages": pages.find({"user": user_id}).sort(PAGE_ORDER).limit(6),
+        "pages.get_pages_after": pages.find(
+            {"user": user_id, **PageCursor(0, str(ObjectId())).filter(older=True)}).sort(PAGE_ORDER).limit(6),
+        "flashcards.reload_flashcards": flashcards.find({"user": user_id, "page_id": ""}),
+        "flashcards.database_batch": flashcards.find({"user": user_id, "page_id": "", "block_id": {"$in": [""]}}),
+        "flashcards.database_deleted": flashcards.find({"user": user_id, "page_id": "", "sync_generation": {"$ne": 1}}),
+        "flashcards.delete_page": flashcards.find({"page_id": "", "user": user_id}),
+        "flashcards.search": flashcards.find(search.query_filter(user_id, ["query"])),
+        "flashcards.get_next_flashcard": flashcards.find({"user": user_id}).limit(1),
+        "flashcards.get_flashcard_by_id": flashcards.find({"_id": ObjectId()}).limit(1),
+        "flashcards.active_study": flashcards.find(
+            {"user": user_id, "due_at": {"$lte": datetime.utcnow()}}).sort("due_at", 1).limit(1),
+        "users.passive_subscriptions": users.find({"passive.enabled": True}, {"user_id": 1, "passive": 1}),
+        "users.passive_changes": users.find({"passive.updated_at": {"$gt": datetime.utcnow()}}, {"user_id": 1, "passive": 1}),
+        "flashcards.flashcard_answer": flashcards.find(
+            {"_id": ObjectId(), "user": user_id, "due_at": {"$not": {"$gt": datetime.utcnow()}}}).limit(1),
+    }
+    return {name: cursor.explain() for name, cursor in queries.items()}
+
+
+def explain_queries(user_id: ObjectId = None) -> dict:
+    """
+    :return: query name -> COLLSCAN stages of its winning plan
+    """
+    return {name: find_collscans(plan) for name, plan in explain_plans(user_id).items()}
+
+
+class PageCursor(NamedTuple):
+    """
+    Position of a page in the library, kept in keyboard buttons
+    """
+    updated_at: int
+    page_object_id: str
+
+    @classmethod
+    def of(cls, page: dict) -> "PageCursor":
+        return cls(page["updatedAt"], page["_id"])
+
+    def filter(self, older: bool, inclusive: bool = False) -> dict:
+        """
+        Range of pages after (older) or before the cursor in PAGE_ORDER
+        """
+        updated_at = EPOCH + timedelta(milliseconds=self.updated_at)
+        compare = "$lt" if older else "$gt"
+        return {"$or": [
+            {"updatedAt": {compare: updated_at}},
+            {"updatedAt": updated_at, "_id": {compare + ("e" if inclusive else ""): ObjectId(self.page_object_id)}},
+        ]}
+
+
+@dataclass
+class PageView:
+    """
+    Page of the library keyboard
+    pages - {"page_id", "title", "icon", "type", "_id", "updatedAt"}, where updatedAt is in milliseconds
+    previous, next - cursors of neighbour pages or None at the ends
+    """
+    pages: List[dict]
+    count: int
+    previous: Union[PageCursor, None] = None
+    next: Union[PageCursor, None] = None
+
+
+def _library_item(page: dict) -> dict:
+    # MongoDB keeps milliseconds, so cursors built from them match stored values exactly
+    updated_at = page.get("updatedAt") or EPOCH
+    return {"page_id": page["page_id"], "title": page.get("title"), "icon": page.get("icon"), "type": page.get("type"),
+            "_id": str(page["_id"]), "updatedAt": (updated_at - EPOCH) // timedelta(milliseconds=1)}
+
+
+def next_due_flashcard(user_id: ObjectId) -> Union[dict, None]:
+    """
+    Picks the most overdue flashcard of user
+    """
+    return flashcards.find_one(
+        {"user": user_id, "due_at": {"$lte": datetime.utcnow()}},
+        sort=[("due_at", ASCENDING)]
+    )
+
+
+def passive_subscriptions(since: datetime = None):
+    """
+    Users with passive mode settings
+    :param since: return users which settings changed after this time, otherwise all enabled ones
+    """
+    query = {"passive.updated_at": {"$gt": since}} if since else {"passive.enabled": True}
+    return users.find(query, {"user_id": 1, "passive": 1})
+
+
+def card_fields(flashcard: Flashcard, card_hash: str) -> dict:
+    """
+    Fields written for new and edited cards, including their search index keys
+    """
+    return {**flashcard.__dict__, "content_hash": card_hash,
+            "search_keys": search.index_keys(flashcard.front_side, flashcard.back_side)}
+
+
+def _upsert_card_op(card_key: dict, flashcard: Flashcard, now: datetime, fields: dict = None) -> UpdateOne:
+    """
+    Upsert of a synced or imported card, new cards are due right away unless fields bring a schedule
+    :param fields: extra fields to set, e.g. sync generation or restored scheduling state
+    """
+    update = {"$set": {**card_fields(flashcard, flashcard.content_hash()), **(fields or {})},
+              "$setOnInsert": {"createdAt": now}}
+    if "due_at" not in update["$set"]:
+        update["$setOnInsert"]["due_at"] = datetime.utcnow()
+    return UpdateOne(card_key, update, upsert=True)
+
+
+@dataclass
+class SyncReport:
+    """
+    Result of page sync
+    fetched - blocks or database rows received from Notion, skipped - cards left as they were,
+    malformed - blocks marked as cards that could not be parsed
+    """
+    fetched: int = 0
+    skipped: int = 0
+    malformed: int = 0
+    inserted: int = 0
+    edited: int = 0
+    deleted: int = 0
+    page_skipped: bool = False
 
-db = get_database()
-
-users = db["users"]
-pages = db["pages"]
-flashcards = db["flashcards"]
+    @property
+    def changed(self) -> int:
+        return self.inserted + self.edited + self.deleted
 
 
 class User:
@@ -21,6 +191,7 @@ class User:
 
     def __init__(self, user: Collection):
         self._model = user
+        self._study_queue = None
 
         try:
             self.notion = NotionAPI(user["access_token"], user["_id"])
@@ -46,7 +217,12 @@ class User:
 
     @staticmethod
     def register(user_id, first_name):
-        return users.insert_one({"user_id": user_id, "first_name": first_name})
+        return users.find_one_and_update(
+            {"user_id": user_id},
+            {"$setOnInsert": {"user_id": user_id, "first_name": first_name}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
 
     def generate_login_url(self):
         args = {
@@ -63,8 +239,7 @@ class User:
         url = "https://api.notion.com/v1/oauth/token"
         auth_token = f"{env['NOTION_CLIENT_ID']}:{env['NOTION_CLIENT_SECRET']}".encode("ascii")
         encoded_token = b64encode(auth_token).decode('ascii')
-        print(encoded_token)
-        json_res = requests.post(url, data={
+        json_res = get_client().request("POST", url, data={
             "grant_type": "authorization_code",
             "code": code,
             "redirect_uri": self.redirect_uri
@@ -72,10 +247,13 @@ class User:
             "Authorization": f"Basic {encoded_token}"
         })
         res: dict = json_res.json()
+        metrics.log_sampled(logger, "notion_token", sample_rate=1, user=self._model["_id"],
+                            status=json_res.status_code, error=res.get("error"))
         if res.get("error"):
             return None
 
-        users.update_one({"_id": self._model["_id"]}, {"$set": res})
+        self._update_model({"$set": res})
+        self.notion = NotionAPI(self._model["access_token"], self._model["_id"])
 
         return res
 
@@ -85,121 +263,494 @@ class User:
     def model_db_id(self) -> dict:
         return {"_id": self._model["_id"]}
 
+    def _update_model(self, update: dict):
+        """
+        Applies update to user document and replaces cached model with the result,
+        so sessions never read their own stale writes
+        """
+        model = users.find_one_and_update(self.model_db_id(), update, return_document=ReturnDocument.AFTER)
+        if model:
+            self._model = model
+
     def add_page(self, page_id: str) -> bool:
+        """
+        Adds page or database and loads its flashcards
+        Rows of databases become cards, front and back are mapped to properties, see database_mapping()
+        """
         result = pages.find_one({"page_id": page_id, "user": self._model["_id"]})
-        count = pages.find().count()
-        if result or count >= 5:
+        if result or self.count_pages() >= int(env.get("MAX_PAGES", 50)):
             return False
-        page = self.notion.page().retrieve(page_id)
-        pages.insert_one({
-            "page_id": page_id,
-            "user": self._model["_id"],
-            "title": page.get_title(),
-        })
+        page_model = {"page_id": page_id, "user": self._model["_id"], "updatedAt": datetime.now()}
+        try:
+            metadata = self.page_metadata(page_id, fresh=True)
+            page_model.update({"title": metadata.title, "icon": metadata.icon})
+        except NotionAPIError:
+            try:
+                database = self.notion.database().retrieve(page_id)
+            except NotionAPIError:
+                return False
+            if not (mapping := self.database_mapping(database.property_types())):
+                return False
+            page_model.update({"type": "database", "title": database.get_title(), "properties": mapping})
+        pages.insert_one(page_model)
+        get_page_cache().invalidate_page_summary(self._model["_id"])
         self.reload_flashcards(page_id)
         return True
 
-    def get_pages(self, page_number, per_page=5):
-        skip = (page_number - 1) * per_page if page_number > 0 else 0
-        return pages.find({"user": self._model["_id"]}).skip(skip).limit(per_page).sort("updatedAt", direction=-1)
+    @staticmethod
+    def database_mapping(property_types: dict) -> Union[dict, None]:
+        """
+        Picks properties of database rows used as flashcard sides
+        Front and Back properties if database has them, otherwise title and the first text property
+        :return: {"front": name, "back": name} or None if database has no suitable properties
+        """
+        front = "Front" if "Front" in property_types else \
+            next((name for name, kind in property_types.items() if kind == "title"), None)
+        back = "Back" if "Back" in property_types else \
+            next((name for name, kind in property_types.items() if kind == "rich_text"), None)
+        if not front or not back:
+            return None
+        return {"front": front, "back": back}
+
+    def page_metadata(self, page_id: str, fresh: bool = False) -> PageMetadata:
+        """
+        Title, icon and last edit time of page, read through the shared page cache
+        :param fresh: always ask Notion and refresh the cached entry
+        :raise NotionAPIError: if page can not be retrieved
+        """
+        cache = get_page_cache()
+        if not fresh and (metadata := cache.get(self._model["_id"], page_id)):
+            return metadata
+        metadata = self.notion.page().retrieve(page_id).metadata()
+        cache.set(self._model["_id"], page_id, metadata)
+        return metadata
+
+    def get_page(self, page_id: str) -> Union[dict, None]:
+        return pages.find_one({"page_id": page_id, "user": self._model["_id"]})
+
+    def _page_summary(self) -> dict:
+        """
+        Page count and the first keyboard page, cached until pages of user change
+        """
+        cache = get_page_cache()
+        summary, generation = cache.get_page_summary(self._model["_id"])
+        if summary is None:
+            first = pages.find({"user": self._model["_id"]}, LIBRARY_FIELDS)
+            summary = {
+                "count": pages.count_documents({"user": self._model["_id"]}),
+                "first": [_library_item(page) for page in first.sort(PAGE_ORDER).limit(LIBRARY_PAGE_SIZE + 1)],
+            }
+            cache.set_page_summary(self._model["_id"], summary, generation)
+        return summary
+
+    def count_pages(self) -> int:
+        """
+        Pages in the library of user, including imported cards page
+        """
+        return self._page_summary()["count"]
+
+    def get_pages(self, cursor: PageCursor = None, older: bool = True, inclusive: bool = False) -> PageView:
+        """
+        Keyboard page of the library, found by range on (user, updatedAt, _id) index,
+        so every page takes the same time however deep it is
+        :param cursor: position to start from, the first page if None
+        :param older: pages after cursor, otherwise the ones before it
+        :param inclusive: include page at cursor, used to render the same page again
+        """
+        summary = self._page_summary()
+        first = summary["first"]
+        if cursor is None:
+            found = first[:LIBRARY_PAGE_SIZE]
+            return PageView(found, summary["count"], None,
+                            PageCursor.of(found[-1]) if len(first) > LIBRARY_PAGE_SIZE else None)
+
+        order = PAGE_ORDER if older else [(name, -direction) for name, direction in PAGE_ORDER]
+        found = [_library_item(page) for page in pages.find(
+            {"user": self._model["_id"], **cursor.filter(older, inclusive)}, LIBRARY_FIELDS
+        ).sort(order).limit(LIBRARY_PAGE_SIZE + 1)]
+        has_more = len(found) > LIBRARY_PAGE_SIZE
+        found = found[:LIBRARY_PAGE_SIZE]
+        if not older:
+            found.reverse()
+            has_more, has_newer = True, has_more
+        else:
+            has_newer = bool(found) and found[0]["_id"] != first[0]["_id"]
+        if not found or not has_newer and not older:
+            # Pages around cursor were deleted or the beginning is reached
+            return self.get_pages()
+        return PageView(found, summary["count"], PageCursor.of(found[0]) if has_newer else None,
+                        PageCursor.of(found[-1]) if has_more else None)
 
-    def reload_flashcards(self, page_id):
-        result = pages.update_one({"page_id": page_id}, {"$set": {"updatedAt": datetime.now()}})
-        if result.matched_count == 0:
+    @staticmethod
+    def _is_unchanged(stored_time: Union[str, None], current_time: Union[str, None], synced_at: Union[datetime, None]) -> bool:
+        """
+        Checks whether Notion object was not edited since last sync
+        Notion truncates edit times to the minute, so an edit made in the same minute
+        as the previous sync keeps the same last_edited_time and has to be treated as changed
+        """
+        if not stored_time or stored_time != current_time or not synced_at:
             return False
-
-        block = self.notion.block().retrieve(page_id)
-        retrieved_flashcards = block.parse_flashcards()
-
-        available_flashcards = flashcards.find({"page_id": page_id})
+        return synced_at >= parse_notion_time(current_time) + timedelta(minutes=1)
+
+    def reload_flashcards(self, page_id, incremental=False) -> Union["SyncReport", bool]:
+        """
+        Syncs page flashcards with Notion
+        :param incremental: skip page if it was not edited since last sync
+                            and do not re-parse blocks that were not edited
+        :return: SyncReport or False if page does not exist
+        """
+        page_model = pages.find_one({"page_id": page_id, "user": self._model["_id"]})
+        if not page_model:
+            return False
+        if page_model.get("type") == "database":
+            return self._reload_database(page_model, incremental)
+        if page_model.get("type") == "import":
+            return SyncReport(page_skipped=True)
+
+        report = SyncReport()
+        sync_started = datetime.utcnow()
+        previous_sync = page_model.get("syncedAt")
+        try:
+            # Full syncs follow add_page or an explicit reload, cached metadata is fresh enough there
+            metadata = self.page_metadata(page_id, fresh=incremental)
+        except NotionAPIError:
+            return False
+        last_edited_time = metadata.last_edited_time
+        if incremental and self._is_unchanged(page_model.get("last_edited_time"), last_edited_time, previous_sync):
+            report.page_skipped = True
+            return report
+
+        available_flashcards = flashcards.find(
+            {"user": self._model["_id"], "page_id": page_id},
+            {"block_id": 1, "content_hash": 1, "front_side": 1, "back_side": 1, "last_edited_time": 1,
+             "due_at": 1, "learning_step": 1}
+        )
         available_flashcards_dict = {}
         for i in available_flashcards:
             available_flashcards_dict[i["block_id"]] = i
 
-        to_insert = []
-        for retrieved_flashcard in retrieved_flashcards:
-            block_id = retrieved_flashcard.block_id
+        known_edits = {}
+        if incremental:
+            # Blocks edited in the minute of the previous sync may keep their edit time, they are parsed again
+            known_edits = {block_id: card["last_edited_time"] for block_id, card in available_flashcards_dict.items()
+                           if self._is_unchanged(card.get("last_edited_time"), card.get("last_edited_time"),
+                                                 previous_sync)}
+        block = self.notion.block().retrieve(page_id)
+        parser = block.parser(known_edits=known_edits)
+        operations = []
+        now = datetime.now()
 
-            flashcard_exists = available_flashcards_dict.get(block_id)
-            if not flashcard_exists:
-                retrieved_flashcard.createdAt = datetime.now()
-                to_insert.append(retrieved_flashcard.__dict__)
-                continue
-            del available_flashcards_dict[block_id]
+        def fetched_blocks():
+            for retrieved_block in block.walk():
+                report.fetched += 1
+                yield retrieved_block
 
-            if flashcard_exists["front_side"] != retrieved_flashcard.front_side or \
-                    flashcard_exists["back_side"] != retrieved_flashcard.back_side:
-                retrieved_flashcard.editedAt = datetime.now()
-                flashcards.update_one({"block_id": block_id}, {"$set": retrieved_flashcard.__dict__, })
+        try:
+            for retrieved_flashcard in parser.parse(fetched_blocks()):
+                block_id = retrieved_flashcard.block_id
+                flashcard_exists = available_flashcards_dict.get(block_id)
+                card_key = {"user": self._model["_id"], "page_id": page_id, "block_id": block_id}
+                card_hash = retrieved_flashcard.content_hash()
+                if not flashcard_exists:
+                    operations.append(_upsert_card_op(card_key, retrieved_flashcard, now))
+                    continue
+                del available_flashcards_dict[block_id]
+
+                stored_hash = flashcard_exists.get("content_hash") or \
+                    content_hash(flashcard_exists["front_side"], flashcard_exists["back_side"])
+                if stored_hash != card_hash:
+                    operations.append(UpdateOne(card_key, {
+                        "$set": {**card_fields(retrieved_flashcard, card_hash), "editedAt": now}
+                    }))
+                    report.edited += 1
+                elif flashcard_exists.get("last_edited_time") != retrieved_flashcard.last_edited_time or \
+                        not flashcard_exists.get("content_hash"):
+                    operations.append(UpdateOne(card_key, {"$set": {
+                        "last_edited_time": retrieved_flashcard.last_edited_time,
+                        "content_hash": card_hash
+                    }}))
+        except NotionAPIError:
+            return False
+        for block_id in parser.unchanged:
+            if available_flashcards_dict.pop(block_id, None) is not None:
+                report.skipped += 1
+        report.malformed = len(parser.diagnostics)
+        for diagnostic in parser.diagnostics[:10]:
+            logger.info("Malformed flashcard on page %s: %s", page_id, diagnostic)
+
+        if available_flashcards_dict:
+            operations.append(DeleteMany({
+                "user": self._model["_id"],
+                "page_id": page_id,
+                "block_id": {"$in": list(available_flashcards_dict)}
+            }))
+        if operations:
+            result = flashcards.bulk_write(operations, ordered=False)
+            report.inserted = result.upserted_count
+            report.deleted = result.deleted_count
+            self._update_stats(study_stats.combine(
+                study_stats.new_cards_update(report.inserted, datetime.utcnow()),
+                study_stats.cards_update(available_flashcards_dict.values(), -1) if report.deleted else {}
+            ))
+
+        if report.changed and self._study_queue:
+            self._study_queue.clear()
+        pages.update_one({"_id": page_model["_id"]}, {"$set": {
+            "updatedAt": datetime.now(),
+            "syncedAt": sync_started,
+            "last_edited_time": last_edited_time,
+            "title": metadata.title,
+            "icon": metadata.icon,
+        }})
+        get_page_cache().invalidate_page_summary(self._model["_id"])
+        return report
+
+    def _reload_database(self, page_model: dict, incremental: bool) -> Union["SyncReport", bool]:
+        """
+        Streams database rows into flashcards in batches, memory does not grow with database size
+        Incremental sync asks Notion only for rows edited since last sync, it cannot see deleted rows.
+        Full sync stamps every row with a new sync generation and deletes cards of rows that were not
+        returned, incremental syncs fall back to it every DATABASE_FULL_SYNC_INTERVAL seconds
+        """
+        database_id = page_model["page_id"]
+        report = SyncReport()
+        sync_started = datetime.utcnow()
+        previous_sync = page_model.get("syncedAt")
+        previous_full_sync = page_model.get("fullSyncedAt")
+        full_sync_interval = timedelta(seconds=int(env.get("DATABASE_FULL_SYNC_INTERVAL", 86400)))
+        edited_after = None
+        if incremental and previous_sync and previous_full_sync \
+                and sync_started - previous_full_sync < full_sync_interval:
+            # Notion truncates edit times to the minute
+            edited_after = (previous_sync - timedelta(minutes=1)).isoformat() + "Z"
+        generation = None if edited_after else page_model.get("sync_generation", 0) + 1
+        batch_size = int(env.get("NOTION_IMPORT_BATCH", 500))
+
+        database = self.notion.database()
+        parser = FlashcardParser(self._model["_id"], database_id)
+        mapping = page_model["properties"]
+
+        def fetched_rows():
+            for row in database.iter_rows(database_id, edited_after):
+                report.fetched += 1
+                yield row
 
-        if len(to_insert) > 0:
-            flashcards.insert(to_insert)
-        to_delete = list(map(lambda i: i["block_id"], available_flashcards_dict.values()))
-        if len(to_delete) > 0:
-            flashcards.delete_many({"block_id": {"$in": to_delete}})
+        try:
+            rows = parser.parse_rows(fetched_rows(), mapping["front"], mapping["back"])
+            while batch := list(islice(rows, batch_size)):
+                self._write_database_batch(database_id, batch, generation, report)
+        except NotionAPIError:
+            return False
 
-        return True
+        report.malformed = len(parser.diagnostics)
+        stats_update = study_stats.new_cards_update(report.inserted, datetime.utcnow())
+        if generation is not None:
+            stale_cards = {"user": self._model["_id"], "page_id": database_id, "sync_generation": {"$ne": generation}}
+            deleted = study_stats.stored_cards_update(flashcards, stale_cards, -1)
+            if deleted:
+                report.deleted = flashcards.delete_many(stale_cards).deleted_count
+                stats_update = study_stats.combine(stats_update, deleted)
+        self._update_stats(stats_update)
+
+        if report.changed and self._study_queue:
+            self._study_queue.clear()
+        page_update = {"updatedAt": datetime.now(), "syncedAt": sync_started}
+        if generation is not None:
+            page_update["sync_generation"] = generation
+            page_update["fullSyncedAt"] = sync_started
+        pages.update_one({"_id": page_model["_id"]}, {"$set": page_update})
+        get_page_cache().invalidate_page_summary(self._model["_id"])
+        return report
+
+    def _write_database_batch(self, database_id: str, batch: list, generation: Union[int, None],
+                              report: "SyncReport"):
+        card_filter = {"user": self._model["_id"], "page_id": database_id}
+        stored = {card["block_id"]: card.get("content_hash") for card in flashcards.find(
+            {**card_filter, "block_id": {"$in": [flashcard.block_id for flashcard in batch]}},
+            {"block_id": 1, "content_hash": 1}
+        )}
+        stamp = {"sync_generation": generation} if generation is not None else {}
+        now = datetime.now()
+        operations = []
+        unchanged = []
+        for flashcard in batch:
+            card_hash = flashcard.content_hash()
+            if flashcard.block_id not in stored:
+                operations.append(_upsert_card_op({**card_filter, "block_id": flashcard.block_id}, flashcard, now,
+                                                  stamp))
+            elif stored[flashcard.block_id] != card_hash:
+                operations.append(UpdateOne({**card_filter, "block_id": flashcard.block_id}, {
+                    "$set": {**card_fields(flashcard, card_hash), "editedAt": now, **stamp}
+                }))
+                report.edited += 1
+            else:
+                unchanged.append(flashcard.block_id)
+        if unchanged and stamp:
+            operations.append(UpdateMany({**card_filter, "block_id": {"$in": unchanged}}, {"$set": stamp}))
+        report.skipped += len(unchanged)
+        if operations:
+            report.inserted += flashcards.bulk_write(operations, ordered=False).upserted_count
 
     def delete_page(self, page_id):
         pages.delete_one({"page_id": page_id, "user": self._model["_id"]})
-        flashcards.delete_many({"page_id": page_id})
+        page_cards = {"page_id": page_id, "user": self._model["_id"]}
+        deleted = study_stats.stored_cards_update(flashcards, page_cards, -1)
+        if flashcards.delete_many(page_cards).deleted_count:
+            self._update_stats(deleted)
+        cache = get_page_cache()
+        cache.invalidate(self._model["_id"], page_id)
+        cache.invalidate_page_summary(self._model["_id"])
+        if self._study_queue:
+            self._study_queue.clear()
+
+    def export_deck(self, deck_format: str = decks.CSV) -> Iterator[decks.ExportChunk]:
+        """
+        Streams cards of user into deck files, see decks.export_chunks()
+        """
+        cursor = flashcards.find({"user": self._model["_id"]}, decks.EXPORT_FIELDS, batch_size=decks.batch_size())
+        return decks.export_chunks(cursor, deck_format)
+
+    def import_deck(self, lines: Iterable[str]) -> decks.ImportReport:
+        """
+        Upserts cards of deck file in batches
+        Rows exported from a page the user still has restore that card with its schedule,
+        other rows go to the imported cards page, keyed by their sides when they have no id
+        """
+        report = decks.ImportReport()
+        page_ids = {page["page_id"] for page in pages.find({"user": self._model["_id"]}, {"page_id": 1})}
+        rows = decks.read_rows(lines)
+        imported_page = False
+        while batch := list(islice(rows, decks.batch_size())):
+            operations = []
+            now = datetime.now()
+            for row in batch:
+                report.rows += 1
+                if row is None:
+                    report.malformed += 1
+                    continue
+                if row.page_id in page_ids and row.page_id != IMPORTED_PAGE and row.block_id:
+                    page_id, block_id = row.page_id, row.block_id
+                else:
+                    page_id, block_id = IMPORTED_PAGE, row.block_id or content_hash(row.front_side, row.back_side)
+                    imported_page = True
+                flashcard = Flashcard(page_id, block_id, row.front_side, row.back_side, self._model["_id"])
+                operations.append(_upsert_card_op(
+                    {"user": self._model["_id"], "page_id": page_id, "block_id": block_id}, flashcard, now,
+                    row.state.to_document() if row.state else None))
+            if operations:
+                result = flashcards.bulk_write(operations, ordered=False)
+                report.inserted += result.upserted_count
+                report.updated += result.modified_count
+
+        if imported_page:
+            pages.update_one({"page_id": IMPORTED_PAGE, "user": self._model["_id"]}, {
+                "$set": {"updatedAt": datetime.now()},
+                "$setOnInsert": {"title": "Imported cards", "type": "import"}
+            }, upsert=True)
+            get_page_cache().invalidate_page_summary(self._model["_id"])
+        if report.inserted or report.updated:
+            # Restored cards bring their own schedule, counting them is left to reconciliation
+            self.reconcile_stats()
+            if self._study_queue:
+                self._study_queue.clear()
+        return report
+
+    def search(self, query: str, limit: int = 5) -> list:
+        """
+        Cards matching every word of query, see search.py
+        """
+        return search.search(flashcards, self._model["_id"], query, limit)
 
     def get_next_flashcard(self):
 
         return flashcards.find_one({"user": self._model["_id"]})
 
+    @property
+    def study_queue(self) -> StudyQueue:
+        if self._study_queue is None:
+            self._study_queue = StudyQueue(flashcards, self._model["_id"],
+                                           size=int(env.get("STUDY_QUEUE_SIZE", 10)))
+        return self._study_queue
+
     def get_flashcard_by_id(self, flashcard_id):
-        return flashcards.find_one({"_id": ObjectId(flashcard_id)})
-
-    def active_study(self):
-        active_cards_ids = self._model.get("active_cards", [])
-        active_cards_ids_list = list(active_cards_ids)
-
-        if (active_cards_count := len(active_cards_ids_list)) < 5:
-            additional_cards = flashcards.find(
-                {
-                    "$or": [
-                        {"active_coef": {"$exists": False}},
-                        {"active_coef": {"$lt": 1.5}}
-                    ],
-
-                    # ,
-                    "user": self._model["_id"],
-                    "_id": {"$nin": active_cards_ids}
-                }, {"_id": 1}) \
-                .limit(5 - active_cards_count)
-            additional_cards_ids = list(map(lambda i: i["_id"], list(additional_cards)))
-            print(additional_cards_ids)
-            users.update_one(self.model_db_id(), {"$addToSet": {"active_cards": {"$each": additional_cards_ids}}})
-            active_cards_ids_list.extend(additional_cards_ids)
-
-        card_to_show = flashcards \
-            .find({"_id": {"$in": active_cards_ids_list}}) \
-            .sort("active_coef", direction=1) \
-            .limit(1)
-        if card_to_show.count() < 1:
+        return self.study_queue.get(flashcard_id) or flashcards.find_one({"_id": ObjectId(flashcard_id)})
+
+    def active_study(self) -> Union[dict, None]:
+        """
+        Picks the most overdue flashcard from prefetched study queue
+        :return: flashcard or None if nothing is due
+        """
+        return self.study_queue.next()
+
+    def submit_answer(self, card_id, answer, time_to_answer: float = None) -> Future:
+        """
+        Records answer in background so the next card can be shown right away
+        """
+        return self.study_queue.submit_answer(card_id, partial(self.flashcard_answer, card_id, answer, time_to_answer))
+
+    def flashcard_answer(self, card_id, answer, time_to_answer: float = None) -> Union[srs.CardState, None]:
+        """
+        Schedules next review of flashcard with a single atomic update and appends it to review log
+        Cards which are not due (e.g. answered twice) are left untouched.
+        :param answer: answer level from callback data (yes/no/ez/hard)
+        :param time_to_answer: seconds since the card was rendered, if known
+        :return: new scheduling state or None if card does not exist or is not due
+        """
+        now = datetime.utcnow()
+        card = flashcards.find_one_and_update(
+            {"_id": ObjectId(card_id), "user": self._model["_id"], "due_at": {"$not": {"$gt": now}}},
+            srs.review_pipeline(answer, now),
+            projection={"front_side": 0, "back_side": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+        if not card:
             return None
-        return list(card_to_show)[0]
-
-    def flashcard_answer(self, card_id, answer):
-        card = self.get_flashcard_by_id(card_id)
-        active_coef = card.get("active_coef", 0)
-        active_coef_rules = {
-            "yes": lambda coef: coef + 0.5,
-            "no": lambda _: 0
-        }
-        active_coef_rule = active_coef_rules.get(answer, lambda coef: coef)
-        new_active_coef = active_coef_rule(active_coef)
-        flashcards.update_one({"_id": card["_id"]}, {"$set": {"active_coef": new_active_coef}})
-
-        if new_active_coef >= 1.5:
-            users.update_one(self.model_db_id(), {"$pull": {"active_cards": {"$in": [card["_id"]]}}})
+        review_log.append({"card": card["_id"], "user": self._model["_id"], "answer": srs.normalize_answer(answer),
+                           "answered_at": now, "time_to_answer": time_to_answer})
+        # Pipeline applies the same review() on the server, previous state is needed for stats
+        previous = srs.CardState.from_document(card)
+        state = srs.review(previous, answer, now)
+
+        self._update_model(study_stats.answer_update(previous, state, answer, now))
+        return state
+
+    def _update_stats(self, increments: dict):
+        if increments:
+            self._update_model(study_stats.update_pipeline(increments, datetime.utcnow()))
+
+    def get_study_stats(self) -> study_stats.StudyStats:
+        """
+        Stats of user from counters of the user document, see study_stats.py
+        """
+        user = users.find_one(self.model_db_id(), {"stats": 1}) or {}
+        if not (user.get("stats") or {}).get("reconciled_at"):
+            # Counters of users who studied before stats were added start from reconciliation
+            self.reconcile_stats()
+            return study_stats.StudyStats.from_document(self._model["stats"], datetime.utcnow())
+        return study_stats.StudyStats.from_document(user["stats"], datetime.utcnow())
+
+    def reconcile_stats(self):
+        """
+        Recomputes stats counters from cards and review log
+        """
+        review_log.flush()
+        self._update_model({"$set": {"stats": study_stats.reconcile(flashcards, reviews, self._model["_id"])}})
+
+    def get_passive_settings(self) -> PassiveSettings:
+        return PassiveSettings.from_document(self._model.get("passive"))
+
+    def set_passive_settings(self, settings: PassiveSettings):
+        self._update_model({"$set": {"passive": {**settings.to_document(), "updated_at": datetime.utcnow()}}})
 
     def set_study_mode(self, study_mode_state: bool):
-        users.update_one(self.model_db_id(), {"$set": {"study_mode_active": study_mode_state}})
+        self._update_model({"$set": {"study_mode_active": study_mode_state}})
 
     def is_study_mode_active(self) -> bool:
-        return bool(self._model["study_mode_active"])
+        return bool(self._model.get("study_mode_active"))
+
+    @property
+    def id(self) -> ObjectId:
+        return self._model["_id"]
 
     @property
     def telegram_user_id(self):
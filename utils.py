@@ -1,6 +1,63 @@
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
 env = os.environ
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter
+    :param rate: tokens added per second
+    :param capacity: maximum burst size, defaults to rate
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else self.rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """
+        Takes tokens if they are available
+        :return: 0 on success, otherwise seconds to wait until tokens are available
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1):
+        """
+        Blocks until tokens are available
+        """
+        while (wait := self.try_acquire(tokens)) > 0:
+            time.sleep(wait)
+
+    def is_full(self) -> bool:
+        """
+        Checks whether bucket has refilled completely, so it can be dropped and recreated
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens >= self.capacity
+
+    def pause(self, seconds: float):
+        """
+        Drains the bucket so no tokens are available for given amount of seconds
+        Used when remote side asks us to slow down
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, -seconds * self.rate)
@@ -0,0 +1,7 @@
+"""
+WSGI entry point of production mode: gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from app import create_app, warm_up
+
+app = create_app()
+warm_up()